@@ -0,0 +1,439 @@
+import asyncio
+import time
+from collections import deque
+from . import protocol
+from . import replication
+from . import rdb
+from . import aof
+from . import stats
+from .command_handler import (handle_command, prepare_blocking_command, argument_error, BlockingRequest,
+                              WRITE_COMMANDS, BLOCKING_COMMANDS, WrongTypeError, WRONGTYPE_ERROR)
+from .resp import RespParser, ProtocolError
+from .datastore import ACTIVE_EXPIRE_HZ
+
+class RedisServerProtocol(asyncio.Protocol):
+    """
+    One instance per client connection, all driven by a single event loop
+    thread. Commands run straight through COMMAND_HANDLERS (the datastore is
+    created with a NullLock in this mode); blocking commands and WAIT park the
+    connection on a future instead of a thread.
+    """
+    __slots__ = ("datastore", "server_state", "parser", "transport", "peername",
+                 "in_transaction", "transaction_queue", "is_replica",
+                 "pending", "replies", "blocked_task", "aof_offset", "deferred_writes",
+                 "replica_output", "replica_output_size", "replica_flush_scheduled", "replica_held",
+                 "writing_paused", "drain_waiter")
+
+    def __init__(self, datastore, server_state):
+        self.datastore = datastore
+        self.server_state = server_state
+        self.parser = RespParser()
+        self.transport = None
+        self.peername = None
+        self.in_transaction = False
+        self.transaction_queue = []
+        self.is_replica = False
+        self.pending = deque()
+        self.replies = []
+        self.blocked_task = None
+        self.aof_offset = 0
+        self.deferred_writes = 0
+        self.replica_output = []
+        self.replica_output_size = 0
+        self.replica_flush_scheduled = False
+        self.replica_held = False
+        self.writing_paused = False
+        self.drain_waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peername = transport.get_extra_info("peername")
+        self.parser.client = f"{self.peername[0]}:{self.peername[1]}"
+        print(f"Connect from {self.peername}")
+        self.server_state["stats"].client_connected()
+
+    def connection_lost(self, exc):
+        print(f"Closing connection from {self.peername}")
+        self.server_state["stats"].client_disconnected()
+        if self.is_replica:
+            replication.remove_replica(self.server_state, self)
+        if self.blocked_task is not None:
+            self.blocked_task.cancel()
+        self.transport = None
+
+    def sendall(self, data):
+        if self.transport is None or self.transport.is_closing():
+            return
+        if not self.is_replica:
+            self.transport.write(data)
+            return
+        # Replication stream: coalesce everything propagated in this loop iteration into one write.
+        self.replica_output_size += len(data)
+        limit = self.server_state["replica_output_buffer_limit"]
+        if self.transport.get_write_buffer_size() + self.replica_output_size > limit:
+            print(f"Replica output buffer over {limit} bytes, disconnecting the replica")
+            self.transport.abort()
+            return
+        self.replica_output.append(data)
+        if not self.replica_flush_scheduled and not self.replica_held:
+            self.replica_flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush_replica_output)
+
+    def flush_replica_output(self):
+        self.replica_flush_scheduled = False
+        if self.transport is not None and self.replica_output:
+            self.transport.write(b"".join(self.replica_output))
+        self.replica_output = []
+        self.replica_output_size = 0
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        waiter, self.drain_waiter = self.drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def drain(self):
+        """Waits until the transport's write buffer is back under its high-water mark."""
+        if self.writing_paused:
+            self.drain_waiter = asyncio.get_running_loop().create_future()
+            await self.drain_waiter
+
+    def data_received(self, data):
+        self.server_state["stats"].add_input_bytes(len(data))
+        self.parser.feed(data)
+        if self.blocked_task is None:
+            self.process_commands()
+
+    def flush(self):
+        """
+        Writes out the queued replies. Under appendfsync always, replies that
+        follow a write are held until the AOF flusher reports it on disk (and
+        so is every later batch, to keep them in order); the event loop keeps
+        serving meanwhile, so writes from many clients share one fsync.
+        """
+        if not self.replies:
+            return
+        buffers = protocol.gather_buffers(self.replies)
+        self.replies = []
+        aof = self.server_state["aof"]
+        if self.deferred_writes or (aof is not None and aof.needs_sync(self.aof_offset)):
+            self.deferred_writes += 1
+            loop = asyncio.get_running_loop()
+            aof.when_synced(self.aof_offset, lambda: loop.call_soon_threadsafe(self.write_deferred, buffers))
+        else:
+            self.transport.writelines(buffers)
+
+    def write_deferred(self, buffers):
+        self.deferred_writes -= 1
+        if self.transport is not None:
+            self.transport.writelines(buffers)
+
+    def propagate(self, command_bytes):
+        replication.propagate_write(self.server_state, command_bytes)
+        if self.server_state["aof"] is not None:
+            self.aof_offset = self.server_state["aof"].appended_offset
+
+    def process_commands(self):
+        try:
+            self.pending.extend(self.parser.parse_commands())
+        except ProtocolError as e:
+            self.replies.append(protocol.format_error(f"Protocol error: {e}"))
+            self.flush()
+            self.transport.close()
+            return
+
+        try:
+            while self.pending:
+                blocking_call = self.execute(self.pending.popleft())
+                if blocking_call is not None:
+                    self.transport.pause_reading()
+                    self.blocked_task = asyncio.ensure_future(self.resume_after(blocking_call))
+                    break
+        except (IndexError, ValueError, OSError):
+            self.transport.close()
+            return
+        self.flush()
+
+    async def resume_after(self, blocking_call):
+        """Awaits a parked command, queues its reply (or an error reply if it failed) and resumes reading either way."""
+        try:
+            reply = await blocking_call
+        except Exception as e:
+            print(f"Error serving {self.peername}: {e!r}")
+            if self.is_replica and self.transport is not None:
+                # Mid full sync there is no way to report it in band.
+                self.transport.close()
+            reply = protocol.format_error(str(e) or type(e).__name__)
+        finally:
+            if self.transport is not None:
+                self.blocked_task = None
+                self.transport.resume_reading()
+        if self.transport is None or self.transport.is_closing(): return
+        if reply:
+            self.replies.append(reply)
+        self.process_commands()
+
+    def execute(self, cmd):
+        datastore, server_state = self.datastore, self.server_state
+        command_name = cmd.name
+
+        if self.in_transaction and command_name not in ["EXEC", "DISCARD", "MULTI"]:
+            self.transaction_queue.append(cmd)
+            self.replies.append(protocol.format_simple_string("QUEUED"))
+            return None
+
+        # Commands dispatched through handle_command record their own stats; the ones handled here are timed from `started`.
+        server_stats = server_state["stats"]
+        started = time.perf_counter_ns()
+        if command_name == "MULTI":
+            self.in_transaction = True
+            self.transaction_queue = []
+            self.replies.append(protocol.format_simple_string("OK"))
+            server_stats.record(cmd, started)
+        elif command_name == "EXEC":
+            if not self.in_transaction:
+                self.replies.append(protocol.format_error("EXEC without MULTI"))
+            else:
+                responses = []
+                for queued_cmd in self.transaction_queue:
+                    responses.append(handle_command(queued_cmd, datastore, server_state))
+                    if queued_cmd.name in WRITE_COMMANDS and server_state["role"] == "master":
+                        self.propagate(queued_cmd.raw)
+                self.replies.append(protocol.format_array_reply(responses))
+                self.in_transaction = False
+                self.transaction_queue = []
+                server_stats.latency_monitor.measure("exec", started)
+                server_stats.record(cmd, started)
+        elif command_name == "DISCARD":
+            if not self.in_transaction:
+                self.replies.append(protocol.format_error("DISCARD without MULTI"))
+            else:
+                self.in_transaction = False
+                self.transaction_queue = []
+                self.replies.append(protocol.format_simple_string("OK"))
+                server_stats.record(cmd, started)
+        elif command_name == "REPLCONF":
+            if len(cmd.argv) > 2 and cmd.argv[1].upper() == b"ACK":
+                if cmd.argv[2].isdigit():
+                    replication.record_replica_ack(server_state, self, int(cmd.argv[2]))
+                server_stats.record(cmd, started)
+            else:
+                self.replies.append(handle_command(cmd, datastore, server_state))
+        elif command_name == "WAIT":
+            try:
+                num_replicas_to_wait_for = int(cmd.argv[1])
+                timeout_ms = int(cmd.argv[2])
+            except (IndexError, ValueError) as e:
+                self.replies.append(argument_error(cmd, e))
+                return None
+            wait_offset = server_state["write_offset"]
+
+            acked_replicas = replication.count_acked_replicas(server_state, wait_offset)
+            server_stats.record(cmd, started)
+            if acked_replicas >= num_replicas_to_wait_for:
+                self.replies.append(protocol.format_integer(acked_replicas))
+                return None
+            self.flush()
+            return self.wait_for_replicas(num_replicas_to_wait_for, timeout_ms, wait_offset)
+        elif command_name == "PSYNC":
+            if len(cmd.argv) != 3:
+                self.replies.append(protocol.format_error("wrong number of arguments for 'psync' command"))
+                return None
+            self.flush()
+            if server_state["role"] == "master":
+                # Registered (and its stream held back) before the reply, so nothing written meanwhile is lost.
+                self.is_replica = True
+                self.replica_held = True
+            response_bytes, snapshot = replication.sync_replica(cmd, datastore, server_state, self if self.is_replica else None)
+            server_stats.record(cmd, started)
+            self.replies.append(response_bytes)
+            self.flush()
+            if snapshot is not None:
+                encoded = asyncio.get_running_loop().run_in_executor(None, rdb.encode_snapshot, snapshot)
+                return self.send_snapshot(encoded)
+            self.release_replica_output()
+        elif command_name in BLOCKING_COMMANDS:
+            request = prepare_blocking_command(cmd, datastore)
+            server_stats.record(cmd, started)
+            if not isinstance(request, BlockingRequest):
+                self.replies.append(request)
+                if command_name in WRITE_COMMANDS and server_state["role"] == "master":
+                    self.propagate(cmd.raw)
+                return None
+            self.flush()
+            return self.block_on_keys(cmd, request)
+        else:
+            response = handle_command(cmd, datastore, server_state)
+            if response is None: return None
+            self.replies.append(response)
+            if command_name in WRITE_COMMANDS and server_state["role"] == "master":
+                self.propagate(cmd.raw)
+        return None
+
+    async def send_snapshot(self, encoded):
+        """
+        Sends the full-sync RDB once the worker thread has encoded it, a chunk
+        at a time, waiting out the transport's high-water mark so the spooled
+        file is never copied whole into memory. The replica's stream queued
+        meanwhile follows it.
+        """
+        spool, size = await encoded
+        for chunk in rdb.transfer_chunks(spool, size):
+            if self.transport is None or self.transport.is_closing():
+                break
+            self.transport.write(chunk)
+            await self.drain()
+        self.release_replica_output()
+        return b""
+
+    def release_replica_output(self):
+        if self.replica_held:
+            self.replica_held = False
+            self.flush_replica_output()
+
+    async def wait_for_replicas(self, num_replicas_to_wait_for, timeout_ms, wait_offset):
+        server_state = self.server_state
+        future = asyncio.get_running_loop().create_future()
+        waiter = (wait_offset, num_replicas_to_wait_for, future)
+        with server_state["ack_condition"]:
+            server_state["ack_waiters"].append(waiter)
+        replication.request_acks(server_state, wait_offset)
+        try:
+            acked_replicas = await asyncio.wait_for(future, timeout_ms / 1000.0 if timeout_ms > 0 else None)
+        except asyncio.TimeoutError:
+            acked_replicas = replication.count_acked_replicas(server_state, wait_offset)
+        finally:
+            with server_state["ack_condition"]:
+                if waiter in server_state["ack_waiters"]:
+                    server_state["ack_waiters"].remove(waiter)
+        return protocol.format_integer(acked_replicas)
+
+    async def block_on_keys(self, cmd, request):
+        datastore, server_state = self.datastore, self.server_state
+        loop = asyncio.get_running_loop()
+        deadline = None if request.timeout_ms == 0 else loop.time() + request.timeout_ms / 1000.0
+        future = loop.create_future()
+        woken_at = None
+
+        def wake():
+            nonlocal woken_at
+            woken_at = time.perf_counter_ns()
+            if not future.done():
+                future.set_result(None)
+
+        waiter = datastore.add_waiter(request.keys, request.is_ready, wake)
+        try:
+            while True:
+                # This task starts a loop iteration after prepare_blocking_command, and a write
+                # served in between found no waiter to wake, so retry before every wait.
+                try:
+                    reply = request.attempt(request.keys)
+                except WrongTypeError:
+                    return protocol.format_error(WRONGTYPE_ERROR)
+                if reply is not None:
+                    if cmd.name in WRITE_COMMANDS and server_state["role"] == "master":
+                        self.propagate(cmd.raw)
+                    if woken_at is not None:
+                        server_state["stats"].latency_monitor.measure("blocked-wakeup", woken_at)
+                    return reply
+
+                try:
+                    timeout_s = None if deadline is None else max(0.0, deadline - loop.time())
+                    await asyncio.wait_for(future, timeout_s)
+                except asyncio.TimeoutError:
+                    return request.timeout_reply
+                future = loop.create_future()
+                waiter.signalled = False
+        finally:
+            datastore.remove_waiter(waiter)
+
+async def replicate_from_master(server_state, replica_port, datastore):
+    master_host, master_port = server_state["master_host"], server_state["master_port"]
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(master_host, master_port)
+            print(f"Connected to master at {master_host}:{master_port}")
+            try:
+                await sync_with_master(reader, writer, server_state, replica_port, datastore)
+            finally:
+                writer.close()
+        except Exception as e:
+            print(f"Error in master connection: {e}")
+        server_state["master_link_status"] = "down"
+        await asyncio.sleep(replication.REPLICA_RECONNECT_DELAY_S)
+
+async def sync_with_master(reader, writer, server_state, replica_port, datastore):
+    *handshake, psync_command = replication.handshake_commands(
+        replica_port, server_state["master_replid"], server_state["master_repl_offset"])
+    for handshake_command in handshake:
+        writer.write(handshake_command)
+        await reader.readline()
+    writer.write(psync_command)
+
+    stream = replication.ReplicationStream(datastore, server_state)
+    loop = asyncio.get_running_loop()
+    next_ack_time = loop.time() + replication.REPLICA_ACK_INTERVAL_S
+    while True:
+        # No ACKs before the RDB is in, so no deadline either: a zero timeout would cancel every read before it ran.
+        timeout_s = max(0.0, next_ack_time - loop.time()) if stream.rdb_received else None
+        try:
+            data = await asyncio.wait_for(reader.read(replication.REPLICA_READ_BUFFER_SIZE), timeout_s)
+            if not data: break
+            ack_bytes = stream.feed(data)
+            if ack_bytes:
+                writer.write(ack_bytes)
+        except asyncio.TimeoutError:
+            pass
+        if stream.rdb_received and loop.time() >= next_ack_time:
+            writer.write(stream.ack_command())
+            next_ack_time = loop.time() + replication.REPLICA_ACK_INTERVAL_S
+
+async def active_expiry(datastore, latency_monitor):
+    while True:
+        started = time.perf_counter_ns()
+        datastore.active_expire_cycle()
+        latency_monitor.measure("expire-cycle", started)
+        await asyncio.sleep(1.0 / ACTIVE_EXPIRE_HZ)
+
+async def sample_ops(server_stats):
+    while True:
+        await asyncio.sleep(stats.OPS_SAMPLE_INTERVAL_S)
+        server_stats.sample_ops()
+
+async def auto_rewrite_aof(datastore, server_state):
+    append_only_file = server_state["aof"]
+    while True:
+        if append_only_file.rewrite_needed():
+            append_only_file.rewrite_in_background(datastore, server_state)
+        await asyncio.sleep(aof.AOF_REWRITE_CRON_INTERVAL_S)
+
+async def run_server(args, datastore, server_state):
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(
+        lambda: RedisServerProtocol(datastore, server_state),
+        "localhost", args.port, reuse_address=True, backlog=511
+    )
+    print(f"Server listen on localhost {args.port}")
+
+    # The loop only holds tasks weakly, so keep them here until shutdown.
+    background_tasks = [asyncio.ensure_future(sample_ops(server_state["stats"]))]
+    if server_state["role"] == "master":
+        background_tasks.append(asyncio.ensure_future(active_expiry(datastore, server_state["stats"].latency_monitor)))
+    if server_state["aof"] is not None:
+        background_tasks.append(asyncio.ensure_future(auto_rewrite_aof(datastore, server_state)))
+    if server_state["role"] == "slave":
+        background_tasks.append(asyncio.ensure_future(replicate_from_master(server_state, args.port, datastore)))
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+
+def serve_asyncio(args, datastore, server_state):
+    asyncio.run(run_server(args, datastore, server_state))
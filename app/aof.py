@@ -0,0 +1,357 @@
+import os
+import threading
+import time
+from collections import deque
+from . import rdb
+from .command_handler import handle_command
+from .datastore import now_ms, string_bytes
+from .hashes import HashListpack, hash_flat
+from .intsets import IntSet, set_members
+from .resp import RespParser
+from .streams import Stream, format_id
+from .zsets import ZsetListpack, SortedSet, format_score
+
+APPENDFSYNC_POLICIES = ("always", "everysec", "no")
+AOF_FSYNC_INTERVAL_S = 1.0
+AOF_WRITE_ERROR_RETRY_S = 1.0
+AOF_LOAD_CHUNK_SIZE = 1024 * 1024
+AOF_WRITE_CHUNK_SIZE = 64 * 1024
+AOF_REWRITE_ITEMS_PER_CMD = 64
+AOF_REWRITE_CATCHUP_BYTES = 64 * 1024
+AOF_REWRITE_CRON_INTERVAL_S = 0.1
+DEFAULT_AUTO_AOF_REWRITE_PERCENTAGE = 100
+DEFAULT_AUTO_AOF_REWRITE_MIN_SIZE = 64 * 1024 * 1024
+
+fdatasync = getattr(os, "fdatasync", os.fsync)
+
+class AppendOnlyFile:
+    """
+    The append-only write log. Writers only add the command bytes to an
+    in-memory buffer; one flusher thread writes out whatever has piled up
+    and, under `appendfsync always`, fsyncs it before waking the clients
+    waiting on those bytes. Everything appended while an fsync is in
+    progress goes out together in the next one, so concurrent writers share
+    fsyncs (group commit). `everysec` fsyncs at most once a second and `no`
+    leaves it to the OS.
+
+    Offsets count bytes appended since startup, not file positions, so they
+    stay valid when a rewrite swaps in a new file. `io_lock` is held around
+    every write to the file and around the swap; `generation` changes with
+    each swap so the flusher drops data the rewrite already carried over.
+    """
+    def __init__(self, path, appendfsync="everysec",
+                 auto_rewrite_percentage=DEFAULT_AUTO_AOF_REWRITE_PERCENTAGE,
+                 auto_rewrite_min_size=DEFAULT_AUTO_AOF_REWRITE_MIN_SIZE):
+        if appendfsync not in APPENDFSYNC_POLICIES:
+            raise ValueError(f"appendfsync must be one of {', '.join(APPENDFSYNC_POLICIES)}")
+        self.path = path
+        self.appendfsync = appendfsync
+        self.auto_rewrite_percentage = auto_rewrite_percentage
+        self.auto_rewrite_min_size = auto_rewrite_min_size
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.file_size = os.fstat(self.fd).st_size
+        self.base_size = self.file_size
+        self.generation = 0
+        self.io_lock = threading.Lock()
+        self.condition = threading.Condition(threading.Lock())
+        self.buffer = bytearray()
+        self.appended_offset = 0
+        self.written_offset = 0
+        self.synced_offset = 0
+        self.sync_callbacks = []
+        self.last_fsync = time.monotonic()
+        self.rewrite_lock = threading.Lock()
+        self.rewrite_buffer = None
+        threading.Thread(target=self.run_flusher, daemon=True).start()
+
+    def append(self, data):
+        """Queues `data` for the log (and for the rewrite in progress, if any); returns the offset it ends at."""
+        with self.condition:
+            self.buffer += data
+            if self.rewrite_buffer is not None:
+                self.rewrite_buffer += data
+            self.appended_offset += len(data)
+            self.condition.notify_all()
+            return self.appended_offset
+
+    def needs_sync(self, offset):
+        return self.appendfsync == "always" and self.synced_offset < offset
+
+    def wait_synced(self, offset=None):
+        """Blocks until `offset` (default: everything appended so far) is on disk, if the policy asks for it."""
+        if self.appendfsync != "always":
+            return
+        with self.condition:
+            if offset is None:
+                offset = self.appended_offset
+            while self.synced_offset < offset:
+                self.condition.wait()
+
+    def when_synced(self, offset, callback):
+        """
+        Calls `callback()` once `offset` is on disk: right away if it already
+        is, else from the flusher thread under `condition`, in the same step
+        that advances synced_offset, so callbacks always run in offset order.
+        Callbacks must be quick and must not block.
+        """
+        with self.condition:
+            if self.needs_sync(offset):
+                self.sync_callbacks.append((offset, callback))
+                return
+        callback()
+
+    def run_flusher(self):
+        while True:
+            with self.condition:
+                while not self.buffer:
+                    if self.appendfsync == "everysec" and self.synced_offset < self.written_offset:
+                        remaining = self.last_fsync + AOF_FSYNC_INTERVAL_S - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                    else:
+                        self.condition.wait()
+                data, self.buffer = self.buffer, bytearray()
+                generation = self.generation
+
+            with self.io_lock:
+                if generation != self.generation:
+                    continue
+                view = memoryview(data)
+                synced = False
+                try:
+                    while view:
+                        view = view[os.write(self.fd, view):]
+                    if self.appendfsync == "always" or (
+                            self.appendfsync == "everysec" and time.monotonic() - self.last_fsync >= AOF_FSYNC_INTERVAL_S):
+                        fdatasync(self.fd)
+                        self.last_fsync = time.monotonic()
+                        synced = True
+                except OSError as e:
+                    if self.appendfsync == "always":
+                        # Replies are held until their write is durable; with the log failing they never would be.
+                        print(f"Can't recover from AOF write error when the AOF fsync policy is 'always': {e}. Exiting...")
+                        os._exit(1)
+                    print(f"Error writing to the AOF file: {e}")
+                written = len(data) - len(view)
+                self.file_size += written
+
+            with self.condition:
+                if generation != self.generation:
+                    continue
+                self.written_offset += written
+                if written < len(data):
+                    self.buffer[:0] = data[written:]
+                if synced:
+                    self.synced_offset = self.written_offset
+                self.run_sync_callbacks()
+            if written < len(data):
+                time.sleep(AOF_WRITE_ERROR_RETRY_S)
+
+    def run_sync_callbacks(self):
+        """Wakes waiters and runs the callbacks whose offset is now on disk, oldest first; caller holds `condition`."""
+        self.condition.notify_all()
+        ready = [callback for offset, callback in self.sync_callbacks if offset <= self.synced_offset]
+        if ready:
+            self.sync_callbacks = [(offset, callback) for offset, callback in self.sync_callbacks
+                                   if offset > self.synced_offset]
+        for callback in ready:
+            callback()
+
+    def rewrite_needed(self):
+        if self.auto_rewrite_percentage <= 0 or self.rewrite_lock.locked():
+            return False
+        base_size = max(self.base_size, 1)
+        return (self.file_size >= self.auto_rewrite_min_size and
+                (self.file_size - base_size) * 100 >= base_size * self.auto_rewrite_percentage)
+
+    def rewrite_in_background(self, datastore, server_state):
+        """
+        Compacts the log: writes the current dataset as the shortest command
+        list to a temp file on a background thread, then appends the writes
+        made meanwhile and swaps it in. Only the start of the snapshot (see
+        rdb.Snapshot) runs here, under the exclusive write gate, together
+        with the start of the buffer for the writes made meanwhile, so every
+        write lands in exactly one of the two; the dataset itself is read and
+        copied on the rewrite thread. Returns False if a rewrite is already
+        running.
+        """
+        if not self.rewrite_lock.acquire(blocking=False):
+            return False
+        try:
+            with datastore.write_gate.exclusive():
+                snapshot = rdb.begin_snapshot(datastore, server_state)
+                with self.condition:
+                    self.rewrite_buffer = bytearray()
+        except BaseException:
+            self.rewrite_lock.release()
+            raise
+        threading.Thread(target=self.run_rewrite, args=(snapshot,), daemon=True).start()
+        return True
+
+    def run_rewrite(self, snapshot):
+        temp_path = f"{self.path}.temp-rewrite-{os.getpid()}"
+        started = time.monotonic()
+        try:
+            with open(temp_path, "wb") as f:
+                write_dataset(snapshot, f)
+                # Catch up with the writes made meanwhile outside the locks until only a little is left.
+                while True:
+                    with self.condition:
+                        pending, self.rewrite_buffer = self.rewrite_buffer, bytearray()
+                    f.write(pending)
+                    if len(pending) < AOF_REWRITE_CATCHUP_BYTES:
+                        break
+                f.flush()
+                os.fsync(f.fileno())
+            self.swap_in(temp_path)
+            print(f"Background AOF rewrite finished in {time.monotonic() - started:.3f} seconds, {self.base_size} bytes")
+        except Exception as e:
+            print(f"Background AOF rewrite failed: {e}")
+            with self.condition:
+                self.rewrite_buffer = None
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        finally:
+            snapshot.release()
+            self.rewrite_lock.release()
+
+    def swap_in(self, temp_path):
+        new_fd = os.open(temp_path, os.O_WRONLY | os.O_APPEND)
+        try:
+            with self.io_lock, self.condition:
+                pending = memoryview(self.rewrite_buffer)
+                while pending:
+                    pending = pending[os.write(new_fd, pending):]
+                fdatasync(new_fd)
+                os.replace(temp_path, self.path)
+                old_fd, self.fd = self.fd, new_fd
+                self.generation += 1
+                self.rewrite_buffer = None
+                # Everything appended so far is in the new file, including what the flusher had not written yet.
+                self.buffer = bytearray()
+                self.written_offset = self.synced_offset = self.appended_offset
+                self.file_size = self.base_size = os.fstat(new_fd).st_size
+                self.run_sync_callbacks()
+        except BaseException:
+            os.close(new_fd)
+            raise
+        os.close(old_fd)
+
+def load_aof(path, datastore, server_state):
+    """
+    Replays the AOF at `path` through the command handlers; returns the
+    number of commands applied. A command cut off at the end of the file
+    (a crash mid-write) is dropped and the file truncated back to the last
+    complete one, so new writes don't land after garbage.
+    """
+    parser = RespParser()
+    applied = 0
+    read = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(AOF_LOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            read += len(chunk)
+            parser.feed(chunk)
+            for cmd in parser.parse_commands():
+                handle_command(cmd, datastore, server_state)
+                applied += 1
+    if parser.pending():
+        valid_size = read - parser.pending()
+        print(f"AOF {path} ends with a truncated command; truncating it to {valid_size} bytes")
+        os.truncate(path, valid_size)
+    return applied
+
+def format_command(*args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+def string_commands(key, value):
+    yield format_command(b"SET", key, string_bytes(value))
+
+def list_commands(key, the_list):
+    items = list(the_list)
+    for i in range(0, len(items), AOF_REWRITE_ITEMS_PER_CMD):
+        yield format_command(b"RPUSH", key, *items[i:i + AOF_REWRITE_ITEMS_PER_CMD])
+
+def hash_commands(key, h):
+    items = hash_flat(h)
+    step = 2 * AOF_REWRITE_ITEMS_PER_CMD
+    for i in range(0, len(items), step):
+        yield format_command(b"HSET", key, *items[i:i + step])
+
+def set_commands(key, s):
+    members = set_members(s)
+    for i in range(0, len(members), AOF_REWRITE_ITEMS_PER_CMD):
+        yield format_command(b"SADD", key, *members[i:i + AOF_REWRITE_ITEMS_PER_CMD])
+
+def zset_commands(key, zset):
+    entries = zset.entries(0, zset.card())
+    for i in range(0, len(entries), AOF_REWRITE_ITEMS_PER_CMD):
+        args = [item for score, member in entries[i:i + AOF_REWRITE_ITEMS_PER_CMD] for item in (format_score(score), member)]
+        yield format_command(b"ZADD", key, *args)
+
+def stream_commands(key, stream):
+    if not len(stream):
+        # An emptied stream still remembers its last ID: add it back and trim it away.
+        yield format_command(b"XADD", key, b"MAXLEN", b"0", format_id(stream.last_id), b"", b"")
+        return
+    for entry_id, fields in stream.iter_entries():
+        yield format_command(b"XADD", key, format_id(entry_id), *fields)
+
+DATASET_COMMANDS = {
+    bytes: string_commands,
+    int: string_commands,
+    deque: list_commands,
+    Stream: stream_commands,
+    HashListpack: hash_commands,
+    dict: hash_commands,
+    ZsetListpack: zset_commands,
+    SortedSet: zset_commands,
+    IntSet: set_commands,
+    set: set_commands,
+}
+
+def write_dataset(snapshot, out):
+    """Writes the shortest command log that rebuilds `snapshot` (an rdb.Snapshot) into the binary file `out`."""
+    buf = bytearray()
+    now = now_ms()
+    for key, value, expiry_ms in snapshot.items():
+        if expiry_ms is not None and expiry_ms <= now:
+            continue
+        for command in DATASET_COMMANDS[type(value)](key, value):
+            buf += command
+        if expiry_ms is not None:
+            buf += format_command(b"PEXPIREAT", key, b"%d" % expiry_ms)
+        if len(buf) >= AOF_WRITE_CHUNK_SIZE:
+            out.write(buf)
+            buf.clear()
+    out.write(buf)
+
+def save_dataset(snapshot, path):
+    """Writes the dataset log next to `path` and renames it into place once it is fully on disk."""
+    temp_path = f"{path}.temp-{os.getpid()}-{time.monotonic_ns()}"
+    try:
+        with open(temp_path, "wb") as f:
+            write_dataset(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        snapshot.release()
+
+def run_auto_rewrite(datastore, server_state):
+    """Starts a background rewrite whenever the AOF has grown enough since the last one (threaded server)."""
+    while True:
+        append_only_file = server_state["aof"]
+        if append_only_file.rewrite_needed():
+            append_only_file.rewrite_in_background(datastore, server_state)
+        time.sleep(AOF_REWRITE_CRON_INTERVAL_S)
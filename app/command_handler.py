@@ -1,305 +1,1605 @@
+import fnmatch
+import math
+import threading
 import time
+from collections import deque
+from decimal import Decimal
+from itertools import islice
 from . import protocol
+from . import rdb
+from .datastore import now_ms, type_name, encode_string, shared_integer, INT64_MIN, INT64_MAX
+from .hashes import HashListpack, hash_len, hash_get, hash_set, hash_delete, hash_items, hash_flat, convert_if_needed
+from .intsets import IntSet, member_bytes, set_contains, set_members, to_hash_set, new_set
+from .zsets import ZsetListpack, SortedSet, zset_convert_if_needed, score_rank, lex_rank, format_score
+from .streams import Stream, MAX_ID, SEQ_MASK, pack_id, unpack_id, parse_id, format_id
 
-def handle_ping(parts, datastore, server_state):
+WRONGTYPE_ERROR = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+class WrongTypeError(Exception):
+    pass
+
+def lookup_typed(datastore, key, expected_type):
+    value = datastore.get_item(key)
+    if value is None:
+        return None
+    if type_name(value) != expected_type:
+        raise WrongTypeError()
+    return value
+
+class BlockingRequest:
+    """
+    A blocking command that found nothing to serve yet. `attempt(keys)` retries
+    it against some of its keys and returns the reply (or None), `is_ready(key)`
+    cheaply checks one key while its shard lock is held (it decides which
+    waiters a write wakes), and `timeout_reply` is sent if `timeout_ms`
+    (0 = forever) runs out first.
+    """
+    __slots__ = ("keys", "timeout_ms", "attempt", "is_ready", "timeout_reply")
+
+    def __init__(self, keys, timeout_ms, attempt, is_ready, timeout_reply):
+        self.keys = keys
+        self.timeout_ms = timeout_ms
+        self.attempt = attempt
+        self.is_ready = is_ready
+        self.timeout_reply = timeout_reply
+
+def wait_for_keys(request, datastore, latency_monitor, on_reply=None):
+    """Blocks until `request` is served or times out; the monitor sees how long the served wake-up took after the write that woke it."""
+    deadline = None if request.timeout_ms == 0 else time.monotonic() + request.timeout_ms / 1000.0
+    woken = threading.Event()
+    woken_at = None
+
+    def wake():
+        nonlocal woken_at
+        woken_at = time.perf_counter_ns()
+        woken.set()
+
+    waiter = datastore.add_waiter(request.keys, request.is_ready, wake)
+    try:
+        while True:
+            # Registered before retrying, so a write landing in between still wakes us.
+            woken.clear()
+            waiter.signalled = False
+            with datastore.write_gate:
+                reply = request.attempt(request.keys)
+                if reply is not None:
+                    if on_reply is not None:
+                        on_reply()
+                    if woken_at is not None:
+                        latency_monitor.measure("blocked-wakeup", woken_at)
+                    return reply
+            timeout_s = None if deadline is None else deadline - time.monotonic()
+            if timeout_s is not None and timeout_s <= 0:
+                return request.timeout_reply
+            woken.wait(timeout_s)
+    finally:
+        datastore.remove_waiter(waiter)
+
+def handle_ping(cmd, datastore, server_state):
     return protocol.format_simple_string("PONG")
 
-def handle_echo(parts, datastore, server_state):
-    return protocol.format_bulk_string(parts[4])
+def handle_echo(cmd, datastore, server_state):
+    return protocol.format_bulk_string(cmd.argv[1])
 
-def handle_set(parts, datastore, server_state):
-    key, value = parts[4], parts[6]
+EXPIRE_UNITS = {
+    b'EX': (1000, False), b'PX': (1, False), b'EXAT': (1000, True), b'PXAT': (1, True),
+    "EXPIRE": (1000, False), "PEXPIRE": (1, False), "EXPIREAT": (1000, True), "PEXPIREAT": (1, True),
+}
+
+def resolve_expiry_ms(unit, amount):
+    multiplier, is_absolute = EXPIRE_UNITS[unit]
+    if is_absolute:
+        return amount * multiplier
+    return now_ms() + amount * multiplier
+
+def handle_set(cmd, datastore, server_state):
+    key, value = cmd.argv[1], cmd.argv[2]
     expiry_ms = None
-    if len(parts) > 8 and parts[8].decode().upper() == 'PX':
-        expiry_duration_ms = int(parts[10].decode())
-        expiry_ms = int(time.time() * 1000) + expiry_duration_ms
-    with datastore.lock:
-        datastore.set_item(key, ('string', (value, expiry_ms)))
+    is_relative = False
+    condition = None
+    keep_ttl = False
+    i = 3
+    while i < len(cmd.argv):
+        option = cmd.argv[i].upper()
+        if option in (b'NX', b'XX') and condition is None:
+            condition = option
+        elif option == b'KEEPTTL' and expiry_ms is None:
+            keep_ttl = True
+        elif option in EXPIRE_UNITS and expiry_ms is None and not keep_ttl and i + 1 < len(cmd.argv):
+            try:
+                amount = int(cmd.argv[i + 1])
+            except ValueError:
+                return protocol.format_error("value is not an integer or out of range")
+            if amount <= 0:
+                return protocol.format_error("invalid expire time in 'set' command")
+            expiry_ms = resolve_expiry_ms(option, amount)
+            is_relative = not EXPIRE_UNITS[option][1]
+            i += 1
+        else:
+            return protocol.format_error("syntax error")
+        i += 1
+
+    with datastore.key_lock(key):
+        if condition is not None:
+            exists = datastore.get_item(key) is not None
+            if (condition == b'NX') == exists:
+                return protocol.format_bulk_string(None)
+        datastore.set_item(key, encode_string(value))
+        if not keep_ttl:
+            datastore.set_expiry(key, expiry_ms)
+    if is_relative:
+        # Replicas and the AOF get the absolute deadline, so replaying later doesn't extend the TTL.
+        cmd.rewrite([b"SET", key, value] + ([condition] if condition else []) + [b"PXAT", b"%d" % expiry_ms])
     return protocol.format_simple_string("OK")
 
-def handle_get(parts, datastore, server_state):
-    key = parts[4]
-    with datastore.lock:
-        item = datastore.get_item(key)
-    if not item or item[0] != 'string': return protocol.format_bulk_string(None)
-    value, _ = item[1]
-    return protocol.format_bulk_string(value)
-
-def handle_incr(parts, datastore, server_state):
-    key = parts[4]
-    with datastore.lock:
-        item = datastore.get_item(key)
-        if item is None:
-            new_value = 1
-            datastore.set_item(key, ('string', (b'1', None)))
-            return protocol.format_integer(new_value)
-        if item[0] != 'string':
-            return protocol.format_error("WRONGTYPE Operation against a key holding the wrong kind of value")
+def handle_get(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        value = datastore.get_item(key)
+    if type(value) is int:
+        return protocol.format_bulk_string(b"%d" % value)
+    if type(value) is not bytes: return protocol.format_bulk_string(None)
+    return protocol.format_bulk_reply(value)
+
+def handle_mget(cmd, datastore, server_state):
+    """All keys are read under one acquisition of their shard locks, so the reply is one consistent view."""
+    keys = cmd.argv[1:]
+    with datastore.locks_for(keys):
+        values = [datastore.get_item(key) for key in keys]
+    return protocol.format_array_reply([
+        protocol.format_bulk_string(b"%d" % value) if type(value) is int
+        else protocol.format_bulk_reply(value if type(value) is bytes else None)
+        for value in values])
+
+def handle_mset(cmd, datastore, server_state):
+    """MSET and MSETNX: every key is written under one acquisition of their shard locks, so none is seen half-set."""
+    pairs = cmd.argv[1:]
+    if not pairs or len(pairs) % 2:
+        return protocol.format_error(f"wrong number of arguments for '{cmd.name.lower()}' command")
+    keys = pairs[0::2]
+    with datastore.locks_for(keys):
+        if cmd.name == "MSETNX" and any(datastore.get_item(key) is not None for key in keys):
+            cmd.rewrite(None)
+            return protocol.format_integer(0)
+        for key, value in zip(keys, pairs[1::2]):
+            datastore.set_item(key, encode_string(value))
+            datastore.set_expiry(key, None)
+    return protocol.format_integer(1) if cmd.name == "MSETNX" else protocol.format_simple_string("OK")
+
+NOT_AN_INTEGER_ERROR = "value is not an integer or out of range"
+NOT_A_FLOAT_ERROR = "value is not a valid float"
+
+def argument_error(cmd, error):
+    """The error reply for an IndexError (an argument missing) or ValueError (a bad number) raised while running `cmd`."""
+    if isinstance(error, IndexError):
+        return protocol.format_error(f"wrong number of arguments for '{cmd.name.lower()}' command")
+    return protocol.format_error(NOT_AN_INTEGER_ERROR)
+
+def parse_int64(arg):
+    value = encode_string(arg)
+    if type(value) is not int:
+        raise ValueError(NOT_AN_INTEGER_ERROR)
+    return value
+
+def handle_incr(cmd, datastore, server_state):
+    """INCR, DECR, INCRBY and DECRBY: integer strings are stored as ints, so this is one addition, no parsing."""
+    key = cmd.argv[1]
+    try:
+        delta = parse_int64(cmd.argv[2]) if cmd.name in ("INCRBY", "DECRBY") else 1
+    except ValueError as e:
+        return protocol.format_error(str(e))
+    if cmd.name in ("DECR", "DECRBY"):
+        if delta == INT64_MIN:
+            return protocol.format_error("decrement would overflow")
+        delta = -delta
+    with datastore.key_lock(key):
+        value = datastore.get_item(key)
+        if value is None:
+            value = 0
+        elif type(value) is not int:
+            if type(value) is bytes:
+                return protocol.format_error(NOT_AN_INTEGER_ERROR)
+            raise WrongTypeError()
+        new_value = value + delta
+        if not INT64_MIN <= new_value <= INT64_MAX:
+            return protocol.format_error("increment or decrement would overflow")
+        datastore.set_item(key, shared_integer(new_value))
+    return protocol.format_integer(new_value)
+
+def parse_float(arg):
+    try:
+        value = float(arg)
+    except ValueError:
+        raise ValueError(NOT_A_FLOAT_ERROR) from None
+    if math.isnan(value) or arg != arg.strip() or b"_" in arg:
+        raise ValueError(NOT_A_FLOAT_ERROR)
+    return value
+
+def format_float(value):
+    """Shortest round-tripping decimal, never in exponent form, without a trailing '.0' (as INCRBYFLOAT replies)."""
+    text = format(Decimal(repr(value)), "f")
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    return text.encode()
+
+def handle_incrbyfloat(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    try:
+        delta = parse_float(cmd.argv[2])
+    except ValueError as e:
+        return protocol.format_error(str(e))
+    with datastore.key_lock(key):
+        value = datastore.get_item(key)
+        if value is None:
+            value = 0
+        elif type(value) is bytes:
+            try:
+                value = parse_float(value)
+            except ValueError as e:
+                return protocol.format_error(str(e))
+        elif type(value) is not int:
+            raise WrongTypeError()
+        new_value = value + delta
+        if math.isnan(new_value) or math.isinf(new_value):
+            return protocol.format_error("increment would produce NaN or Infinity")
+        result = format_float(new_value)
+        datastore.set_item(key, encode_string(result))
+    # Float addition may round differently elsewhere, so replicas and the AOF get the result.
+    cmd.rewrite([b"SET", key, result, b"KEEPTTL"])
+    return protocol.format_bulk_string(result)
+
+def handle_expire(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    try:
+        amount = int(cmd.argv[2])
+    except ValueError:
+        return protocol.format_error("value is not an integer or out of range")
+    flag = cmd.argv[3].upper() if len(cmd.argv) > 3 else None
+    if flag not in (None, b'NX', b'XX', b'GT', b'LT') or len(cmd.argv) > 4:
+        return protocol.format_error("syntax error")
+    expiry_ms = resolve_expiry_ms(cmd.name, amount)
+
+    with datastore.key_lock(key):
+        if datastore.get_item(key) is None:
+            return protocol.format_integer(0)
+        current_expiry_ms = datastore.get_expiry(key)
+        if flag == b'NX' and current_expiry_ms is not None:
+            return protocol.format_integer(0)
+        if flag == b'XX' and current_expiry_ms is None:
+            return protocol.format_integer(0)
+        if flag == b'GT' and (current_expiry_ms is None or expiry_ms <= current_expiry_ms):
+            return protocol.format_integer(0)
+        if flag == b'LT' and current_expiry_ms is not None and expiry_ms >= current_expiry_ms:
+            return protocol.format_integer(0)
+
+        if expiry_ms <= now_ms():
+            datastore.delete_item(key)
+        else:
+            datastore.set_expiry(key, expiry_ms)
+    if cmd.name != "PEXPIREAT":
+        cmd.rewrite([b"PEXPIREAT", key, b"%d" % expiry_ms] + ([flag] if flag else []))
+    return protocol.format_integer(1)
+
+def handle_ttl(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        if datastore.get_item(key) is None:
+            return protocol.format_integer(-2)
+        expiry_ms = datastore.get_expiry(key)
+    if expiry_ms is None:
+        return protocol.format_integer(-1)
+    remaining_ms = max(0, expiry_ms - now_ms())
+    if cmd.name == "PTTL":
+        return protocol.format_integer(remaining_ms)
+    return protocol.format_integer((remaining_ms + 500) // 1000)
+
+def handle_persist(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        if datastore.get_item(key) is None or datastore.get_expiry(key) is None:
+            return protocol.format_integer(0)
+        datastore.set_expiry(key, None)
+    return protocol.format_integer(1)
+
+def handle_type(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        value = datastore.get_item(key)
+    return protocol.format_simple_string("none" if value is None else type_name(value))
+
+def handle_del(cmd, datastore, server_state):
+    """DEL and UNLINK; UNLINK leaves freeing big values to the datastore's background thread."""
+    keys = cmd.argv[1:]
+    with datastore.locks_for(keys):
+        values = [value for value in map(datastore.pop_item, keys) if value is not None]
+    deleted = len(values)
+    if cmd.name == "UNLINK":
+        datastore.free_later(values)
+    if not deleted:
+        cmd.rewrite(None)
+    return protocol.format_integer(deleted)
+
+def handle_exists(cmd, datastore, server_state):
+    keys = cmd.argv[1:]
+    with datastore.locks_for(keys):
+        return protocol.format_integer(sum(datastore.get_item(key) is not None for key in keys))
+
+def normalize_range(start, end, length):
+    if start < 0: start += length
+    if end < 0: end += length
+    if start < 0: start = 0
+    if end >= length: end = length - 1
+    if start > end or start >= length:
+        return None
+    return start, end
+
+def slice_list(the_list, start, end):
+    length = len(the_list)
+    if start > length - 1 - end:
+        tail = list(islice(reversed(the_list), length - 1 - end, length - start))
+        tail.reverse()
+        return tail
+    return list(islice(the_list, start, end + 1))
+
+def pop_from_list(datastore, key, the_list, from_left):
+    value = the_list.popleft() if from_left else the_list.pop()
+    if not the_list:
+        datastore.delete_item(key)
+    return value
+
+def handle_push(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    elements = cmd.argv[2:]
+    with datastore.key_lock(key):
+        the_list = lookup_typed(datastore, key, 'list')
+        if the_list is None:
+            the_list = deque()
+            datastore.set_item(key, the_list)
+        if cmd.name == "LPUSH":
+            the_list.extendleft(elements)
+        else:
+            the_list.extend(elements)
+        length = len(the_list)
+        datastore.notify_waiters(key, count=len(elements))
+    return protocol.format_integer(length)
+
+def handle_pop(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    from_left = cmd.name == "LPOP"
+    count_provided = len(cmd.argv) > 2
+    if count_provided:
         try:
-            current_value = int(item[1][0].decode())
-            new_value = current_value + 1
-            datastore.set_item(key, ('string', (str(new_value).encode(), item[1][1])))
-            return protocol.format_integer(new_value)
+            count = int(cmd.argv[2])
         except ValueError:
-            return protocol.format_error("value is not an integer or out of range")
-
-def handle_type(parts, datastore, server_state):
-    key = parts[4]
-    with datastore.lock:
-        item = datastore.get_item(key)
-    type_name = "none"
-    if item: type_name = item[0]
-    return protocol.format_simple_string(type_name)
-
-def handle_lpush(parts, datastore, server_state):
-    key = parts[4]
-    elements = parts[6::2]
-    with datastore.lock:
-        item = datastore.get_item(key)
-        current_list = item[1] if item and item[0] == 'list' else []
-        elements.reverse()
-        current_list[:0] = elements
-        if not item or item[0] != 'list': datastore.set_item(key, ('list', current_list))
-        datastore.notify_waiters(key)
-    return protocol.format_integer(len(current_list))
-
-def handle_rpush(parts, datastore, server_state):
-    key = parts[4]
-    elements = parts[6::2]
-    with datastore.lock:
-        item = datastore.get_item(key)
-        current_list = item[1] if item and item[0] == 'list' else []
-        current_list.extend(elements)
-        if not item or item[0] != 'list': datastore.set_item(key, ('list', current_list))
-        datastore.notify_waiters(key)
-    return protocol.format_integer(len(current_list))
-
-def handle_lpop(parts, datastore, server_state):
-    key = parts[4]
-    count_provided = len(parts) > 5
-    with datastore.lock:
-        item = datastore.get_item(key)
-        if not item or item[0] != 'list' or not item[1]:
+            return protocol.format_error("value is out of range, must be positive")
+        if count < 0:
+            return protocol.format_error("value is out of range, must be positive")
+    with datastore.key_lock(key):
+        the_list = lookup_typed(datastore, key, 'list')
+        if not the_list:
             return protocol.format_array([]) if count_provided else protocol.format_bulk_string(None)
-        the_list = item[1]
         if count_provided:
-            count = int(parts[6].decode())
-            pop_count = min(count, len(the_list))
-            elements_to_return = the_list[:pop_count]
-            datastore.set_item(key, ('list', the_list[pop_count:]))
-            return protocol.format_array([protocol.format_bulk_string(el) for el in elements_to_return])
+            pop = the_list.popleft if from_left else the_list.pop
+            elements_to_return = [pop() for _ in range(min(count, len(the_list)))]
+            if not the_list:
+                datastore.delete_item(key)
+            return protocol.format_bulk_array(elements_to_return)
         else:
-            return protocol.format_bulk_string(the_list.pop(0))
+            return protocol.format_bulk_string(pop_from_list(datastore, key, the_list, from_left))
 
-def handle_llen(parts, datastore, server_state):
-    key = parts[4]
-    with datastore.lock:
-        item = datastore.get_item(key)
-        if not item or item[0] != 'list':
-            return protocol.format_integer(0)
-        return protocol.format_integer(len(item[1]))
-
-def handle_lrange(parts, datastore, server_state):
-    key = parts[4]
-    start, end = int(parts[6].decode()), int(parts[8].decode())
-    with datastore.lock:
-        item = datastore.get_item(key)
-        if not item or item[0] != 'list':
+def handle_llen(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        the_list = lookup_typed(datastore, key, 'list')
+        return protocol.format_integer(len(the_list) if the_list else 0)
+
+def handle_lrange(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    start, end = int(cmd.argv[2]), int(cmd.argv[3])
+    with datastore.key_lock(key):
+        the_list = lookup_typed(datastore, key, 'list')
+        if not the_list:
+            return protocol.format_array([])
+        bounds = normalize_range(start, end, len(the_list))
+        if bounds is None:
             return protocol.format_array([])
-        the_list = item[1]
-        sub_list = the_list[start:] if end == -1 else the_list[start:end+1]
-        return protocol.format_array([protocol.format_bulk_string(i) for i in sub_list])
-
-def handle_xadd(parts, datastore, server_state):
-    key = parts[4]
-    entry_id_str = parts[6].decode()
-    with datastore.lock:
-        entry_id_bytes_to_store = b''
-        if entry_id_str == '*':
-            ms_time = int(time.time() * 1000)
-            seq_num = 0
-            item = datastore.get_item(key)
-            if item and item[0] == 'stream' and item[1]:
-                last_ms, last_seq = map(int, item[1][-1][0].decode().split('-'))
-                if ms_time <= last_ms:
-                    ms_time = last_ms
-                    seq_num = last_seq + 1
-            entry_id_bytes_to_store = f"{ms_time}-{seq_num}".encode()
-        elif entry_id_str.endswith('-*'):
-            ms_time = int(entry_id_str.split('-')[0])
-            seq_num = 0
-            item = datastore.get_item(key)
-            if item and item[0] == 'stream' and item[1]:
-                last_ms, last_seq = map(int, item[1][-1][0].decode().split('-'))
-                if ms_time < last_ms: return protocol.format_error("The ID specified in XADD is equal or smaller than the target stream top item")
-                if ms_time == last_ms: seq_num = last_seq + 1
-            if ms_time == 0 and seq_num == 0: seq_num = 1
-            entry_id_bytes_to_store = f"{ms_time}-{seq_num}".encode()
+        sub_list = slice_list(the_list, *bounds)
+    return protocol.format_bulk_array(sub_list)
+
+def handle_lindex(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    index = int(cmd.argv[2])
+    with datastore.key_lock(key):
+        the_list = lookup_typed(datastore, key, 'list')
+        if not the_list:
+            return protocol.format_bulk_string(None)
+        if index < 0: index += len(the_list)
+        if index < 0 or index >= len(the_list):
+            return protocol.format_bulk_string(None)
+        return protocol.format_bulk_string(the_list[index])
+
+def handle_ltrim(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    start, end = int(cmd.argv[2]), int(cmd.argv[3])
+    with datastore.key_lock(key):
+        the_list = lookup_typed(datastore, key, 'list')
+        if not the_list:
+            return protocol.format_simple_string("OK")
+        length = len(the_list)
+        bounds = normalize_range(start, end, length)
+        if bounds is None:
+            datastore.delete_item(key)
+            return protocol.format_simple_string("OK")
+        start, end = bounds
+        kept = end - start + 1
+        if kept < length - kept:
+            datastore.set_item(key, deque(slice_list(the_list, start, end)))
         else:
-            ms_time, seq_num = map(int, entry_id_str.split('-'))
-            if ms_time == 0 and seq_num == 0: return protocol.format_error("The ID specified in XADD must be greater than 0-0")
-            item = datastore.get_item(key)
-            if item and item[0] == 'stream' and item[1]:
-                last_ms, last_seq = map(int, item[1][-1][0].decode().split('-'))
-                if ms_time < last_ms or (ms_time == last_ms and seq_num <= last_seq):
-                    return protocol.format_error("The ID specified in XADD is equal or smaller than the target stream top item")
-            entry_id_bytes_to_store = parts[6]
-        
-        field_value_parts = parts[8::2]
-        entry_data = {field_value_parts[i]: field_value_parts[i+1] for i in range(0, len(field_value_parts), 2)}
-        new_entry = (entry_id_bytes_to_store, entry_data)
-        item = datastore.get_item(key)
-        if item and item[0] == 'stream':
-            item[1].append(new_entry)
+            for _ in range(start):
+                the_list.popleft()
+            for _ in range(length - 1 - end):
+                the_list.pop()
+    return protocol.format_simple_string("OK")
+
+def parse_list_direction(arg):
+    direction = arg.upper()
+    if direction not in (b'LEFT', b'RIGHT'):
+        raise ValueError("syntax error")
+    return direction == b'LEFT'
+
+def move_list_element(datastore, source, destination, from_left, to_left):
+    with datastore.locks_for([source, destination]):
+        source_list = lookup_typed(datastore, source, 'list')
+        if not source_list:
+            return None
+        lookup_typed(datastore, destination, 'list')
+        value = pop_from_list(datastore, source, source_list, from_left)
+        destination_list = lookup_typed(datastore, destination, 'list')
+        if destination_list is None:
+            destination_list = deque()
+            datastore.set_item(destination, destination_list)
+        if to_left:
+            destination_list.appendleft(value)
         else:
-            datastore.set_item(key, ('stream', [new_entry]))
-        datastore.notify_waiters(key, notify_all=True)
-    return protocol.format_bulk_string(entry_id_bytes_to_store)
-
-def handle_xrange(parts, datastore, server_state):
-    key = parts[4]
-    start_id_str, end_id_str = parts[6].decode(), parts[8].decode()
-    def parse_range_id(id_str, is_end_id=False):
-        if id_str == '-': return (0, 0)
-        if id_str == '+': return (float('inf'), float('inf'))
-        if '-' in id_str: return tuple(map(int, id_str.split('-')))
-        return (int(id_str), float('inf') if is_end_id else 0)
-    start_id, end_id = parse_range_id(start_id_str), parse_range_id(end_id_str, True)
-    results = []
-    with datastore.lock:
-        item = datastore.get_item(key)
-        if item and item[0] == 'stream':
-            for entry in item[1]:
-                entry_id_tuple = parse_range_id(entry[0].decode())
-                if start_id <= entry_id_tuple <= end_id:
-                    results.append(entry)
-    return protocol.format_stream_range_response(results)
-
-def handle_xread(parts, datastore, server_state, is_blocking_call=False):
-    block_timeout_ms = None
-    keys = []
-    start_ids_str = []
+            destination_list.append(value)
+        datastore.notify_waiters(destination, count=1)
+        return value
 
+def handle_lmove(cmd, datastore, server_state):
+    source, destination = cmd.argv[1], cmd.argv[2]
     try:
-        streams_idx = [p.lower() for p in parts].index(b'streams')
-        options_parts = parts[:streams_idx]
-        stream_parts = parts[streams_idx + 1:]
+        from_left, to_left = parse_list_direction(cmd.argv[3]), parse_list_direction(cmd.argv[4])
+    except ValueError:
+        return protocol.format_error("syntax error")
+    return protocol.format_bulk_string(move_list_element(datastore, source, destination, from_left, to_left))
+
+def parse_blocking_timeout_ms(arg):
+    try:
+        timeout_s = float(arg)
+    except ValueError:
+        raise ValueError("timeout is not a float or out of range") from None
+    if timeout_s < 0:
+        raise ValueError("timeout is negative")
+    return timeout_s * 1000
+
+def prepare_blocking_pop(cmd, datastore):
+    keys = cmd.argv[1:-1]
+    try:
+        timeout_ms = parse_blocking_timeout_ms(cmd.argv[-1])
+    except ValueError as e:
+        return protocol.format_error(str(e))
+    from_left = cmd.name == "BLPOP"
+    cmd.rewrite(None)
+
+    def attempt(candidate_keys):
+        with datastore.locks_for(candidate_keys):
+            for key in candidate_keys:
+                the_list = lookup_typed(datastore, key, 'list')
+                if the_list:
+                    value = pop_from_list(datastore, key, the_list, from_left)
+                    cmd.rewrite([b"LPOP" if from_left else b"RPOP", key])
+                    return protocol.format_array([protocol.format_bulk_string(key), protocol.format_bulk_string(value)])
+        return None
+
+    def is_ready(key):
+        value = datastore.get_item(key)
+        return type(value) is deque and len(value) > 0
+
+    reply = attempt(keys)
+    if reply is not None:
+        return reply
+    return BlockingRequest(keys, timeout_ms, attempt, is_ready, protocol.format_array(None))
+
+def prepare_blmove(cmd, datastore):
+    source, destination = cmd.argv[1], cmd.argv[2]
+    try:
+        from_left, to_left = parse_list_direction(cmd.argv[3]), parse_list_direction(cmd.argv[4])
+        timeout_ms = parse_blocking_timeout_ms(cmd.argv[5])
+    except ValueError as e:
+        return protocol.format_error(str(e))
+    cmd.rewrite(None)
+
+    def attempt(candidate_keys):
+        value = move_list_element(datastore, source, destination, from_left, to_left)
+        if value is None:
+            return None
+        cmd.rewrite([b"LMOVE", source, destination, cmd.argv[3], cmd.argv[4]])
+        return protocol.format_bulk_string(value)
+
+    def is_ready(key):
+        value = datastore.get_item(key)
+        return type(value) is deque and len(value) > 0
+
+    reply = attempt([source])
+    if reply is not None:
+        return reply
+    return BlockingRequest([source], timeout_ms, attempt, is_ready, protocol.format_bulk_string(None))
+
+XADD_ID_TOO_SMALL_ERROR = "The ID specified in XADD is equal or smaller than the target stream top item"
+
+def parse_range_bound(arg, is_end):
+    if arg == b'-': return 0
+    if arg == b'+': return MAX_ID
+    exclusive = arg.startswith(b'(')
+    stream_id = parse_id(arg[1:] if exclusive else arg, SEQ_MASK if is_end else 0)
+    if exclusive:
+        if stream_id == (0 if is_end else MAX_ID):
+            raise ValueError("invalid end ID for the interval" if is_end else "invalid start ID for the interval")
+        stream_id += -1 if is_end else 1
+    return stream_id
 
+def parse_count_option(argv, i):
+    if len(argv) == i:
+        return None
+    if len(argv) != i + 2 or argv[i].upper() != b'COUNT':
+        raise ValueError("syntax error")
+    try:
+        return max(0, int(argv[i + 1]))
+    except ValueError:
+        raise ValueError("value is not an integer or out of range") from None
+
+def parse_trim_options(argv, i):
+    """Parses `MAXLEN|MINID [=|~] threshold [LIMIT count]` at argv[i]; returns (strategy, approximate, threshold, limit) and the next index."""
+    strategy = argv[i].upper()
+    i += 1
+    approximate = False
+    if i < len(argv) and argv[i] in (b'=', b'~'):
+        approximate = argv[i] == b'~'
+        i += 1
+    if i >= len(argv):
+        raise ValueError("syntax error")
+    if strategy == b'MAXLEN':
+        try:
+            threshold = int(argv[i])
+        except ValueError:
+            raise ValueError("value is not an integer or out of range") from None
+        if threshold < 0:
+            raise ValueError("The MAXLEN argument must be >= 0.")
+    else:
+        threshold = parse_id(argv[i])
+    i += 1
+    limit = None
+    if i + 1 < len(argv) and argv[i].upper() == b'LIMIT':
+        if not approximate:
+            raise ValueError("syntax error, LIMIT cannot be used without the special ~ option")
+        try:
+            limit = int(argv[i + 1])
+        except ValueError:
+            raise ValueError("value is not an integer or out of range") from None
+        i += 2
+    return (strategy, approximate, threshold, limit), i
+
+def trim_stream(stream, trim):
+    strategy, approximate, threshold, limit = trim
+    if strategy == b'MAXLEN':
+        return stream.trim_maxlen(threshold, approximate, limit)
+    return stream.trim_minid(threshold, approximate, limit)
+
+def next_entry_id(id_arg, last_id):
+    last_ms, last_seq = unpack_id(last_id)
+    if id_arg == b'*':
+        ms = max(now_ms(), last_ms)
+        seq = last_seq + 1 if ms == last_ms else 0
+        if seq > SEQ_MASK:
+            ms, seq = ms + 1, 0
+        return pack_id(ms, seq)
+    if id_arg.endswith(b'-*'):
+        ms = parse_id(id_arg[:-2]) >> 64
+        if ms < last_ms:
+            raise ValueError(XADD_ID_TOO_SMALL_ERROR)
+        seq = last_seq + 1 if ms == last_ms else 0
+        if seq > SEQ_MASK:
+            raise ValueError(XADD_ID_TOO_SMALL_ERROR)
+        return pack_id(ms, seq)
+    entry_id = parse_id(id_arg)
+    if entry_id == 0:
+        raise ValueError("The ID specified in XADD must be greater than 0-0")
+    if entry_id <= last_id:
+        raise ValueError(XADD_ID_TOO_SMALL_ERROR)
+    return entry_id
+
+def handle_xadd(cmd, datastore, server_state):
+    argv = cmd.argv
+    key = argv[1]
+    no_mkstream = False
+    trim = None
+    i = 2
+    try:
+        while i < len(argv):
+            option = argv[i].upper()
+            if option == b'NOMKSTREAM':
+                no_mkstream = True
+                i += 1
+            elif option in (b'MAXLEN', b'MINID'):
+                trim, i = parse_trim_options(argv, i)
+            else:
+                break
+    except ValueError as e:
+        return protocol.format_error(str(e))
+    field_values = argv[i + 1:]
+    if not field_values or len(field_values) % 2:
+        return protocol.format_error("wrong number of arguments for 'xadd' command")
+
+    with datastore.key_lock(key):
+        stream = lookup_typed(datastore, key, 'stream')
+        if stream is None and no_mkstream:
+            return protocol.format_bulk_string(None)
         try:
-            block_idx = [p.lower() for p in options_parts].index(b'block')
-            if is_blocking_call:
-                block_timeout_ms = int(options_parts[block_idx + 2].decode())
-        except (ValueError, IndexError):
-            pass
-
-        if len(stream_parts) % 2 != 0:
-            return protocol.format_error("ERR Unbalanced XREAD list of streams")
-        
-        num_keys = len(stream_parts) // 2
-        keys = stream_parts[:num_keys]
-        start_ids_str = [p.decode() for p in stream_parts[num_keys:]]
+            entry_id = next_entry_id(argv[i], stream.last_id if stream is not None else 0)
+        except ValueError as e:
+            return protocol.format_error(str(e))
+        if stream is None:
+            stream = Stream()
+            datastore.set_item(key, stream)
+        stream.append(entry_id, tuple(field_values))
+        entry_id_bytes = format_id(entry_id)
+        if trim is not None:
+            trim_stream(stream, trim)
+        if trim is not None or argv[i].endswith(b'*'):
+            # Replicas must store the same ID and trim to the same length, so send them both explicitly.
+            trim_args = [b"MAXLEN", b"=", b"%d" % len(stream)] if trim is not None else []
+            cmd.rewrite([b"XADD", key] + trim_args + [entry_id_bytes] + field_values)
+        datastore.notify_waiters(key)
+    return protocol.format_bulk_string(entry_id_bytes)
+
+def handle_xrange(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    reverse = cmd.name == "XREVRANGE"
+    try:
+        if reverse:
+            end, start = parse_range_bound(cmd.argv[2], True), parse_range_bound(cmd.argv[3], False)
+        else:
+            start, end = parse_range_bound(cmd.argv[2], False), parse_range_bound(cmd.argv[3], True)
+        count = parse_count_option(cmd.argv, 4)
+    except ValueError as e:
+        return protocol.format_error(str(e))
+    with datastore.key_lock(key):
+        stream = lookup_typed(datastore, key, 'stream')
+        if stream is None:
+            return protocol.format_array([])
+        entries = stream.revrange(end, start, count) if reverse else stream.range(start, end, count)
+    return protocol.format_stream_range_response(entries)
 
+def handle_xlen(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        stream = lookup_typed(datastore, key, 'stream')
+        return protocol.format_integer(len(stream) if stream is not None else 0)
+
+def handle_xtrim(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    try:
+        if len(cmd.argv) < 4 or cmd.argv[2].upper() not in (b'MAXLEN', b'MINID'):
+            raise ValueError("syntax error")
+        trim, i = parse_trim_options(cmd.argv, 2)
+        if i != len(cmd.argv):
+            raise ValueError("syntax error")
+    except ValueError as e:
+        return protocol.format_error(str(e))
+    with datastore.key_lock(key):
+        stream = lookup_typed(datastore, key, 'stream')
+        removed = trim_stream(stream, trim) if stream is not None else 0
+        cmd.rewrite([b"XTRIM", key, b"MAXLEN", b"=", b"%d" % len(stream)] if removed else None)
+    return protocol.format_integer(removed)
+
+def prepare_xread(cmd, datastore):
+    argv = cmd.argv
+    block_timeout_ms = None
+    count = None
+    i = 1
+    try:
+        while argv[i].upper() != b'STREAMS':
+            option = argv[i].upper()
+            if option == b'COUNT':
+                count = int(argv[i + 1])
+                if count <= 0: count = None
+            elif option == b'BLOCK':
+                block_timeout_ms = int(argv[i + 1])
+                if block_timeout_ms < 0:
+                    return protocol.format_error("timeout is negative")
+            else:
+                return protocol.format_error("syntax error")
+            i += 2
     except ValueError:
-        return protocol.format_error("ERR syntax error")
+        return protocol.format_error("value is not an integer or out of range")
+    except IndexError:
+        return protocol.format_error("syntax error")
 
-    if not keys:
-        return protocol.format_error("ERR 'streams' argument is missing or empty")
-
-    def parse_id(id_str):
-        if id_str == '$': return '$'
-        return tuple(map(int, id_str.split('-')))
-
-    resolved_start_ids = []
-    with datastore.lock:
-        for i, key in enumerate(keys):
-            id_val = start_ids_str[i]
-            if id_val == '$':
-                item = datastore.get_item(key)
-                if item and item[0] == 'stream' and item[1]:
-                    resolved_start_ids.append(parse_id(item[1][-1][0].decode()))
-                else:
-                    resolved_start_ids.append((0, 0))
+    stream_parts = argv[i + 1:]
+    if not stream_parts or len(stream_parts) % 2 != 0:
+        return protocol.format_error("Unbalanced 'xread' list of streams: for each stream key an ID or '$' must be specified.")
+    num_keys = len(stream_parts) // 2
+    keys = stream_parts[:num_keys]
+
+    start_ids = {}
+    with datastore.locks_for(keys):
+        for key, id_arg in zip(keys, stream_parts[num_keys:]):
+            if id_arg == b'$':
+                stream = lookup_typed(datastore, key, 'stream')
+                start_ids[key] = stream.last_id if stream is not None else 0
             else:
-                resolved_start_ids.append(parse_id(id_val))
-    
-    def get_results_after_id_resolution():
-        all_results = {}
-        with datastore.lock:
-            for i, key in enumerate(keys):
-                start_id = resolved_start_ids[i]
-                key_results = []
-                item = datastore.get_item(key)
-                if item and item[0] == 'stream':
-                    for entry in item[1]:
-                        entry_id = parse_id(entry[0].decode())
-                        if entry_id > start_id:
-                            key_results.append(entry)
-                if key_results:
-                    all_results[key] = key_results
-        return all_results
-
-    results = get_results_after_id_resolution()
-    if results or not is_blocking_call or block_timeout_ms is None:
-        return protocol.format_xread_response(results)
-
-    key_to_wait_on = keys[0]
-    with datastore.lock:
-        results = get_results_after_id_resolution()
+                try:
+                    start_ids[key] = parse_id(id_arg)
+                except ValueError as e:
+                    return protocol.format_error(str(e))
+
+    def attempt(candidate_keys):
+        results = read_streams(datastore, candidate_keys, start_ids, count)
         if results:
             return protocol.format_xread_response(results)
-        
-        condition = datastore.get_condition_for_key(key_to_wait_on)
-        timeout_s = None if block_timeout_ms == 0 else block_timeout_ms / 1000.0
-        condition.wait(timeout=timeout_s)
-
-    final_results = get_results_after_id_resolution()
-    if final_results:
-        return protocol.format_xread_response(final_results)
+        return None
+
+    def is_ready(key):
+        value = datastore.get_item(key)
+        return type(value) is Stream and value.last_id > start_ids[key]
+
+    reply = attempt(keys)
+    if reply is not None or block_timeout_ms is None:
+        return reply or protocol.format_xread_response({})
+    return BlockingRequest(keys, block_timeout_ms, attempt, is_ready, protocol.format_bulk_string(None))
+
+def read_streams(datastore, keys, start_ids, count=None):
+    all_results = {}
+    with datastore.locks_for(keys):
+        for key in keys:
+            stream = lookup_typed(datastore, key, 'stream')
+            if stream is not None and stream.last_id > start_ids[key]:
+                entries = stream.after(start_ids[key], count)
+                if entries:
+                    all_results[key] = entries
+    return all_results
+
+def set_hash_fields(datastore, key, h, pairs):
+    """
+    Writes the flat field/value `pairs` into hash `h` (None creates it) and
+    stores it back in the encoding its new size needs. Returns the number
+    of fields added.
+    """
+    limits = datastore.limits
+    h = convert_if_needed(HashListpack() if h is None else h, limits, pairs)
+    added = 0
+    for i in range(0, len(pairs), 2):
+        added += hash_set(h, pairs[i], pairs[i + 1])
+    datastore.set_item(key, convert_if_needed(h, limits))
+    return added
+
+def handle_hset(cmd, datastore, server_state):
+    key, pairs = cmd.argv[1], cmd.argv[2:]
+    if not pairs or len(pairs) % 2:
+        return protocol.format_error("wrong number of arguments for 'hset' command")
+    with datastore.key_lock(key):
+        h = lookup_typed(datastore, key, 'hash')
+        return protocol.format_integer(set_hash_fields(datastore, key, h, pairs))
+
+def handle_hget(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        h = lookup_typed(datastore, key, 'hash')
+        return protocol.format_bulk_reply(hash_get(h, cmd.argv[2]) if h is not None else None)
+
+def handle_hmget(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        h = lookup_typed(datastore, key, 'hash')
+        values = [hash_get(h, field) if h is not None else None for field in cmd.argv[2:]]
+    return protocol.format_array([protocol.format_bulk_string(value) for value in values])
+
+def handle_hdel(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        h = lookup_typed(datastore, key, 'hash')
+        removed = sum(hash_delete(h, field) for field in cmd.argv[2:]) if h is not None else 0
+        if removed and not h:
+            datastore.delete_item(key)
+    if not removed:
+        cmd.rewrite(None)
+    return protocol.format_integer(removed)
+
+def handle_hgetall(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        h = lookup_typed(datastore, key, 'hash')
+        flat = hash_flat(h) if h is not None else []
+    return protocol.format_bulk_array(flat)
+
+def handle_hlen(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        h = lookup_typed(datastore, key, 'hash')
+        return protocol.format_integer(hash_len(h) if h is not None else 0)
+
+def handle_hincrby(cmd, datastore, server_state):
+    key, field = cmd.argv[1], cmd.argv[2]
+    try:
+        delta = parse_int64(cmd.argv[3])
+    except ValueError as e:
+        return protocol.format_error(str(e))
+    with datastore.key_lock(key):
+        h = lookup_typed(datastore, key, 'hash')
+        value = hash_get(h, field) if h is not None else None
+        if value is None:
+            value = 0
+        else:
+            value = encode_string(value)
+            if type(value) is not int:
+                return protocol.format_error("hash value is not an integer")
+        new_value = value + delta
+        if not INT64_MIN <= new_value <= INT64_MAX:
+            return protocol.format_error("increment or decrement would overflow")
+        set_hash_fields(datastore, key, h, [field, b"%d" % new_value])
+    return protocol.format_integer(new_value)
+
+def parse_scan_options(argv, i):
+    """Returns (MATCH pattern or None, COUNT, NOVALUES) from the options starting at argv[i]."""
+    pattern, count, no_values = None, 10, False
+    while i < len(argv):
+        option = argv[i].upper()
+        if option == b'MATCH' and i + 1 < len(argv):
+            pattern = argv[i + 1]
+            i += 2
+        elif option == b'COUNT' and i + 1 < len(argv):
+            try:
+                count = int(argv[i + 1])
+            except ValueError:
+                raise ValueError(NOT_AN_INTEGER_ERROR) from None
+            if count < 1:
+                raise ValueError("syntax error")
+            i += 2
+        elif option == b'NOVALUES':
+            no_values = True
+            i += 1
+        else:
+            raise ValueError("syntax error")
+    return pattern, count, no_values
+
+def handle_hscan(cmd, datastore, server_state):
+    """
+    A listpack hash is returned whole with cursor 0, as Redis does. A dict
+    is walked in insertion order and the cursor counts fields already
+    returned, so fields deleted mid-scan can make it skip as many others.
+    """
+    key = cmd.argv[1]
+    try:
+        cursor = int(cmd.argv[2])
+        if cursor < 0:
+            raise ValueError()
+    except ValueError:
+        return protocol.format_error("invalid cursor")
+    try:
+        pattern, count, no_values = parse_scan_options(cmd.argv, 3)
+    except ValueError as e:
+        return protocol.format_error(str(e))
+    next_cursor = 0
+    with datastore.key_lock(key):
+        h = lookup_typed(datastore, key, 'hash')
+        if h is None:
+            pairs = []
+        elif type(h) is HashListpack:
+            pairs = list(hash_items(h))
+        else:
+            pairs = list(islice(h.items(), cursor, cursor + count))
+            if cursor + count < len(h):
+                next_cursor = cursor + count
+    if pattern is not None:
+        pairs = [pair for pair in pairs if fnmatch.fnmatchcase(pair[0], pattern)]
+    items = [pair[0] for pair in pairs] if no_values else [item for pair in pairs for item in pair]
+    return protocol.format_array_reply([protocol.format_bulk_string(b"%d" % next_cursor), protocol.format_bulk_array(items)])
+
+ZADD_FLAGS = {b'NX', b'XX', b'GT', b'LT', b'CH', b'INCR'}
+
+def handle_zadd(cmd, datastore, server_state):
+    argv = cmd.argv
+    key = argv[1]
+    flags = set()
+    i = 2
+    while i < len(argv) and argv[i].upper() in ZADD_FLAGS:
+        flags.add(argv[i].upper())
+        i += 1
+    pairs = argv[i:]
+    incr = b'INCR' in flags
+    if not pairs or len(pairs) % 2:
+        return protocol.format_error("syntax error")
+    if b'NX' in flags and b'XX' in flags:
+        return protocol.format_error("XX and NX options at the same time are not compatible")
+    if len(flags & {b'GT', b'LT', b'NX'}) > 1:
+        return protocol.format_error("GT, LT, and/or NX options at the same time are not compatible")
+    if incr and len(pairs) > 2:
+        return protocol.format_error("INCR option supports a single increment-element pair")
+    try:
+        scores = [parse_float(score) for score in pairs[0::2]]
+    except ValueError as e:
+        return protocol.format_error(str(e))
+    members = pairs[1::2]
+
+    limits = datastore.limits
+    added = changed = 0
+    result = None
+    with datastore.key_lock(key):
+        zset = lookup_typed(datastore, key, 'zset')
+        if zset is None:
+            zset = ZsetListpack()
+        zset = zset_convert_if_needed(zset, limits, members)
+        for score, member in zip(scores, members):
+            current = zset.get_score(member)
+            if current is None:
+                if b'XX' in flags:
+                    continue
+                zset.insert(member, score)
+                added += 1
+            else:
+                if b'NX' in flags:
+                    continue
+                if incr:
+                    score += current
+                    if math.isnan(score):
+                        return protocol.format_error("resulting score is not a number (NaN)")
+                if (b'GT' in flags and score <= current) or (b'LT' in flags and score >= current):
+                    continue
+                if score != current:
+                    zset.delete(member)
+                    zset.insert(member, score)
+                    changed += 1
+            result = score
+        if zset.card():
+            datastore.set_item(key, zset_convert_if_needed(zset, limits))
+            if added:
+                datastore.notify_waiters(key, count=added)
+    if incr:
+        return protocol.format_bulk_string(format_score(result) if result is not None else None)
+    return protocol.format_integer(added + changed if b'CH' in flags else added)
+
+def handle_zincrby(cmd, datastore, server_state):
+    key, member = cmd.argv[1], cmd.argv[3]
+    try:
+        increment = parse_float(cmd.argv[2])
+    except ValueError as e:
+        return protocol.format_error(str(e))
+    limits = datastore.limits
+    with datastore.key_lock(key):
+        zset = lookup_typed(datastore, key, 'zset')
+        if zset is None:
+            zset = ZsetListpack()
+        current = zset.get_score(member)
+        score = increment if current is None else current + increment
+        if math.isnan(score):
+            return protocol.format_error("resulting score is not a number (NaN)")
+        zset = zset_convert_if_needed(zset, limits, [member])
+        if current is not None:
+            zset.delete(member)
+        zset.insert(member, score)
+        datastore.set_item(key, zset_convert_if_needed(zset, limits))
+        if current is None:
+            datastore.notify_waiters(key, count=1)
+    return protocol.format_bulk_string(format_score(score))
+
+def handle_zscore(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        zset = lookup_typed(datastore, key, 'zset')
+        score = zset.get_score(cmd.argv[2]) if zset is not None else None
+    return protocol.format_bulk_string(format_score(score) if score is not None else None)
+
+def handle_zcard(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        zset = lookup_typed(datastore, key, 'zset')
+        return protocol.format_integer(zset.card() if zset is not None else 0)
+
+def handle_zrank(cmd, datastore, server_state):
+    """ZRANK and ZREVRANK, optionally WITHSCORE."""
+    key, member = cmd.argv[1], cmd.argv[2]
+    with_score = len(cmd.argv) > 3
+    if len(cmd.argv) > 4 or (with_score and cmd.argv[3].upper() != b'WITHSCORE'):
+        return protocol.format_error("syntax error")
+    with datastore.key_lock(key):
+        zset = lookup_typed(datastore, key, 'zset')
+        rank = zset.rank(member) if zset is not None else None
+        if rank is None:
+            return protocol.format_bulk_string(None)
+        if cmd.name == "ZREVRANK":
+            rank = zset.card() - 1 - rank
+        score = zset.get_score(member)
+    if with_score:
+        return protocol.format_array([protocol.format_integer(rank), protocol.format_bulk_string(format_score(score))])
+    return protocol.format_integer(rank)
+
+def handle_zrem(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        zset = lookup_typed(datastore, key, 'zset')
+        removed = sum(zset.delete(member) for member in cmd.argv[2:]) if zset is not None else 0
+        if removed and not zset.card():
+            datastore.delete_item(key)
+    if not removed:
+        cmd.rewrite(None)
+    return protocol.format_integer(removed)
+
+def parse_score_bound(arg):
+    """(score, exclusive) from a ZRANGE BYSCORE bound such as `1.5`, `(1.5` or `-inf`."""
+    exclusive = arg.startswith(b'(')
+    try:
+        score = float(arg[1:] if exclusive else arg)
+    except ValueError:
+        score = math.nan
+    if math.isnan(score):
+        raise ValueError("min or max is not a float")
+    return score, exclusive
+
+def parse_lex_bound(arg):
+    """(member, exclusive) from a ZRANGE BYLEX bound; `-` is (b"", False) and `+` is (None, False)."""
+    if arg == b'-':
+        return b"", False
+    if arg == b'+':
+        return None, False
+    if arg[:1] not in (b'[', b'('):
+        raise ValueError("min or max not valid string range item")
+    return arg[1:], arg[:1] == b'('
+
+def lex_bound_rank(zset, bound, is_max):
+    member, exclusive = bound
+    if member is None:
+        return zset.card()
+    return lex_rank(zset, member, after=exclusive != is_max)
+
+def handle_zrange(cmd, datastore, server_state):
+    """ZRANGE key start stop [BYSCORE | BYLEX] [REV] [LIMIT offset count] [WITHSCORES]"""
+    argv = cmd.argv
+    key = argv[1]
+    by, rev, with_scores, limit = None, False, False, None
+    i = 4
+    while i < len(argv):
+        option = argv[i].upper()
+        if option in (b'BYSCORE', b'BYLEX'):
+            by = option
+        elif option == b'REV':
+            rev = True
+        elif option == b'WITHSCORES':
+            with_scores = True
+        elif option == b'LIMIT' and i + 2 < len(argv):
+            try:
+                limit = int(argv[i + 1]), int(argv[i + 2])
+            except ValueError:
+                return protocol.format_error(NOT_AN_INTEGER_ERROR)
+            i += 2
+        else:
+            return protocol.format_error("syntax error")
+        i += 1
+    if limit is not None and by is None:
+        return protocol.format_error("syntax error, LIMIT is only supported in combination with either BYSCORE or BYLEX")
+    if with_scores and by == b'BYLEX':
+        return protocol.format_error("syntax error, WITHSCORES not supported in combination with BYLEX")
+    # With REV, BYSCORE and BYLEX take the range as max then min.
+    min_arg, max_arg = (argv[3], argv[2]) if rev and by is not None else (argv[2], argv[3])
+    try:
+        if by == b'BYSCORE':
+            min_bound, max_bound = parse_score_bound(min_arg), parse_score_bound(max_arg)
+        elif by == b'BYLEX':
+            min_bound, max_bound = parse_lex_bound(min_arg), parse_lex_bound(max_arg)
+        else:
+            start, stop = int(min_arg), int(max_arg)
+    except ValueError as e:
+        return protocol.format_error(NOT_AN_INTEGER_ERROR if by is None else str(e))
+
+    with datastore.key_lock(key):
+        zset = lookup_typed(datastore, key, 'zset')
+        if zset is None:
+            return protocol.format_array([])
+        card = zset.card()
+        if by == b'BYSCORE':
+            lo = score_rank(zset, min_bound[0], after=min_bound[1])
+            hi = score_rank(zset, max_bound[0], after=not max_bound[1])
+        elif by == b'BYLEX':
+            lo, hi = lex_bound_rank(zset, min_bound, False), lex_bound_rank(zset, max_bound, True)
+        else:
+            bounds = normalize_range(start, stop, card)
+            if bounds is None:
+                return protocol.format_array([])
+            lo, hi = (card - 1 - bounds[1], card - bounds[0]) if rev else (bounds[0], bounds[1] + 1)
+        if limit is not None:
+            offset, count = limit
+            if offset < 0:
+                return protocol.format_array([])
+            if rev:
+                hi -= offset
+                if count >= 0:
+                    lo = max(lo, hi - count)
+            else:
+                lo += offset
+                if count >= 0:
+                    hi = min(hi, lo + count)
+        entries = zset.entries(lo, hi) if lo < hi else []
+    if rev:
+        entries.reverse()
+    return protocol.format_bulk_array(zset_reply_items(entries, with_scores))
+
+def zset_reply_items(entries, with_scores=True):
+    if with_scores:
+        return [item for score, member in entries for item in (member, format_score(score))]
+    return [member for _, member in entries]
+
+def pop_from_zset(datastore, key, zset, count, from_min):
+    """Removes up to `count` lowest (or highest) elements and returns their (score, member) entries in pop order."""
+    card = zset.card()
+    count = min(count, card)
+    entries = zset.entries(0, count) if from_min else zset.entries(card - count, card)[::-1]
+    for _, member in entries:
+        zset.delete(member)
+    if not zset.card():
+        datastore.delete_item(key)
+    return entries
+
+def handle_zpop(cmd, datastore, server_state):
+    """ZPOPMIN and ZPOPMAX."""
+    key = cmd.argv[1]
+    count = 1
+    if len(cmd.argv) > 2:
+        try:
+            count = int(cmd.argv[2])
+        except ValueError:
+            return protocol.format_error("value is out of range, must be positive")
+        if count < 0:
+            return protocol.format_error("value is out of range, must be positive")
+    with datastore.key_lock(key):
+        zset = lookup_typed(datastore, key, 'zset')
+        entries = pop_from_zset(datastore, key, zset, count, cmd.name == "ZPOPMIN") if zset is not None else []
+    if not entries:
+        cmd.rewrite(None)
+    return protocol.format_bulk_array(zset_reply_items(entries))
+
+def prepare_blocking_zpop(cmd, datastore):
+    """BZPOPMIN and BZPOPMAX: served like BLPOP, and propagated as the ZPOPMIN/ZPOPMAX that served them."""
+    keys = cmd.argv[1:-1]
+    try:
+        timeout_ms = parse_blocking_timeout_ms(cmd.argv[-1])
+    except ValueError as e:
+        return protocol.format_error(str(e))
+    from_min = cmd.name == "BZPOPMIN"
+    cmd.rewrite(None)
+
+    def attempt(candidate_keys):
+        with datastore.locks_for(candidate_keys):
+            for key in candidate_keys:
+                zset = lookup_typed(datastore, key, 'zset')
+                if zset is not None:
+                    (score, member), = pop_from_zset(datastore, key, zset, 1, from_min)
+                    cmd.rewrite([b"ZPOPMIN" if from_min else b"ZPOPMAX", key])
+                    return protocol.format_bulk_array([key, member, format_score(score)])
+        return None
+
+    def is_ready(key):
+        return type(datastore.get_item(key)) in (ZsetListpack, SortedSet)
+
+    reply = attempt(keys)
+    if reply is not None:
+        return reply
+    return BlockingRequest(keys, timeout_ms, attempt, is_ready, protocol.format_array(None))
+
+def handle_sadd(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    max_intset_entries = datastore.limits.set_max_intset_entries
+    with datastore.key_lock(key):
+        s = lookup_typed(datastore, key, 'set')
+        if s is None:
+            s = IntSet()
+        added = 0
+        for member in cmd.argv[2:]:
+            if type(s) is IntSet:
+                member = encode_string(member)
+                if type(member) is int:
+                    added += s.add(member)
+                    if len(s) > max_intset_entries:
+                        s = to_hash_set(s)
+                    continue
+                s = to_hash_set(s)
+            if member not in s:
+                s.add(member)
+                added += 1
+        if s:
+            datastore.set_item(key, s)
+    return protocol.format_integer(added)
+
+def handle_srem(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        s = lookup_typed(datastore, key, 'set')
+        removed = 0
+        if s is not None:
+            for member in cmd.argv[2:]:
+                if type(s) is IntSet:
+                    member = encode_string(member)
+                    removed += type(member) is int and s.discard(member)
+                elif member in s:
+                    s.remove(member)
+                    removed += 1
+            if not s:
+                datastore.delete_item(key)
+    if not removed:
+        cmd.rewrite(None)
+    return protocol.format_integer(removed)
+
+def handle_sismember(cmd, datastore, server_state):
+    """SISMEMBER and SMISMEMBER."""
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        s = lookup_typed(datastore, key, 'set')
+        found = [s is not None and set_contains(s, encode_string(member)) for member in cmd.argv[2:]]
+    if cmd.name == "SISMEMBER":
+        return protocol.format_integer(int(found[0]))
+    return protocol.format_array([protocol.format_integer(int(is_member)) for is_member in found])
+
+def handle_scard(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        s = lookup_typed(datastore, key, 'set')
+        return protocol.format_integer(len(s) if s is not None else 0)
+
+def handle_smembers(cmd, datastore, server_state):
+    key = cmd.argv[1]
+    with datastore.key_lock(key):
+        s = lookup_typed(datastore, key, 'set')
+        members = set_members(s) if s is not None else []
+    return protocol.format_bulk_array(members)
+
+def encoded_members(s):
+    return s if type(s) is IntSet else map(encode_string, s)
+
+def intersect_sets(sets):
+    """
+    Members of every one of `sets` (None for a missing key). The smallest
+    set is walked and each member probed in the others, next smallest
+    first, so the work is bounded by the smallest set and misses are found
+    early. Sets of bytes only go through set.intersection() instead.
+    """
+    if not sets or any(s is None for s in sets):
+        return []
+    sets = sorted(sets, key=len)
+    smallest, others = sets[0], sets[1:]
+    if type(smallest) is set and all(type(s) is set for s in others):
+        return smallest.intersection(*others)
+    return [member for member in encoded_members(smallest) if all(set_contains(s, member) for s in others)]
+
+def union_sets(sets):
+    sets = [s for s in sets if s is not None]
+    if all(type(s) is IntSet for s in sets):
+        result = set()
+        for s in sets:
+            result.update(s)
+        return result
+    return set().union(*(to_hash_set(s) for s in sets))
+
+def diff_sets(sets):
+    first, others = sets[0], [s for s in sets[1:] if s is not None]
+    if first is None:
+        return []
+    if type(first) is set and all(type(s) is set for s in others):
+        return first.difference(*others)
+    return [member for member in encoded_members(first) if not any(set_contains(s, member) for s in others)]
+
+SET_OPERATIONS = {"SINTER": intersect_sets, "SUNION": union_sets, "SDIFF": diff_sets}
+
+def handle_set_operation(cmd, datastore, server_state):
+    """SINTER, SUNION and SDIFF."""
+    keys = cmd.argv[1:]
+    with datastore.locks_for(keys):
+        result = SET_OPERATIONS[cmd.name]([lookup_typed(datastore, key, 'set') for key in keys])
+        members = [member_bytes(member) for member in result]
+    return protocol.format_bulk_array(members)
+
+def handle_set_operation_store(cmd, datastore, server_state):
+    """SINTERSTORE, SUNIONSTORE and SDIFFSTORE: the result replaces `destination`, whatever it held."""
+    destination, keys = cmd.argv[1], cmd.argv[2:]
+    with datastore.locks_for([destination] + keys):
+        result = SET_OPERATIONS[cmd.name[:-len("STORE")]]([lookup_typed(datastore, key, 'set') for key in keys])
+        if result:
+            members = [member if type(member) is int else encode_string(member) for member in result]
+            datastore.set_item(destination, new_set(members, datastore.limits))
+            datastore.set_expiry(destination, None)
+        else:
+            datastore.delete_item(destination)
+    return protocol.format_integer(len(result))
+
+def replication_info(server_state):
+    """On a master, each replica's acknowledged offset and seconds since its last ACK; on a replica, the link state."""
+    info_lines = [f"role:{server_state['role']}"]
+    if server_state['role'] == 'master':
+        now = time.monotonic()
+        with server_state["ack_condition"]:
+            replicas = [(server_state["replica_acks"].get(replica, 0), server_state["replica_ack_times"].get(replica, now))
+                        for replica in server_state["replicas"]]
+        info_lines.append(f"connected_slaves:{len(replicas)}")
+        for i, (ack_offset, ack_time) in enumerate(replicas):
+            info_lines.append(f"slave{i}:offset={ack_offset},lag={int(now - ack_time)}")
+        info_lines.append(f"master_replid:{server_state['master_replid']}")
+        info_lines.append(f"master_repl_offset:{server_state['master_repl_offset']}")
     else:
-        return protocol.format_bulk_string(None)
-
-def handle_info(parts, datastore, server_state):
-    section = parts[4].decode().lower()
-    if section == "replication":
-        info_lines = [f"role:{server_state['role']}"]
-        if server_state['role'] == 'master':
-            info_lines.append(f"master_replid:{server_state['master_replid']}")
-            info_lines.append(f"master_repl_offset:{server_state['master_repl_offset']}")
-        response_str = "\r\n".join(info_lines)
-        return protocol.format_bulk_string(response_str.encode())
-    return protocol.format_bulk_string(b"")
-
-def handle_replconf(parts, datastore, server_state):
+        last_io_time = server_state.get("master_last_io_time")
+        info_lines.append(f"master_host:{server_state['master_host']}")
+        info_lines.append(f"master_port:{server_state['master_port']}")
+        info_lines.append(f"master_link_status:{server_state.get('master_link_status', 'down')}")
+        info_lines.append(f"master_last_io_seconds_ago:{-1 if last_io_time is None else int(time.monotonic() - last_io_time)}")
+        info_lines.append(f"slave_repl_offset:{server_state['master_repl_offset']}")
+    return info_lines
+
+def keyspace_info(datastore):
+    keys, expires, type_counts = datastore.keyspace_stats()
+    if not keys:
+        return []
+    types = "".join(f",{name}={count}" for name, count in sorted(type_counts.items()))
+    return [f"db0:keys={keys},expires={expires}{types}"]
+
+INFO_SECTIONS = {
+    "clients": lambda datastore, server_state: server_state["stats"].clients_info(datastore.blocked_clients()),
+    "stats": lambda datastore, server_state: server_state["stats"].stats_info(),
+    "replication": lambda datastore, server_state: replication_info(server_state),
+    "commandstats": lambda datastore, server_state: server_state["stats"].commandstats_info(),
+    "latencystats": lambda datastore, server_state: server_state["stats"].latencystats_info(),
+    "keyspace": lambda datastore, server_state: keyspace_info(datastore),
+}
+DEFAULT_INFO_SECTIONS = ("clients", "stats", "replication", "keyspace")
+
+def handle_info(cmd, datastore, server_state):
+    sections = []
+    for arg in cmd.argv[1:] or [b"default"]:
+        section = arg.decode().lower()
+        if section == "default":
+            sections.extend(DEFAULT_INFO_SECTIONS)
+        elif section in ("all", "everything"):
+            sections.extend(INFO_SECTIONS)
+        else:
+            sections.append(section)
+    info_lines = []
+    for section in dict.fromkeys(sections):
+        section_info = INFO_SECTIONS.get(section)
+        if section_info is None:
+            continue
+        if info_lines:
+            info_lines.append("")
+        info_lines.append(f"# {section.capitalize()}")
+        info_lines.extend(section_info(datastore, server_state))
+    return protocol.format_bulk_string("\r\n".join(info_lines).encode())
+
+def handle_replconf(cmd, datastore, server_state):
     return protocol.format_simple_string("OK")
 
-def handle_psync(parts, datastore, server_state):
-    replid = server_state["master_replid"]
-    offset = server_state["master_repl_offset"]
-    response_str = f"FULLRESYNC {replid} {offset}"
-    return (protocol.format_simple_string(response_str), "SEND_RDB_FILE")
+def handle_save(cmd, datastore, server_state):
+    bgsave_lock = server_state["rdb_bgsave_lock"]
+    if bgsave_lock.locked():
+        return protocol.format_error("Background save already in progress")
+    config = server_state["config"]
+    try:
+        rdb.save_snapshot(rdb.capture_snapshot(datastore, server_state), config["dir"], config["dbfilename"])
+    except OSError as e:
+        return protocol.format_error(f"Error saving DB on disk: {e}")
+    server_state["rdb_last_save_time"] = int(time.time())
+    return protocol.format_simple_string("OK")
+
+def handle_bgsave(cmd, datastore, server_state):
+    bgsave_lock = server_state["rdb_bgsave_lock"]
+    if not bgsave_lock.acquire(blocking=False):
+        return protocol.format_error("Background save already in progress")
+    config = server_state["config"]
+    snapshot = rdb.capture_snapshot(datastore, server_state)
+
+    def save_in_background():
+        try:
+            rdb.save_snapshot(snapshot, config["dir"], config["dbfilename"])
+            server_state["rdb_last_save_time"] = int(time.time())
+        except OSError as e:
+            print(f"Background saving error: {e}")
+        finally:
+            bgsave_lock.release()
+
+    threading.Thread(target=save_in_background, daemon=True).start()
+    return protocol.format_simple_string("Background saving started")
+
+def handle_bgrewriteaof(cmd, datastore, server_state):
+    append_only_file = server_state["aof"]
+    if append_only_file is None:
+        return protocol.format_error("Background append only file rewriting requires appendonly yes")
+    if not append_only_file.rewrite_in_background(datastore, server_state):
+        return protocol.format_error("Background append only file rewriting already in progress")
+    return protocol.format_simple_string("Background append only file rewriting started")
+
+def handle_lastsave(cmd, datastore, server_state):
+    return protocol.format_integer(server_state["rdb_last_save_time"])
+
+def handle_config(cmd, datastore, server_state):
+    subcommand = cmd.argv[1].upper() if len(cmd.argv) > 1 else b''
+    if subcommand != b'GET' or len(cmd.argv) < 3:
+        return protocol.format_error(f"unknown subcommand or wrong number of arguments for '{subcommand.decode()}'")
+    matched = {}
+    for pattern in cmd.argv[2:]:
+        pattern = pattern.decode().lower()
+        for name, value in server_state["config"].items():
+            if fnmatch.fnmatchcase(name, pattern):
+                matched[name] = value
+    return protocol.format_array([protocol.format_bulk_string(part.encode())
+                                  for item in matched.items() for part in item])
+
+def handle_slowlog(cmd, datastore, server_state):
+    server_stats = server_state["stats"]
+    subcommand = cmd.argv[1].upper() if len(cmd.argv) > 1 else b''
+    if subcommand == b'GET' and len(cmd.argv) <= 3:
+        count = 10
+        if len(cmd.argv) == 3:
+            try:
+                count = int(cmd.argv[2])
+            except ValueError:
+                return protocol.format_error("value is not an integer or out of range")
+            if count < -1:
+                return protocol.format_error("count should be greater than or equal to -1")
+        entries = server_stats.slowlog_entries(None if count == -1 else count)
+        return protocol.format_array([protocol.format_array([
+            protocol.format_integer(entry.id), protocol.format_integer(entry.timestamp),
+            protocol.format_integer(entry.duration_us),
+            protocol.format_array([protocol.format_bulk_string(arg) for arg in entry.argv]),
+            protocol.format_bulk_string(entry.client.encode()), protocol.format_bulk_string(b""),
+        ]) for entry in entries])
+    if subcommand == b'LEN' and len(cmd.argv) == 2:
+        return protocol.format_integer(server_stats.slowlog_len())
+    if subcommand == b'RESET' and len(cmd.argv) == 2:
+        server_stats.slowlog_reset()
+        return protocol.format_simple_string("OK")
+    return protocol.format_error(f"unknown subcommand or wrong number of arguments for '{subcommand.decode()}'")
+
+def handle_latency(cmd, datastore, server_state):
+    latency_monitor = server_state["stats"].latency_monitor
+    subcommand = cmd.argv[1].upper() if len(cmd.argv) > 1 else b''
+    if subcommand == b'LATEST' and len(cmd.argv) == 2:
+        return protocol.format_array([protocol.format_array([
+            protocol.format_bulk_string(event.encode()), protocol.format_integer(timestamp),
+            protocol.format_integer(latest_ms), protocol.format_integer(max_ms),
+        ]) for event, timestamp, latest_ms, max_ms in latency_monitor.latest()])
+    if subcommand == b'HISTORY' and len(cmd.argv) == 3:
+        return protocol.format_array([
+            protocol.format_array([protocol.format_integer(timestamp), protocol.format_integer(latency_ms)])
+            for timestamp, latency_ms in latency_monitor.history(cmd.argv[2].decode())])
+    if subcommand == b'RESET':
+        events = [arg.decode() for arg in cmd.argv[2:]] or None
+        return protocol.format_integer(latency_monitor.reset(events))
+    return protocol.format_error(f"unknown subcommand or wrong number of arguments for '{subcommand.decode()}'")
+
+def populate_items(count, prefix, size):
+    for i in range(count):
+        value = b"value:%d" % i
+        if size is not None:
+            value = value[:size].ljust(size, b"\0")
+        yield b"%s:%d" % (prefix, i), value, None
+
+def handle_debug(cmd, datastore, server_state):
+    """DEBUG POPULATE count [prefix] [size]: creates prefix:0..count-1 string keys (skipping existing ones) for large-dataset tests."""
+    subcommand = cmd.argv[1].upper() if len(cmd.argv) > 1 else b''
+    if subcommand != b'POPULATE' or not 3 <= len(cmd.argv) <= 5:
+        return protocol.format_error(f"unknown subcommand or wrong number of arguments for '{subcommand.decode()}'")
+    try:
+        count = int(cmd.argv[2])
+        size = int(cmd.argv[4]) if len(cmd.argv) > 4 else None
+    except ValueError:
+        return protocol.format_error("value is not an integer or out of range")
+    if count < 0 or (size is not None and size < 0):
+        return protocol.format_error("value is out of range")
+    prefix = cmd.argv[3] if len(cmd.argv) > 3 else b"key"
+    datastore.load_items(populate_items(count, prefix, size), replace=False)
+    return protocol.format_simple_string("OK")
 
-def handle_wait(parts, datastore, server_state):
+def handle_wait(cmd, datastore, server_state):
     return None
 
 COMMAND_HANDLERS = {
     "PING": handle_ping, "ECHO": handle_echo, "INFO": handle_info,
-    "REPLCONF": handle_replconf, "PSYNC": handle_psync,
-    "SET": handle_set, "GET": handle_get, "INCR": handle_incr,
+    "REPLCONF": handle_replconf,
+    "SET": handle_set, "GET": handle_get, "MGET": handle_mget, "MSET": handle_mset, "MSETNX": handle_mset,
+    "DEL": handle_del, "UNLINK": handle_del, "EXISTS": handle_exists,
+    "INCR": handle_incr, "INCRBY": handle_incr,
+    "DECR": handle_incr, "DECRBY": handle_incr, "INCRBYFLOAT": handle_incrbyfloat,
     "TYPE": handle_type, "WAIT": handle_wait,
-    "LPUSH": handle_lpush, "RPUSH": handle_rpush, "LPOP": handle_lpop,
-    "LLEN": handle_llen, "LRANGE": handle_lrange,
-    "XADD": handle_xadd, "XRANGE": handle_xrange, "XREAD": handle_xread,
+    "SAVE": handle_save, "BGSAVE": handle_bgsave, "LASTSAVE": handle_lastsave,
+    "BGREWRITEAOF": handle_bgrewriteaof, "CONFIG": handle_config,
+    "SLOWLOG": handle_slowlog, "LATENCY": handle_latency, "DEBUG": handle_debug,
+    "EXPIRE": handle_expire, "PEXPIRE": handle_expire,
+    "EXPIREAT": handle_expire, "PEXPIREAT": handle_expire,
+    "TTL": handle_ttl, "PTTL": handle_ttl, "PERSIST": handle_persist,
+    "LPUSH": handle_push, "RPUSH": handle_push, "LPOP": handle_pop, "RPOP": handle_pop,
+    "LLEN": handle_llen, "LRANGE": handle_lrange, "LINDEX": handle_lindex,
+    "LTRIM": handle_ltrim, "LMOVE": handle_lmove,
+    "XADD": handle_xadd, "XRANGE": handle_xrange, "XREVRANGE": handle_xrange,
+    "XLEN": handle_xlen, "XTRIM": handle_xtrim,
+    "HSET": handle_hset, "HGET": handle_hget, "HMGET": handle_hmget, "HDEL": handle_hdel,
+    "HGETALL": handle_hgetall, "HLEN": handle_hlen, "HINCRBY": handle_hincrby, "HSCAN": handle_hscan,
+    "ZADD": handle_zadd, "ZINCRBY": handle_zincrby, "ZSCORE": handle_zscore, "ZCARD": handle_zcard,
+    "ZRANK": handle_zrank, "ZREVRANK": handle_zrank, "ZRANGE": handle_zrange, "ZREM": handle_zrem,
+    "ZPOPMIN": handle_zpop, "ZPOPMAX": handle_zpop,
+    "SADD": handle_sadd, "SREM": handle_srem, "SISMEMBER": handle_sismember, "SMISMEMBER": handle_sismember,
+    "SCARD": handle_scard, "SMEMBERS": handle_smembers,
+    "SINTER": handle_set_operation, "SUNION": handle_set_operation, "SDIFF": handle_set_operation,
+    "SINTERSTORE": handle_set_operation_store, "SUNIONSTORE": handle_set_operation_store,
+    "SDIFFSTORE": handle_set_operation_store,
 }
 
-WRITE_COMMANDS = {"SET", "INCR", "LPUSH", "RPUSH", "LPOP", "XADD"}
+BLOCKING_COMMANDS = {
+    "XREAD": prepare_xread,
+    "BLPOP": prepare_blocking_pop, "BRPOP": prepare_blocking_pop,
+    "BLMOVE": prepare_blmove,
+    "BZPOPMIN": prepare_blocking_zpop, "BZPOPMAX": prepare_blocking_zpop,
+}
+
+WRITE_COMMANDS = {
+    "SET", "MSET", "MSETNX", "DEL", "UNLINK", "INCR", "INCRBY", "DECR", "DECRBY", "INCRBYFLOAT",
+    "LPUSH", "RPUSH", "LPOP", "RPOP", "LTRIM", "LMOVE",
+    "BLPOP", "BRPOP", "BLMOVE", "XADD", "XTRIM", "HSET", "HDEL", "HINCRBY",
+    "ZADD", "ZINCRBY", "ZREM", "ZPOPMIN", "ZPOPMAX", "BZPOPMIN", "BZPOPMAX",
+    "SADD", "SREM", "SINTERSTORE", "SUNIONSTORE", "SDIFFSTORE",
+    "EXPIRE", "PEXPIRE", "EXPIREAT", "PEXPIREAT", "PERSIST",
+}
+
+def prepare_blocking_command(cmd, datastore):
+    """Runs a BLOCKING_COMMANDS entry once: returns the reply bytes, or a BlockingRequest to wait on."""
+    try:
+        return BLOCKING_COMMANDS[cmd.name](cmd, datastore)
+    except WrongTypeError:
+        return protocol.format_error(WRONGTYPE_ERROR)
+    except (IndexError, ValueError) as e:
+        return argument_error(cmd, e)
+
+def handle_blocking_command(cmd, datastore, server_state, on_reply=None):
+    """
+    Threaded path for BLOCKING_COMMANDS; `on_reply()` runs inside the write
+    gate once the command is served. Stats charge the first attempt only, not
+    the time spent blocked.
+    """
+    started = time.perf_counter_ns()
+    with datastore.write_gate:
+        request = prepare_blocking_command(cmd, datastore)
+        server_state["stats"].record(cmd, started)
+        if not isinstance(request, BlockingRequest):
+            if on_reply is not None:
+                on_reply()
+            return request
+    try:
+        return wait_for_keys(request, datastore, server_state["stats"].latency_monitor, on_reply)
+    except WrongTypeError:
+        return protocol.format_error(WRONGTYPE_ERROR)
+
+def handle_command(cmd, datastore, server_state):
+    command_name = cmd.name
+    started = time.perf_counter_ns()
+    if command_name in BLOCKING_COMMANDS:
+        request = prepare_blocking_command(cmd, datastore)
+        server_state["stats"].record(cmd, started)
+        return request.timeout_reply if isinstance(request, BlockingRequest) else request
 
-def handle_command(parts, datastore, server_state):
-    command_name = parts[2].decode().upper()
     handler = COMMAND_HANDLERS.get(command_name)
     if not handler:
         return protocol.format_error(f"unknown command '{command_name}'")
 
-    if command_name in ["WAIT", "XREAD"]:
+    if command_name == "WAIT":
         return None
-    
-    return handler(parts, datastore, server_state)
\ No newline at end of file
+
+    try:
+        return handler(cmd, datastore, server_state)
+    except WrongTypeError:
+        return protocol.format_error(WRONGTYPE_ERROR)
+    except (IndexError, ValueError) as e:
+        return argument_error(cmd, e)
+    finally:
+        server_state["stats"].record(cmd, started)
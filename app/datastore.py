@@ -1,40 +1,588 @@
+import heapq
+import queue
 import threading
 import time
+from collections import deque
+from contextlib import contextmanager
+from .hashes import HashListpack, DEFAULT_HASH_MAX_LISTPACK_ENTRIES, DEFAULT_HASH_MAX_LISTPACK_VALUE
+from .intsets import IntSet, DEFAULT_SET_MAX_INTSET_ENTRIES
+from .streams import Stream
+from .zsets import ZsetListpack, SortedSet, DEFAULT_ZSET_MAX_LISTPACK_ENTRIES, DEFAULT_ZSET_MAX_LISTPACK_VALUE
+
+ACTIVE_EXPIRE_CYCLE_KEYS_PER_LOOP = 20
+ACTIVE_EXPIRE_CYCLE_TIME_LIMIT_MS = 25
+ACTIVE_EXPIRE_HZ = 10
+EXPIRY_HEAP_SLACK = 1024
+LAZYFREE_THRESHOLD = 64
+SNAPSHOT_BATCH_EFFORT = 1024
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+SHARED_INTEGERS = 10000
+SHARED_INTEGER_OBJECTS = list(range(SHARED_INTEGERS))
+
+# Values are stored bare, with no type tag beside them: the Python class of
+# a value is its tag. A string is bytes, or an int when it is the canonical
+# decimal form of a 64-bit integer (Redis's OBJ_ENCODING_INT); a hash is a
+# HashListpack while small and a dict once it outgrows EncodingLimits, and
+# a sorted set likewise a ZsetListpack or a SortedSet. A set of integers is
+# an IntSet until it grows too big or takes another member, then a set.
+TYPE_NAMES = {bytes: 'string', int: 'string', deque: 'list', Stream: 'stream', HashListpack: 'hash', dict: 'hash',
+              ZsetListpack: 'zset', SortedSet: 'zset', IntSet: 'set', set: 'set'}
+
+def now_ms():
+    return int(time.time() * 1000)
+
+# How to take a private copy of a value that may be changed in place; None for immutable ones.
+VALUE_COPIERS = {
+    bytes: None,
+    int: None,
+    deque: deque,
+    Stream: lambda stream: stream.copy(),
+    HashListpack: HashListpack,
+    dict: dict,
+    ZsetListpack: ZsetListpack,
+    SortedSet: lambda zset: zset.copy(),
+    IntSet: lambda intset: intset.copy(),
+    set: set,
+}
+
+def type_name(value):
+    return TYPE_NAMES[type(value)]
+
+def copy_value(value):
+    copier = VALUE_COPIERS[type(value)]
+    return value if copier is None else copier(value)
+
+def shared_integer(n):
+    """Returns one shared object for each of 0..SHARED_INTEGERS-1, so small counters cost no memory of their own."""
+    return SHARED_INTEGER_OBJECTS[n] if 0 <= n < SHARED_INTEGERS else n
+
+def encode_string(value):
+    """The stored form of string `value`: an int if it round-trips through one exactly, else the bytes themselves."""
+    if 0 < len(value) <= 20 and (value.isdigit() or (value[0] == 45 and value[1:].isdigit())):
+        number = int(value)
+        if INT64_MIN <= number <= INT64_MAX and b"%d" % number == value:
+            return shared_integer(number)
+    return value
+
+def string_bytes(value):
+    return b"%d" % value if type(value) is int else value
+
+def free_effort(value):
+    """Roughly how many objects freeing `value` releases, as Redis's lazyfreeGetFreeEffort() estimates it."""
+    if type(value) in (bytes, int, IntSet):
+        return 1
+    if type(value) is SortedSet:
+        return value.card()
+    return len(value)
+
+class EncodingLimits:
+    """Sizes up to which values keep their compact encoding (Redis's *-max-listpack-* and set-max-intset-entries)."""
+    __slots__ = ("hash_max_listpack_entries", "hash_max_listpack_value",
+                 "zset_max_listpack_entries", "zset_max_listpack_value", "set_max_intset_entries")
+
+    def __init__(self, hash_max_listpack_entries=DEFAULT_HASH_MAX_LISTPACK_ENTRIES,
+                 hash_max_listpack_value=DEFAULT_HASH_MAX_LISTPACK_VALUE,
+                 zset_max_listpack_entries=DEFAULT_ZSET_MAX_LISTPACK_ENTRIES,
+                 zset_max_listpack_value=DEFAULT_ZSET_MAX_LISTPACK_VALUE,
+                 set_max_intset_entries=DEFAULT_SET_MAX_INTSET_ENTRIES):
+        self.hash_max_listpack_entries = hash_max_listpack_entries
+        self.hash_max_listpack_value = hash_max_listpack_value
+        self.zset_max_listpack_entries = zset_max_listpack_entries
+        self.zset_max_listpack_value = zset_max_listpack_value
+        self.set_max_intset_entries = set_max_intset_entries
+
+class NullLock:
+    """Stands in for the keyspace lock when every command runs on one event loop thread."""
+    def acquire(self, blocking=True, timeout=-1):
+        return True
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+class MultiLock:
+    """Holds several shard locks at once, acquired in shard order so multi-key commands can't deadlock."""
+    __slots__ = ("locks",)
+
+    def __init__(self, locks):
+        self.locks = locks
+
+    def __enter__(self):
+        for lock in self.locks:
+            lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        for lock in reversed(self.locks):
+            lock.release()
+        return False
+
+class WriteGate:
+    """
+    Brackets each write command together with its replication propagation.
+    Any number of writers pass at once; `exclusive()` waits for those in
+    flight to finish and holds new ones back, so a snapshot started inside it
+    matches exactly one replication offset.
+    """
+    __slots__ = ("condition", "active", "closed")
 
-class RedisDataStore:
     def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.active = 0
+        self.closed = False
+
+    def __enter__(self):
+        with self.condition:
+            while self.closed:
+                self.condition.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.active -= 1
+            if self.closed and not self.active:
+                self.condition.notify_all()
+        return False
+
+    @contextmanager
+    def exclusive(self):
+        with self.condition:
+            while self.closed:
+                self.condition.wait()
+            self.closed = True
+            while self.active:
+                self.condition.wait()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.closed = False
+                self.condition.notify_all()
+
+class KeyWaiter:
+    """
+    One blocked client, registered on every key it waits for. `is_ready(key)`
+    is checked under that key's shard lock before `wake()` is called, so a
+    write only wakes the waiters it can actually serve. `signalled` is set on
+    wake and cleared by the client before it retries.
+    """
+    __slots__ = ("keys", "is_ready", "wake", "signalled")
+
+    def __init__(self, keys, is_ready, wake):
+        self.keys = list(dict.fromkeys(keys))
+        self.is_ready = is_ready
+        self.wake = wake
+        self.signalled = False
+
+class ShardCapture:
+    """
+    One shard's part of a snapshot in progress, copied on write. Until the
+    snapshot gets to the shard, the first write to a key saves the value and
+    TTL it had before in `saved`. `start()` then takes a shallow copy of the
+    shard, patched with `saved`, as `pending`; from there on a write only
+    copies the value if `pending` still shares it with the live shard.
+    `take_batch()` hands the snapshot its keys a batch at a time. `lock` is a
+    real lock even in asyncio mode, since snapshots are read on other
+    threads; nothing that holds it takes any other lock.
+    """
+    __slots__ = ("shard", "lock", "saved", "saved_expires", "pending", "pending_expires")
+
+    def __init__(self, shard):
+        self.shard = shard
+        self.lock = threading.Lock()
+        self.saved = {}
+        self.saved_expires = {}
+        self.pending = None
+        self.pending_expires = None
+
+    def preserve(self, key, detached):
+        """Keeps what the snapshot needs of `key` before a write; `detached` means the old value leaves the keyspace unchanged."""
+        with self.lock:
+            shard = self.shard
+            if self.pending is None:
+                if key not in self.saved:
+                    value = shard.data.get(key)
+                    self.saved[key] = value if detached or value is None else copy_value(value)
+                    self.saved_expires[key] = shard.expires.get(key)
+            elif not detached:
+                value = self.pending.get(key)
+                if value is not None and value is shard.data.get(key):
+                    self.pending[key] = copy_value(value)
+
+    def start(self):
+        """Caller holds `lock`."""
+        pending = self.shard.data.copy()
+        pending_expires = self.shard.expires.copy()
+        for key, value in self.saved.items():
+            if value is None:
+                pending.pop(key, None)
+            else:
+                pending[key] = value
+        for key, expiry_ms in self.saved_expires.items():
+            if expiry_ms is None:
+                pending_expires.pop(key, None)
+            else:
+                pending_expires[key] = expiry_ms
+        self.pending, self.pending_expires = pending, pending_expires
+        self.saved = self.saved_expires = None
+
+    def take_batch(self):
+        """
+        Removes keys from the capture until about SNAPSHOT_BATCH_EFFORT
+        objects' worth are taken and returns them as (key, value, expiry_ms)
+        triples, with values no write can change any more; [] once done.
+        """
+        with self.lock:
+            if self.pending is None:
+                self.start()
+            pending, pending_expires, live = self.pending, self.pending_expires, self.shard.data
+            batch = []
+            effort = 0
+            while pending and effort < SNAPSHOT_BATCH_EFFORT:
+                key, value = pending.popitem()
+                if value is live.get(key):
+                    value = copy_value(value)
+                batch.append((key, value, pending_expires.get(key)))
+                effort += free_effort(value)
+            return batch
+
+class Shard:
+    """`type_counts` counts the keys holding each value class, kept up to date by every write so INFO only has to add them up."""
+    __slots__ = ("index", "data", "expires", "expiry_heap", "waiters", "lock", "captures", "type_counts")
+
+    def __init__(self, index, lock_factory):
+        self.index = index
         self.data = {}
-        self.blocking_conditions = {}
-        self.lock = threading.RLock()
+        self.expires = {}
+        self.expiry_heap = []
+        self.waiters = {}
+        self.lock = lock_factory()
+        self.captures = ()
+        self.type_counts = {}
+
+    def count_replaced(self, old, value):
+        """Updates `type_counts` for a key going from `old` to `value`, either of which may be None for no key."""
+        if type(old) is not type(value):
+            type_counts = self.type_counts
+            if old is not None:
+                type_counts[type(old)] -= 1
+            if value is not None:
+                type_counts[type(value)] = type_counts.get(type(value), 0) + 1
+
+    def preserve(self, key, detached=False):
+        """Called with `lock` held before `key` is written, while any snapshot is capturing this shard."""
+        for capture in self.captures:
+            capture.preserve(key, detached)
+
+class RedisDataStore:
+    """
+    The keyspace, split into `num_shards` shards by key hash. Each shard owns
+    its dict, its lock and its registry of blocked clients, so commands on
+    keys in different shards never contend. With the default single shard
+    this behaves like one dict behind one lock. `limits` (an EncodingLimits)
+    decides when small values switch to their general encoding.
+    `on_expire(keys)`, if set, is called with the shard lock still held
+    whenever keys are deleted for having expired, so a master can propagate
+    the deletion before any later write to them.
+    """
+    def __init__(self, num_shards=1, lock_factory=threading.RLock, limits=None):
+        if num_shards < 1:
+            raise ValueError("num_shards must be at least 1")
+        self.limits = limits if limits is not None else EncodingLimits()
+        self.shards = [Shard(i, lock_factory) for i in range(num_shards)]
+        self.num_shards = num_shards
+        self.write_gate = WriteGate()
+        self._expire_cursor = 0
+        self._lazyfree_queue = None
+        self._lazyfree_lock = threading.Lock()
+        self._capture_lock = threading.Lock()
+        self.on_expire = None
+
+    def shard_for(self, key):
+        if self.num_shards == 1:
+            return self.shards[0]
+        return self.shards[hash(key) % self.num_shards]
+
+    def key_lock(self, key):
+        return self.shard_for(key).lock
+
+    def locks_for(self, keys):
+        if self.num_shards == 1:
+            return self.shards[0].lock
+        indexes = sorted({hash(key) % self.num_shards for key in keys})
+        if len(indexes) == 1:
+            return self.shards[indexes[0]].lock
+        return MultiLock([self.shards[i].lock for i in indexes])
+
+    def all_locks(self):
+        if self.num_shards == 1:
+            return self.shards[0].lock
+        return MultiLock([shard.lock for shard in self.shards])
 
     def get_item(self, key):
-        item = self.data.get(key)
-        if not item:
+        shard = self.shard_for(key)
+        item = shard.data.get(key)
+        if item is None:
             return None
-        
-        if item[0] == 'string':
-            _value, expiry_ms = item[1]
-            if expiry_ms is not None and int(time.time() * 1000) > expiry_ms:
-                if key in self.data: del self.data[key]
+
+        if shard.expires:
+            expiry_ms = shard.expires.get(key)
+            if expiry_ms is not None and now_ms() > expiry_ms:
+                if shard.captures:
+                    shard.preserve(key, True)
+                del shard.data[key]
+                del shard.expires[key]
+                shard.count_replaced(item, None)
+                if self.on_expire is not None:
+                    self.on_expire([key])
                 return None
+        if shard.captures:
+            # The caller may change the value in place.
+            shard.preserve(key)
         return item
 
     def set_item(self, key, value):
-        self.data[key] = value
+        shard = self.shard_for(key)
+        old = shard.data.get(key)
+        if shard.captures:
+            shard.preserve(key, old is not value)
+        shard.data[key] = value
+        if type(old) is not type(value):
+            shard.count_replaced(old, value)
 
-    def get_condition_for_key(self, key):
-        with self.lock:
-            if key not in self.blocking_conditions:
-                self.blocking_conditions[key] = threading.Condition(self.lock)
-            return self.blocking_conditions[key]
+    def delete_item(self, key):
+        shard = self.shard_for(key)
+        if shard.captures:
+            shard.preserve(key, True)
+        shard.expires.pop(key, None)
+        old = shard.data.pop(key, None)
+        shard.count_replaced(old, None)
+        return old is not None
 
-    def notify_waiters(self, key, notify_all=False):
-        with self.lock:
-            if key in self.blocking_conditions:
-                condition = self.blocking_conditions[key]
-                if notify_all:
-                    condition.notify_all()
+    def pop_item(self, key):
+        """Removes `key` and returns its value, or None if it was missing or expired."""
+        shard = self.shard_for(key)
+        if key not in shard.data:
+            return None
+        if shard.captures:
+            shard.preserve(key, True)
+        value = shard.data.pop(key)
+        shard.count_replaced(value, None)
+        expiry_ms = shard.expires.pop(key, None)
+        if expiry_ms is not None and now_ms() > expiry_ms:
+            return None
+        return value
+
+    def free_later(self, values):
+        """
+        Hands `values` to a background thread to drop, if any of them holds
+        more than LAZYFREE_THRESHOLD objects, so the caller (UNLINK) doesn't
+        pay for freeing big collections on its own path.
+        """
+        if not any(free_effort(value) > LAZYFREE_THRESHOLD for value in values):
+            return
+        with self._lazyfree_lock:
+            if self._lazyfree_queue is None:
+                self._lazyfree_queue = queue.SimpleQueue()
+                threading.Thread(target=run_lazyfree, args=(self._lazyfree_queue,), daemon=True).start()
+        self._lazyfree_queue.put(values)
+
+    def get_expiry(self, key):
+        return self.shard_for(key).expires.get(key)
+
+    def set_expiry(self, key, expiry_ms):
+        shard = self.shard_for(key)
+        if shard.captures:
+            shard.preserve(key)
+        if expiry_ms is None:
+            shard.expires.pop(key, None)
+            return
+        shard.expires[key] = expiry_ms
+        heapq.heappush(shard.expiry_heap, (expiry_ms, key))
+        if len(shard.expiry_heap) > 2 * len(shard.expires) + EXPIRY_HEAP_SLACK:
+            shard.expiry_heap = [(when, k) for k, when in shard.expires.items()]
+            heapq.heapify(shard.expiry_heap)
+
+    def load_items(self, items, replace=True):
+        """
+        Bulk-inserts (key, item, expiry_ms or None) triples under one
+        acquisition of every shard lock; with `replace=False`, keys that
+        already exist are left alone. Returns the number of keys written.
+        """
+        written = 0
+        with self.all_locks():
+            for key, item, expiry_ms in items:
+                shard = self.shard_for(key)
+                if not replace and key in shard.data:
+                    continue
+                if shard.captures:
+                    shard.preserve(key, True)
+                written += 1
+                shard.count_replaced(shard.data.get(key), item)
+                shard.data[key] = item
+                if expiry_ms is None:
+                    shard.expires.pop(key, None)
+                else:
+                    shard.expires[key] = expiry_ms
+                    heapq.heappush(shard.expiry_heap, (expiry_ms, key))
+        return written
+
+    def clear(self):
+        with self.all_locks():
+            for shard in self.shards:
+                # Snapshots that haven't got to the shard yet take their copy now, before the keys go.
+                for capture in shard.captures:
+                    with capture.lock:
+                        if capture.pending is None:
+                            capture.start()
+                shard.data.clear()
+                shard.expires.clear()
+                shard.expiry_heap.clear()
+                shard.type_counts.clear()
+
+    def begin_capture(self):
+        """
+        Starts a ShardCapture on every shard and returns them. Call it with
+        the write gate held exclusively, so together they hold the keyspace
+        as of one instant; it costs O(shards), whatever the keyspace size.
+        """
+        captures = [ShardCapture(shard) for shard in self.shards]
+        with self._capture_lock:
+            for shard, capture in zip(self.shards, captures):
+                shard.captures += (capture,)
+        return captures
+
+    def end_capture(self, capture):
+        shard = capture.shard
+        with self._capture_lock:
+            shard.captures = tuple(other for other in shard.captures if other is not capture)
+
+    def keyspace_stats(self):
+        """Returns (keys, keys with a TTL, {type name: keys}) from each shard's counters, in O(shards)."""
+        keys = expires = 0
+        type_counts = {}
+        for shard in self.shards:
+            with shard.lock:
+                keys += len(shard.data)
+                expires += len(shard.expires)
+                for value_type, count in shard.type_counts.items():
+                    if count:
+                        name = TYPE_NAMES[value_type]
+                        type_counts[name] = type_counts.get(name, 0) + count
+        return keys, expires, type_counts
+
+    def blocked_clients(self):
+        waiters = set()
+        for shard in self.shards:
+            with shard.lock:
+                for key_waiters in shard.waiters.values():
+                    waiters.update(key_waiters)
+        return len(waiters)
+
+    def active_expire_cycle(self, time_limit_ms=ACTIVE_EXPIRE_CYCLE_TIME_LIMIT_MS):
+        """
+        Reclaims keys whose TTL has passed, popping them off each shard's
+        expiry heap in batches of ACTIVE_EXPIRE_CYCLE_KEYS_PER_LOOP so a shard
+        lock is never held for long, and stops once `time_limit_ms` is spent.
+        Heap entries whose key was since deleted or given a new TTL are
+        dropped as they surface. Returns the number of keys expired.
+        """
+        deadline = time.monotonic() + time_limit_ms / 1000.0
+        expired = 0
+        for offset in range(self.num_shards):
+            shard = self.shards[(self._expire_cursor + offset) % self.num_shards]
+            while True:
+                with shard.lock:
+                    heap, expires = shard.expiry_heap, shard.expires
+                    now = now_ms()
+                    batch_done = True
+                    expired_keys = []
+                    for _ in range(ACTIVE_EXPIRE_CYCLE_KEYS_PER_LOOP):
+                        if not heap or heap[0][0] > now:
+                            break
+                        expiry_ms, key = heapq.heappop(heap)
+                        if expires.get(key) == expiry_ms:
+                            if shard.captures:
+                                shard.preserve(key, True)
+                            del expires[key]
+                            shard.count_replaced(shard.data.pop(key, None), None)
+                            expired_keys.append(key)
+                    else:
+                        batch_done = False
+                    if expired_keys:
+                        expired += len(expired_keys)
+                        if self.on_expire is not None:
+                            self.on_expire(expired_keys)
+                if batch_done:
+                    break
+                if time.monotonic() >= deadline:
+                    self._expire_cursor = (self._expire_cursor + offset) % self.num_shards
+                    return expired
+        self._expire_cursor = (self._expire_cursor + 1) % self.num_shards
+        return expired
+
+    def add_waiter(self, keys, is_ready, wake):
+        waiter = KeyWaiter(keys, is_ready, wake)
+        for key in waiter.keys:
+            shard = self.shard_for(key)
+            with shard.lock:
+                shard.waiters.setdefault(key, deque()).append(waiter)
+        return waiter
+
+    def remove_waiter(self, waiter):
+        """
+        Unregisters `waiter` from all its keys. Whatever it was woken for may
+        have gone unused (it was served by another key, or gave up), so the
+        next waiter in line on each key gets a chance at it.
+        """
+        for key in waiter.keys:
+            shard = self.shard_for(key)
+            with shard.lock:
+                waiters = shard.waiters.get(key)
+                if waiters is None:
+                    continue
+                try:
+                    waiters.remove(waiter)
+                except ValueError:
+                    pass
+                if waiters:
+                    self.notify_waiters(key, count=1)
                 else:
-                    condition.notify()
-                if not getattr(condition, '_waiters', True):
-                    del self.blocking_conditions[key]
\ No newline at end of file
+                    del shard.waiters[key]
+
+    def notify_waiters(self, key, count=None):
+        """Wakes up to `count` (all if None) of the waiters on `key` that it can serve, oldest first."""
+        shard = self.shard_for(key)
+        with shard.lock:
+            waiters = shard.waiters.get(key)
+            if not waiters:
+                return
+            for waiter in waiters:
+                if waiter.signalled or not waiter.is_ready(key):
+                    continue
+                waiter.signalled = True
+                waiter.wake()
+                if count is not None:
+                    count -= 1
+                    if count <= 0:
+                        break
+
+def run_lazyfree(values_queue):
+    while True:
+        values = values_queue.get()
+        del values
+
+def run_active_expiry(datastore, latency_monitor, hz=ACTIVE_EXPIRE_HZ):
+    while True:
+        started = time.perf_counter_ns()
+        datastore.active_expire_cycle()
+        latency_monitor.measure("expire-cycle", started)
+        time.sleep(1.0 / hz)
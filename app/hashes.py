@@ -0,0 +1,87 @@
+from itertools import islice
+
+DEFAULT_HASH_MAX_LISTPACK_ENTRIES = 128
+DEFAULT_HASH_MAX_LISTPACK_VALUE = 64
+
+class HashListpack(list):
+    """
+    A small hash packed as one flat [field, value, field, value, ...] list,
+    like Redis's listpack encoding: no per-field hash table, so a hash of a
+    few fields costs about as much as the list itself. Lookups scan the
+    fields, which is cheap while the hash stays within the encoding limits;
+    past them it is converted to a dict for good.
+    """
+    __slots__ = ()
+
+    def field_index(self, field):
+        """Index of `field` in the list, or -1; a value equal to it is skipped."""
+        i = 0
+        try:
+            while True:
+                i = self.index(field, i)
+                if not i & 1:
+                    return i
+                i += 1
+        except ValueError:
+            return -1
+
+def hash_len(h):
+    return len(h) >> 1 if type(h) is HashListpack else len(h)
+
+def hash_get(h, field):
+    if type(h) is not HashListpack:
+        return h.get(field)
+    i = h.field_index(field)
+    return h[i + 1] if i >= 0 else None
+
+def hash_set(h, field, value):
+    """Sets `field` in either encoding; returns True if the field is new."""
+    if type(h) is not HashListpack:
+        is_new = field not in h
+        h[field] = value
+        return is_new
+    i = h.field_index(field)
+    if i >= 0:
+        h[i + 1] = value
+        return False
+    h += (field, value)
+    return True
+
+def hash_delete(h, field):
+    if type(h) is not HashListpack:
+        return h.pop(field, None) is not None
+    i = h.field_index(field)
+    if i < 0:
+        return False
+    del h[i:i + 2]
+    return True
+
+def hash_items(h):
+    if type(h) is HashListpack:
+        return zip(islice(h, 0, None, 2), islice(h, 1, None, 2))
+    return h.items()
+
+def hash_flat(h):
+    """A new [field, value, ...] list of the hash's contents."""
+    if type(h) is HashListpack:
+        return list(h)
+    return [item for pair in h.items() for item in pair]
+
+def fits_listpack(limits, strings):
+    max_value = limits.hash_max_listpack_value
+    return all(len(s) <= max_value for s in strings)
+
+def convert_if_needed(h, limits, strings=()):
+    """
+    Returns `h`, or a dict with its fields if it is a listpack that has more
+    than hash_max_listpack_entries fields or is about to take one of
+    `strings` longer than hash_max_listpack_value bytes.
+    """
+    if type(h) is HashListpack and (len(h) > 2 * limits.hash_max_listpack_entries or
+                                    not fits_listpack(limits, strings)):
+        return dict(hash_items(h))
+    return h
+
+def new_hash(flat, limits):
+    """Builds a hash from a flat [field, value, ...] list of unique fields, in whichever encoding its size calls for."""
+    return convert_if_needed(HashListpack(flat), limits, flat)
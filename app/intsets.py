@@ -0,0 +1,68 @@
+from array import array
+from bisect import bisect_left
+
+DEFAULT_SET_MAX_INTSET_ENTRIES = 512
+
+class IntSet(array):
+    """
+    A set whose members are all 64-bit integers, kept as a sorted array of
+    packed int64s like Redis's intset encoding: 8 bytes a member instead of
+    a bytes object plus a hash table slot. Lookups are binary searches and
+    inserts move the array's tail, so past set-max-intset-entries members, or
+    on the first non-integer member, it is converted to a set of bytes.
+    """
+    __slots__ = ()
+
+    def __new__(cls, values=()):
+        return super().__new__(cls, 'q', values)
+
+    def contains(self, n):
+        i = bisect_left(self, n)
+        return i < len(self) and self[i] == n
+
+    def add(self, n):
+        """Returns True if `n` was not a member yet."""
+        i = bisect_left(self, n)
+        if i < len(self) and self[i] == n:
+            return False
+        self.insert(i, n)
+        return True
+
+    def discard(self, n):
+        i = bisect_left(self, n)
+        if i < len(self) and self[i] == n:
+            del self[i]
+            return True
+        return False
+
+    def copy(self):
+        copied = IntSet()
+        copied.extend(self)
+        return copied
+
+# Set code passes members around encoded the way strings are stored
+# (datastore.encode_string): an int when the member is a canonical 64-bit
+# integer, else bytes. A set of bytes holds them all as bytes.
+
+def member_bytes(member):
+    return b"%d" % member if type(member) is int else member
+
+def set_contains(s, member):
+    if type(s) is IntSet:
+        return type(member) is int and s.contains(member)
+    return member_bytes(member) in s
+
+def set_members(s):
+    """Members of either encoding as bytes, for replies and the AOF."""
+    if type(s) is IntSet:
+        return [b"%d" % n for n in s]
+    return list(s)
+
+def to_hash_set(s):
+    return {b"%d" % n for n in s} if type(s) is IntSet else s
+
+def new_set(members, limits):
+    """Builds a set from distinct encoded `members`: an IntSet if they are all integers and few enough, else a set of bytes."""
+    if len(members) <= limits.set_max_intset_entries and all(type(member) is int for member in members):
+        return IntSet(sorted(members))
+    return {member_bytes(member) for member in members}
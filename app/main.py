@@ -1,285 +1,374 @@
+import os
 import socket
 import threading
 import argparse
 import time
-from .datastore import RedisDataStore
-from .command_handler import handle_command, WRITE_COMMANDS, handle_xread
+from .datastore import RedisDataStore, NullLock, EncodingLimits, run_active_expiry
+from .command_handler import handle_command, handle_blocking_command, argument_error, WRITE_COMMANDS, BLOCKING_COMMANDS
 from . import protocol
+from . import replication
+from . import rdb
+from . import aof
+from . import stats
+from . import hashes
+from . import zsets
+from . import intsets
+from .resp import RespParser, ProtocolError
+from .aio_server import serve_asyncio
 
-EMPTY_RDB_HEX = "524544495330303131fa0972656469732d76657205372e322e30fa0a72656469732d62697473c040fa056374696d65c26d08bc65fa08757365642d6d656dc226404000fa0c616f662d707265616d626c65c000fffe00f7e03ac95225"
-EMPTY_RDB_CONTENT = bytes.fromhex(EMPTY_RDB_HEX)
-
-def parse_commands_from_buffer(buffer):
-    """
-    Parses multiple commands from a stream buffer.
-    Returns a list of raw command byte strings and the remaining, unprocessed buffer.
-    """
-    commands = []
-    current_pos = 0
-    while current_pos < len(buffer):
-        start_pos = current_pos
-        if not buffer[start_pos:].startswith(b'*'):
-            break
-        
-        crlf1 = buffer.find(b'\r\n', start_pos)
-        if crlf1 == -1: break
+def execute_write(cmd, datastore, server_state):
+    """Runs a WRITE_COMMANDS entry and propagates it inside the write gate, so snapshots never split the two."""
+    with datastore.write_gate:
+        response = handle_command(cmd, datastore, server_state)
+        if server_state["role"] == "master":
+            replication.propagate_write(server_state, cmd.raw)
+    return response
 
-        try:
-            num_elements = int(buffer[start_pos+1:crlf1])
-            current_pos = crlf1 + 2
-
-            for _ in range(num_elements):
-                if not buffer[current_pos:].startswith(b'$'): raise ValueError("Expected bulk string prefix")
-                crlf2 = buffer.find(b'\r\n', current_pos)
-                if crlf2 == -1: raise ValueError("Incomplete bulk string length")
-                length = int(buffer[current_pos+1:crlf2])
-                
-                data_start = crlf2 + 2
-                data_end = data_start + length
-                
-                if len(buffer) < data_end + 2: raise ValueError("Incomplete bulk string data")
-                
-                current_pos = data_end + 2
-
-            commands.append(buffer[start_pos:current_pos])
-        except (ValueError, IndexError):
-            break
-            
-    return commands, buffer[current_pos:]
+def send_replies(client_socket, replies, server_state, wrote):
+    """Sends a batch of replies; under appendfsync always, only once the writes among them are on disk."""
+    if wrote and server_state["aof"] is not None:
+        server_state["aof"].wait_synced()
+    protocol.send_replies(client_socket, replies)
+
+def send_sync_reply(client_socket, response_bytes, snapshot):
+    """Sends the PSYNC reply and, for a full resync, the RDB; the snapshot is released even if the replica goes away."""
+    try:
+        client_socket.sendall(response_bytes)
+        if snapshot is not None:
+            for chunk in rdb.transfer_chunks(*rdb.encode_snapshot(snapshot)):
+                client_socket.sendall(chunk)
+    finally:
+        if snapshot is not None:
+            snapshot.release()
 
 def handle_client(client_socket, client_address, datastore, server_state):
     print(f"Connect from {client_address}")
+    server_stats = server_state["stats"]
+    server_stats.client_connected()
     in_transaction = False
     transaction_queue = []
-    is_replica = False
+    replica = None
+    parser = RespParser(client=f"{client_address[0]}:{client_address[1]}")
 
     try:
         while True:
-            request_bytes = client_socket.recv(1024)
+            request_bytes = client_socket.recv(65536)
             if not request_bytes: break
+            server_stats.add_input_bytes(len(request_bytes))
 
-            parts = request_bytes.strip().split(b'\r\n')
-            if not parts or len(parts) < 3: continue
-            
-            command_name = parts[2].decode().upper()
-
-            if in_transaction and command_name not in ["EXEC", "DISCARD", "MULTI"]:
-                transaction_queue.append((parts, request_bytes))
-                client_socket.sendall(protocol.format_simple_string("QUEUED"))
-                continue
-
-            if command_name == "MULTI":
-                in_transaction = True
-                transaction_queue = []
-                client_socket.sendall(protocol.format_simple_string("OK"))
-            elif command_name == "EXEC":
-                if not in_transaction:
-                    client_socket.sendall(protocol.format_error("EXEC without MULTI"))
-                else:
-                    responses = []
-                    bytes_to_propagate = []
-                    for queued_parts, original_bytes in transaction_queue:
-                        responses.append(handle_command(queued_parts, datastore, server_state))
-                        if queued_parts[2].decode().upper() in WRITE_COMMANDS:
-                            bytes_to_propagate.append(original_bytes)
-                    
-                    if server_state["role"] == "master":
-                        for original_bytes in bytes_to_propagate:
-                            server_state["master_repl_offset"] += len(original_bytes)
-                            with server_state["ack_condition"]:
-                                for replica_socket in server_state["replicas"]:
-                                    replica_socket.sendall(original_bytes)
-
-                    client_socket.sendall(protocol.format_array(responses))
-                    in_transaction = False
-                    transaction_queue = []
-            elif command_name == "DISCARD":
-                if not in_transaction:
-                    client_socket.sendall(protocol.format_error("DISCARD without MULTI"))
-                else:
-                    in_transaction = False
-                    transaction_queue = []
-                    client_socket.sendall(protocol.format_simple_string("OK"))
-            elif command_name == "REPLCONF":
-                if len(parts) > 5 and parts[4].decode().upper() == "ACK":
-                    ack_offset = int(parts[6].decode())
-                    with server_state["ack_condition"]:
-                        server_state["replica_acks"][client_socket] = ack_offset
-                else:
-                    client_socket.sendall(handle_command(parts, datastore, server_state))
-            elif command_name == "WAIT":
-                num_replicas_to_wait_for = int(parts[4].decode())
-                timeout_ms = int(parts[6].decode())
-                wait_offset = server_state["master_repl_offset"]
+            parser.feed(request_bytes)
+            try:
+                commands = parser.parse_commands()
+            except ProtocolError as e:
+                client_socket.sendall(protocol.format_error(f"Protocol error: {e}"))
+                break
+            replies = []
+            wrote = False
 
-                with server_state["ack_condition"]:
-                    acked_replicas = sum(1 for offset in server_state["replica_acks"].values() if offset >= wait_offset)
+            for cmd in commands:
+                command_name = cmd.name
 
-                if acked_replicas >= num_replicas_to_wait_for:
-                    client_socket.sendall(protocol.format_integer(acked_replicas))
+                if in_transaction and command_name not in ["EXEC", "DISCARD", "MULTI"]:
+                    transaction_queue.append(cmd)
+                    replies.append(protocol.format_simple_string("QUEUED"))
                     continue
 
-                with server_state["ack_condition"]:
-                    if server_state["replicas"]:
-                        getack_command = protocol.format_array([
-                            protocol.format_bulk_string(b"REPLCONF"),
-                            protocol.format_bulk_string(b"GETACK"),
-                            protocol.format_bulk_string(b"*")
-                        ])
-                        for replica_socket in server_state["replicas"]:
-                            try:
-                                replica_socket.sendall(getack_command)
-                            except OSError: pass
-
-                start_time = time.time()
-                while True:
-                    with server_state["ack_condition"]:
-                        acked_replicas = sum(1 for offset in server_state["replica_acks"].values() if offset >= wait_offset)
-                    
+                # Commands dispatched through handle_command record their own stats; the ones handled here are timed from `started`.
+                started = time.perf_counter_ns()
+                if command_name == "MULTI":
+                    in_transaction = True
+                    transaction_queue = []
+                    replies.append(protocol.format_simple_string("OK"))
+                    server_stats.record(cmd, started)
+                elif command_name == "EXEC":
+                    if not in_transaction:
+                        replies.append(protocol.format_error("EXEC without MULTI"))
+                    else:
+                        responses = []
+                        for queued_cmd in transaction_queue:
+                            if queued_cmd.name in WRITE_COMMANDS:
+                                responses.append(execute_write(queued_cmd, datastore, server_state))
+                                wrote = True
+                            else:
+                                responses.append(handle_command(queued_cmd, datastore, server_state))
+
+                        replies.append(protocol.format_array_reply(responses))
+                        in_transaction = False
+                        transaction_queue = []
+                        server_stats.latency_monitor.measure("exec", started)
+                        server_stats.record(cmd, started)
+                elif command_name == "DISCARD":
+                    if not in_transaction:
+                        replies.append(protocol.format_error("DISCARD without MULTI"))
+                    else:
+                        in_transaction = False
+                        transaction_queue = []
+                        replies.append(protocol.format_simple_string("OK"))
+                        server_stats.record(cmd, started)
+                elif command_name == "REPLCONF":
+                    if len(cmd.argv) > 2 and cmd.argv[1].upper() == b"ACK":
+                        if replica is not None and cmd.argv[2].isdigit():
+                            replication.record_replica_ack(server_state, replica, int(cmd.argv[2]))
+                        server_stats.record(cmd, started)
+                    else:
+                        replies.append(handle_command(cmd, datastore, server_state))
+                elif command_name == "WAIT":
+                    try:
+                        num_replicas_to_wait_for = int(cmd.argv[1])
+                        timeout_ms = int(cmd.argv[2])
+                    except (IndexError, ValueError) as e:
+                        replies.append(argument_error(cmd, e))
+                        continue
+                    wait_offset = server_state["write_offset"]
+
+                    acked_replicas = replication.count_acked_replicas(server_state, wait_offset)
+                    server_stats.record(cmd, started)
                     if acked_replicas >= num_replicas_to_wait_for:
-                        break
-                    
-                    elapsed_ms = (time.time() - start_time) * 1000
-                    if timeout_ms > 0 and elapsed_ms >= timeout_ms:
-                        break
-                    
-                    time.sleep(0.01)
-                
-                client_socket.sendall(protocol.format_integer(acked_replicas))
-
-            elif command_name == "XREAD":
-                response = handle_xread(parts, datastore, server_state, is_blocking_call=True)
-                client_socket.sendall(response)
-
-            else:
-                response = handle_command(parts, datastore, server_state)
-                if response is None: continue 
-
-                if isinstance(response, tuple):
-                    response_bytes, action = response
-                    client_socket.sendall(response_bytes)
-                    if action == "SEND_RDB_FILE":
-                        rdb_response = f"${len(EMPTY_RDB_CONTENT)}\r\n".encode() + EMPTY_RDB_CONTENT
-                        client_socket.sendall(rdb_response)
-                        if server_state["role"] == "master":
-                            is_replica = True
-                            with server_state["ack_condition"]:
-                                server_state["replicas"].append(client_socket)
-                                server_state["replica_acks"][client_socket] = 0
-                else:
-                    client_socket.sendall(response)
+                        replies.append(protocol.format_integer(acked_replicas))
+                        continue
+
+                    if replies:
+                        send_replies(client_socket, replies, server_state, wrote)
+                        replies, wrote = [], False
+                    acked_replicas = replication.wait_for_acks(server_state, wait_offset, num_replicas_to_wait_for, timeout_ms)
+                    replies.append(protocol.format_integer(acked_replicas))
+
+                elif command_name in BLOCKING_COMMANDS:
+                    if replies:
+                        send_replies(client_socket, replies, server_state, wrote)
+                        replies, wrote = [], False
+                    on_reply = None
                     if command_name in WRITE_COMMANDS and server_state["role"] == "master":
-                        server_state["master_repl_offset"] += len(request_bytes)
-                        with server_state["ack_condition"]:
-                            for replica_socket in server_state["replicas"]:
-                                replica_socket.sendall(request_bytes)
+                        on_reply = lambda: replication.propagate_write(server_state, cmd.raw)
+                        wrote = True
+                    replies.append(handle_blocking_command(cmd, datastore, server_state, on_reply))
+
+                elif command_name == "PSYNC":
+                    if len(cmd.argv) != 3:
+                        replies.append(protocol.format_error("wrong number of arguments for 'psync' command"))
+                        continue
+                    if replies:
+                        send_replies(client_socket, replies, server_state, wrote)
+                        replies, wrote = [], False
+                    if server_state["role"] == "master":
+                        replica = replication.ReplicaOutput(client_socket, server_state["replica_output_buffer_limit"])
+                    response_bytes, snapshot = replication.sync_replica(cmd, datastore, server_state, replica)
+                    server_stats.record(cmd, started)
+                    send_sync_reply(client_socket, response_bytes, snapshot)
+                    if replica is not None:
+                        replica.start()
+
+                elif command_name in WRITE_COMMANDS:
+                    replies.append(execute_write(cmd, datastore, server_state))
+                    wrote = True
+
+                else:
+                    response = handle_command(cmd, datastore, server_state)
+                    if response is None: continue
+                    replies.append(response)
+
+            if replies:
+                send_replies(client_socket, replies, server_state, wrote)
 
     except (IndexError, ConnectionResetError, ValueError, OSError):
         pass
     finally:
         print(f"Closing connection from {client_address}")
-        if is_replica:
-            with server_state["ack_condition"]:
-                if client_socket in server_state["replicas"]:
-                    server_state["replicas"].remove(client_socket)
-                if client_socket in server_state["replica_acks"]:
-                    del server_state["replica_acks"][client_socket]
+        server_stats.client_disconnected()
+        server_stats.retire_thread()
+        if replica is not None:
+            replication.remove_replica(server_state, replica)
+            replica.close()
         client_socket.close()
 
 def connect_to_master(server_state, replica_port, datastore):
     master_host, master_port = server_state["master_host"], server_state["master_port"]
-    try:
-        master_socket = socket.create_connection((master_host, master_port))
-        print(f"Connected to master at {master_host}:{master_port}")
-        master_socket.sendall(protocol.format_array([protocol.format_bulk_string(b"PING")]))
-        master_socket.recv(1024)
-        master_socket.sendall(protocol.format_array([protocol.format_bulk_string(b"REPLCONF"), protocol.format_bulk_string(b"listening-port"), protocol.format_bulk_string(str(replica_port).encode())]))
-        master_socket.recv(1024)
-        master_socket.sendall(protocol.format_array([protocol.format_bulk_string(b"REPLCONF"), protocol.format_bulk_string(b"capa"), protocol.format_bulk_string(b"psync2")]))
-        master_socket.recv(1024)
-        master_socket.sendall(protocol.format_array([protocol.format_bulk_string(b"PSYNC"), protocol.format_bulk_string(b"?"), protocol.format_bulk_string(b"-1")]))
-        
-        buffer = b""
+    while True:
+        try:
+            master_socket = socket.create_connection((master_host, master_port))
+            master_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print(f"Connected to master at {master_host}:{master_port}")
+            sync_with_master(master_socket, server_state, replica_port, datastore)
+        except Exception as e:
+            print(f"Error in master connection: {e}")
+        server_state["master_link_status"] = "down"
+        time.sleep(replication.REPLICA_RECONNECT_DELAY_S)
 
+def sync_with_master(master_socket, server_state, replica_port, datastore):
+    with master_socket:
+        *handshake, psync_command = replication.handshake_commands(
+            replica_port, server_state["master_replid"], server_state["master_repl_offset"])
+        for handshake_command in handshake:
+            master_socket.sendall(handshake_command)
+            master_socket.recv(1024)
+        master_socket.sendall(psync_command)
+
+        stream = replication.ReplicationStream(datastore, server_state)
+        master_socket.settimeout(replication.REPLICA_ACK_INTERVAL_S)
+        next_ack_time = time.monotonic() + replication.REPLICA_ACK_INTERVAL_S
+        buffer = bytearray(replication.REPLICA_READ_BUFFER_SIZE)
+        view = memoryview(buffer)
         while True:
-            if b'$' in buffer:
-                rdb_start = buffer.find(b'$') + 1
-                rdb_end_of_length = buffer.find(b'\r\n', rdb_start)
-                if rdb_end_of_length != -1:
-                    rdb_length = int(buffer[rdb_start:rdb_end_of_length])
-                    rdb_data_start = rdb_end_of_length + 2
-                    if len(buffer) >= rdb_data_start + rdb_length:
-                        buffer = buffer[rdb_data_start + rdb_length:]
-                        break
-            data = master_socket.recv(4096)
-            if not data: break
-            buffer += data
-        
-        bytes_processed = 0
-        while True:
-            commands, buffer = parse_commands_from_buffer(buffer)
-            for command_bytes in commands:
-                parts = command_bytes.strip().split(b'\r\n')
-                command_name = parts[2].decode().upper()
-                
-                if command_name == "REPLCONF" and len(parts) > 5 and parts[4].decode().upper() == "GETACK":
-                    ack_response = protocol.format_array([
-                        protocol.format_bulk_string(b"REPLCONF"),
-                        protocol.format_bulk_string(b"ACK"),
-                        protocol.format_bulk_string(str(bytes_processed).encode())
-                    ])
-                    master_socket.sendall(ack_response)
-                else:
-                    handle_command(parts, datastore, server_state)
-                
-                bytes_processed += len(command_bytes)
+            try:
+                received = master_socket.recv_into(buffer)
+                if not received: break
+                ack_bytes = stream.feed(view[:received])
+                if ack_bytes:
+                    master_socket.sendall(ack_bytes)
+            except socket.timeout:
+                pass
+            # Unsolicited ACKs let WAIT on the master complete without a GETACK round trip.
+            if stream.rdb_received and time.monotonic() >= next_ack_time:
+                master_socket.sendall(stream.ack_command())
+                next_ack_time = time.monotonic() + replication.REPLICA_ACK_INTERVAL_S
+
+def serve_threads(args, datastore, server_state):
+    if server_state["role"] == "master":
+        threading.Thread(target=run_active_expiry, args=(datastore, server_state["stats"].latency_monitor), daemon=True).start()
+    threading.Thread(target=stats.run_ops_sampler, args=(server_state["stats"],), daemon=True).start()
+    if server_state["aof"] is not None:
+        threading.Thread(target=aof.run_auto_rewrite, args=(datastore, server_state), daemon=True).start()
+
+    if server_state["role"] == "slave":
+        handshake_thread = threading.Thread(target=connect_to_master, args=(server_state, args.port, datastore))
+        handshake_thread.start()
+
+    server_socket = socket.create_server(("localhost", args.port))
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    print(f"Server listen on localhost {args.port}")
 
-            more_data = master_socket.recv(4096)
-            if not more_data: break
-            buffer += more_data
-            
-    except Exception as e:
-        print(f"Error in master connection: {e}")
+    while True:
+        client_socket, client_address = server_socket.accept()
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_thread = threading.Thread(
+            target=handle_client,
+            args=(client_socket, client_address, datastore, server_state),
+            daemon=True
+        )
+        client_thread.start()
+
+def load_data(args, datastore, server_state):
+    """Loads the AOF if enabled and present, else the RDB; then opens the AOF (seeded with what was loaded) on a master."""
+    rdb_path = os.path.join(args.dir, args.dbfilename)
+    aof_path = os.path.join(args.dir, args.appendfilename)
+    started = time.monotonic()
+    if args.appendonly == "yes" and os.path.exists(aof_path):
+        applied = aof.load_aof(aof_path, datastore, server_state)
+        print(f"DB loaded from append only file: {applied} commands in {time.monotonic() - started:.3f} seconds")
+    elif os.path.exists(rdb_path):
+        loader = rdb.load_file(rdb_path, datastore)
+        print(f"DB loaded from disk: {loader.keys_loaded} keys in {time.monotonic() - started:.3f} seconds")
+        if server_state["role"] == "slave" and b"repl-id" in loader.aux and b"repl-offset" in loader.aux:
+            # Resume from where the snapshot left off: the handshake then asks for PSYNC <replid> <offset+1>.
+            server_state["master_replid"] = loader.aux[b"repl-id"].decode()
+            server_state["master_repl_offset"] = int(loader.aux[b"repl-offset"])
+
+    if args.appendonly == "yes" and server_state["role"] == "master":
+        if not os.path.exists(aof_path):
+            aof.save_dataset(rdb.capture_snapshot(datastore, server_state), aof_path)
+        server_state["aof"] = aof.AppendOnlyFile(aof_path, args.appendfsync, args.auto_aof_rewrite_percentage,
+                                                 args.auto_aof_rewrite_min_size)
 
 def main():
     print("Redis server start...")
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, default=6379)
     parser.add_argument("--replicaof", type=str, help="Start server as a replica of a master.")
+    parser.add_argument("--io-model", choices=["threads", "asyncio"], default="threads",
+                        help="Serve clients with one thread per connection or a single asyncio event loop.")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Split the keyspace into this many independently locked shards.")
+    parser.add_argument("--dir", type=str, default=os.getcwd(), help="Directory for RDB snapshots.")
+    parser.add_argument("--dbfilename", type=str, default="dump.rdb", help="RDB snapshot file name.")
+    parser.add_argument("--appendonly", choices=["yes", "no"], default="no",
+                        help="Log every write to an append-only file and replay it at startup.")
+    parser.add_argument("--appendfilename", type=str, default="appendonly.aof", help="AOF file name, inside --dir.")
+    parser.add_argument("--appendfsync", choices=aof.APPENDFSYNC_POLICIES, default="everysec",
+                        help="When the AOF is fsynced: before each reply, once a second, or when the OS decides.")
+    parser.add_argument("--auto-aof-rewrite-percentage", type=int, default=aof.DEFAULT_AUTO_AOF_REWRITE_PERCENTAGE,
+                        help="Rewrite the AOF once it has grown by this percentage since the last rewrite (0 disables).")
+    parser.add_argument("--auto-aof-rewrite-min-size", type=int, default=aof.DEFAULT_AUTO_AOF_REWRITE_MIN_SIZE,
+                        help="Never rewrite the AOF automatically while it is smaller than this many bytes.")
+    parser.add_argument("--repl-backlog-size", type=int, default=replication.DEFAULT_REPL_BACKLOG_SIZE,
+                        help="Bytes of replication stream kept for partial resynchronization of reconnecting replicas.")
+    parser.add_argument("--replica-output-buffer-limit", type=int,
+                        default=replication.DEFAULT_REPLICA_OUTPUT_BUFFER_LIMIT,
+                        help="Disconnect a replica once this many bytes of stream are queued for it.")
+    parser.add_argument("--slowlog-log-slower-than", type=int, default=stats.DEFAULT_SLOWLOG_LOG_SLOWER_THAN_US,
+                        help="Log commands that take at least this many microseconds to SLOWLOG (negative disables).")
+    parser.add_argument("--slowlog-max-len", type=int, default=stats.DEFAULT_SLOWLOG_MAX_LEN,
+                        help="Keep this many of the most recent SLOWLOG entries.")
+    parser.add_argument("--latency-monitor-threshold", type=int, default=stats.DEFAULT_LATENCY_MONITOR_THRESHOLD_MS,
+                        help="Record internal events taking at least this many milliseconds for LATENCY (0 disables).")
+    parser.add_argument("--hash-max-listpack-entries", type=int, default=hashes.DEFAULT_HASH_MAX_LISTPACK_ENTRIES,
+                        help="Hashes with more fields than this are converted from a packed list to a dict.")
+    parser.add_argument("--hash-max-listpack-value", type=int, default=hashes.DEFAULT_HASH_MAX_LISTPACK_VALUE,
+                        help="Hashes holding a field or value longer than this many bytes are converted to a dict.")
+    parser.add_argument("--zset-max-listpack-entries", type=int, default=zsets.DEFAULT_ZSET_MAX_LISTPACK_ENTRIES,
+                        help="Sorted sets with more members than this are converted from a packed list to a SortedSet.")
+    parser.add_argument("--zset-max-listpack-value", type=int, default=zsets.DEFAULT_ZSET_MAX_LISTPACK_VALUE,
+                        help="Sorted sets holding a member longer than this many bytes are converted to a SortedSet.")
+    parser.add_argument("--set-max-intset-entries", type=int, default=intsets.DEFAULT_SET_MAX_INTSET_ENTRIES,
+                        help="Sets of integers with more members than this are converted from a packed array to a set.")
     args = parser.parse_args()
-    
-    datastore = RedisDataStore()
-    
+
+    limits = EncodingLimits(args.hash_max_listpack_entries, args.hash_max_listpack_value,
+                            args.zset_max_listpack_entries, args.zset_max_listpack_value, args.set_max_intset_entries)
+    if args.io_model == "asyncio":
+        datastore = RedisDataStore(num_shards=args.shards, lock_factory=NullLock, limits=limits)
+    else:
+        datastore = RedisDataStore(num_shards=args.shards, limits=limits)
+
     server_state = {
-        "master_replid": "8371b4fb1155b71f4a04d3e1bc3e18c4a990aeeb",
+        "master_replid": os.urandom(20).hex(),
         "master_repl_offset": 0,
+        "write_offset": 0,
+        "repl_backlog": replication.ReplicationBacklog(max(1, args.repl_backlog_size)),
         "replicas": [],
+        "replica_output_buffer_limit": args.replica_output_buffer_limit,
         "replica_acks": {},
+        "replica_ack_times": {},
         "ack_condition": threading.Condition(),
+        "ack_waiters": [],
+        "acks_requested_offset": -1,
+        "config": {"dir": args.dir, "dbfilename": args.dbfilename,
+                   "appendonly": args.appendonly, "appendfilename": args.appendfilename,
+                   "appendfsync": args.appendfsync,
+                   "auto-aof-rewrite-percentage": str(args.auto_aof_rewrite_percentage),
+                   "auto-aof-rewrite-min-size": str(args.auto_aof_rewrite_min_size),
+                   "repl-backlog-size": str(args.repl_backlog_size),
+                   "replica-output-buffer-limit": str(args.replica_output_buffer_limit),
+                   "slowlog-log-slower-than": str(args.slowlog_log_slower_than),
+                   "slowlog-max-len": str(args.slowlog_max_len),
+                   "latency-monitor-threshold": str(args.latency_monitor_threshold),
+                   "hash-max-listpack-entries": str(args.hash_max_listpack_entries),
+                   "hash-max-listpack-value": str(args.hash_max_listpack_value),
+                   "zset-max-listpack-entries": str(args.zset_max_listpack_entries),
+                   "zset-max-listpack-value": str(args.zset_max_listpack_value),
+                   "set-max-intset-entries": str(args.set_max_intset_entries)},
+        "rdb_bgsave_lock": threading.Lock(),
+        "rdb_last_save_time": int(time.time()),
+        "aof": None,
+        "stats": stats.ServerStats(args.slowlog_log_slower_than, max(0, args.slowlog_max_len),
+                                   args.latency_monitor_threshold),
     }
-    
+
     if args.replicaof:
         server_state["role"] = "slave"
+        server_state["master_replid"] = None
         master_host, master_port = args.replicaof.split()
         server_state["master_host"] = master_host
         server_state["master_port"] = int(master_port)
-        handshake_thread = threading.Thread(target=connect_to_master, args=(server_state, args.port, datastore))
-        handshake_thread.start()
     else:
         server_state["role"] = "master"
-    
-    server_socket = socket.create_server(("localhost", args.port))
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    print(f"Server listen on localhost {args.port}")
-    
-    while True:
-        client_socket, client_address = server_socket.accept()
-        client_thread = threading.Thread(
-            target=handle_client,
-            args=(client_socket, client_address, datastore, server_state),
-            daemon=True
-        )
-        client_thread.start()
+
+    load_data(args, datastore, server_state)
+    datastore.on_expire = lambda keys: replication.propagate_expired(server_state, keys)
+
+    if args.io_model == "asyncio":
+        serve_asyncio(args, datastore, server_state)
+    else:
+        serve_threads(args, datastore, server_state)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,51 +1,152 @@
+CRLF = b"\r\n"
+OK = b"+OK\r\n"
+QUEUED = b"+QUEUED\r\n"
+PONG = b"+PONG\r\n"
+NULL_BULK = b"$-1\r\n"
+NULL_ARRAY = b"*-1\r\n"
+EMPTY_ARRAY = b"*0\r\n"
+
+SHARED_INTEGERS = 10000
+SHARED_HEADERS = 1024
+INTEGER_REPLIES = [b":%d\r\n" % i for i in range(SHARED_INTEGERS)]
+BULK_HEADERS = [b"$%d\r\n" % i for i in range(SHARED_HEADERS)]
+ARRAY_HEADERS = [b"*%d\r\n" % i for i in range(SHARED_HEADERS)]
+SIMPLE_STRING_REPLIES = {"OK": OK, "QUEUED": QUEUED, "PONG": PONG}
+
+# Replies at least GATHER_MIN_BYTES long stay a list of fragments, and
+# fragments at least LARGE_FRAGMENT_BYTES long (big values) are handed to
+# sendmsg() as they are instead of being copied into a joined buffer.
+GATHER_MIN_BYTES = 64 * 1024
+LARGE_FRAGMENT_BYTES = 16 * 1024
+SENDMSG_MAX_BUFFERS = 512
+
+class Gather(list):
+    """A reply kept as its fragments (headers and the values themselves) until the socket write."""
+    __slots__ = ()
+
+def bulk_header(n):
+    return BULK_HEADERS[n] if n < SHARED_HEADERS else b"$%d\r\n" % n
+
+def array_header(n):
+    return ARRAY_HEADERS[n] if n < SHARED_HEADERS else b"*%d\r\n" % n
+
 def format_simple_string(s):
-    return f"+{s}\r\n".encode()
+    reply = SIMPLE_STRING_REPLIES.get(s)
+    return reply if reply is not None else f"+{s}\r\n".encode()
 
 def format_error(s):
     return f"-ERR {s}\r\n".encode()
 
 def format_integer(i):
-    return f":{i}\r\n".encode()
+    if 0 <= i < SHARED_INTEGERS:
+        return INTEGER_REPLIES[i]
+    return b":%d\r\n" % i
 
 def format_bulk_string(b):
     if b is None:
-        return b"$-1\r\n"
-    return f"${len(b)}\r\n".encode() + b + b"\r\n"
+        return NULL_BULK
+    return b"".join((bulk_header(len(b)), b, CRLF))
 
 def format_array(arr_bytes):
     if arr_bytes is None:
-        return b"*-1\r\n"
+        return NULL_ARRAY
     if not arr_bytes:
-        return b"*0\r\n"
-    
-    response_parts = [f"*{len(arr_bytes)}\r\n".encode()]
+        return EMPTY_ARRAY
+
+    response_parts = [array_header(len(arr_bytes))]
     response_parts.extend(arr_bytes)
     return b"".join(response_parts)
 
+def finish_reply(parts):
+    """Joins `parts` into one bytes reply, unless it is big enough to be worth sending as a Gather."""
+    if sum(map(len, parts)) >= GATHER_MIN_BYTES:
+        return Gather(parts)
+    return b"".join(parts)
+
+def add_bulk(parts, value):
+    parts += (bulk_header(len(value)), value, CRLF)
+
+def format_bulk_reply(value):
+    """Like format_bulk_string, but a large value is referenced by the reply instead of copied into it."""
+    if value is None or len(value) < GATHER_MIN_BYTES:
+        return format_bulk_string(value)
+    return Gather((bulk_header(len(value)), value, CRLF))
+
+def format_bulk_array(values):
+    """Array-of-bulk-strings reply (LRANGE, multi-element pops) built without copying large values."""
+    if not values:
+        return EMPTY_ARRAY
+    parts = [array_header(len(values))]
+    for value in values:
+        add_bulk(parts, value)
+    return finish_reply(parts)
+
+def format_array_reply(replies):
+    """Array of already encoded replies, any of which may be a Gather (EXEC)."""
+    parts = [array_header(len(replies))]
+    for reply in replies:
+        if isinstance(reply, Gather):
+            parts.extend(reply)
+        else:
+            parts.append(reply)
+    return finish_reply(parts)
+
+def add_stream_entries(parts, entries):
+    parts.append(array_header(len(entries)))
+    for entry_id_bytes, fields in entries:
+        parts.append(ARRAY_HEADERS[2])
+        add_bulk(parts, entry_id_bytes)
+        parts.append(array_header(len(fields)))
+        for item in fields:
+            add_bulk(parts, item)
+
 def format_stream_range_response(entries):
     if not entries:
-        return b"*0\r\n"
-        
-    response_parts = [f"*{len(entries)}\r\n".encode()]
-    for entry_id_bytes, entry_data in entries:
-        response_parts.append(b'*2\r\n')
-        response_parts.append(format_bulk_string(entry_id_bytes))
-        
-        flat_kv_list = [item for pair in entry_data.items() for item in pair]
-        response_parts.append(f"*{len(flat_kv_list)}\r\n".encode())
-        for item in flat_kv_list:
-            response_parts.append(format_bulk_string(item))
-            
-    return b"".join(response_parts)
+        return EMPTY_ARRAY
+    parts = []
+    add_stream_entries(parts, entries)
+    return finish_reply(parts)
 
 def format_xread_response(results_dict):
     if not results_dict:
-        return format_bulk_string(None)
-    
-    response_parts = [f"*{len(results_dict)}\r\n".encode()]
+        return NULL_BULK
+
+    parts = [array_header(len(results_dict))]
     for key, entries in results_dict.items():
-        response_parts.append(b'*2\r\n')
-        response_parts.append(format_bulk_string(key))
-        response_parts.append(format_stream_range_response(entries))
-    
-    return b"".join(response_parts)
\ No newline at end of file
+        parts.append(ARRAY_HEADERS[2])
+        add_bulk(parts, key)
+        add_stream_entries(parts, entries)
+    return finish_reply(parts)
+
+def gather_buffers(replies):
+    """Flattens replies into the buffer list for one scatter-gather write, joining each run of small fragments."""
+    buffers = []
+    small = []
+    for reply in replies:
+        for part in (reply if isinstance(reply, Gather) else (reply,)):
+            if len(part) < LARGE_FRAGMENT_BYTES:
+                small.append(part)
+                continue
+            if small:
+                buffers.append(b"".join(small))
+                small = []
+            buffers.append(part)
+    if small:
+        buffers.append(b"".join(small))
+    return buffers
+
+def send_replies(sock, replies):
+    """Writes `replies` to a blocking socket with sendmsg(), so large values go out without being copied."""
+    buffers = gather_buffers(replies)
+    if len(buffers) == 1:
+        sock.sendall(buffers[0])
+        return
+    while buffers:
+        sent = sock.sendmsg(buffers[:SENDMSG_MAX_BUFFERS])
+        done = 0
+        while done < len(buffers) and sent >= len(buffers[done]):
+            sent -= len(buffers[done])
+            done += 1
+        del buffers[:done]
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
@@ -0,0 +1,847 @@
+import gc
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from collections import deque
+from .datastore import now_ms, encode_string
+from .hashes import HashListpack, new_hash
+from .intsets import IntSet, new_set
+from .streams import SEQ_MASK, Stream, pack_id
+from .zsets import ZsetListpack, SortedSet, new_zset, format_score
+
+RDB_MAGIC = b"REDIS0011"
+RDB_VERSION_STRING = b"7.2.0"
+RDB_WRITE_CHUNK_SIZE = 64 * 1024
+RDB_SPOOL_MAX_MEMORY = 16 * 1024 * 1024
+STREAM_NODE_MAX_ENTRIES = 100
+
+RDB_TYPE_STRING = 0
+RDB_TYPE_LIST = 1
+RDB_TYPE_SET = 2
+RDB_TYPE_HASH = 4
+RDB_TYPE_ZSET_2 = 5
+RDB_TYPE_STREAM_LISTPACKS = 15
+RDB_TYPE_SET_INTSET = 11
+RDB_TYPE_HASH_LISTPACK = 16
+RDB_TYPE_ZSET_LISTPACK = 17
+
+RDB_OPCODE_AUX = 0xFA
+RDB_OPCODE_RESIZEDB = 0xFB
+RDB_OPCODE_EXPIRETIME_MS = 0xFC
+RDB_OPCODE_SELECTDB = 0xFE
+RDB_OPCODE_EOF = 0xFF
+
+STREAM_ITEM_FLAG_NONE = 0
+STREAM_ITEM_FLAG_SAMEFIELDS = 2
+
+class Snapshot:
+    """
+    The keyspace as of one replication offset. Creating it only marks every
+    shard (see ShardCapture); `items()` then reads it out shard by shard, a
+    bounded batch per acquisition of one capture lock, so writes carry on
+    meanwhile and pay only for copying a value the snapshot hasn't read yet
+    when they change it. Whoever reads it calls `release()` when done, even
+    on failure, or the shards keep saving values for it.
+    """
+    __slots__ = ("datastore", "captures", "repl_id", "repl_offset", "num_keys", "num_expires")
+
+    def __init__(self, datastore, captures, repl_id, repl_offset, num_keys, num_expires):
+        self.datastore = datastore
+        self.captures = captures
+        self.repl_id = repl_id
+        self.repl_offset = repl_offset
+        self.num_keys = num_keys
+        self.num_expires = num_expires
+
+    def items(self):
+        """Yields (key, value, expiry_ms or None) for every key; values are the snapshot's own, safe to read with no lock."""
+        for capture in self.captures:
+            while True:
+                batch = capture.take_batch()
+                if not batch:
+                    break
+                yield from batch
+            self.datastore.end_capture(capture)
+
+    def release(self):
+        for capture in self.captures:
+            self.datastore.end_capture(capture)
+
+def capture_snapshot(datastore, server_state):
+    """
+    Starts a snapshot with the write gate held exclusively, so no write is
+    half done (applied but not yet propagated) and it matches exactly the
+    current master_repl_offset. The gate is held only while every shard is
+    marked, not while the keyspace is read.
+    """
+    with datastore.write_gate.exclusive():
+        return begin_snapshot(datastore, server_state)
+
+def begin_snapshot(datastore, server_state):
+    """Starts a snapshot of the keyspace as it is now; the caller holds the write gate."""
+    captures = datastore.begin_capture()
+    num_keys = sum(len(shard.data) for shard in datastore.shards)
+    num_expires = sum(len(shard.expires) for shard in datastore.shards)
+    return Snapshot(datastore, captures, server_state.get("master_replid"),
+                    server_state.get("master_repl_offset", 0), num_keys, num_expires)
+
+def write_length(buf, n):
+    if n < 0x40:
+        buf.append(n)
+    elif n < 0x4000:
+        buf += bytes((0x40 | (n >> 8), n & 0xFF))
+    elif n <= 0xFFFFFFFF:
+        buf.append(0x80)
+        buf += n.to_bytes(4, "big")
+    else:
+        buf.append(0x81)
+        buf += n.to_bytes(8, "big")
+
+def write_string(buf, s):
+    if len(s) <= 11:
+        value = encode_string(s)
+        if type(value) is int:
+            write_integer(buf, value)
+            return
+    write_length(buf, len(s))
+    buf += s
+
+def write_integer(buf, value):
+    """Writes an int-encoded string value: as an RDB integer when it fits 32 bits, else as its decimal digits."""
+    if -(1 << 7) <= value < (1 << 7):
+        buf.append(0xC0)
+        buf += value.to_bytes(1, "little", signed=True)
+    elif -(1 << 15) <= value < (1 << 15):
+        buf.append(0xC1)
+        buf += value.to_bytes(2, "little", signed=True)
+    elif -(1 << 31) <= value < (1 << 31):
+        buf.append(0xC2)
+        buf += value.to_bytes(4, "little", signed=True)
+    else:
+        digits = b"%d" % value
+        write_length(buf, len(digits))
+        buf += digits
+
+def listpack_backlen(length):
+    if length <= 127:
+        return bytes((length,))
+    if length < 16383:
+        return bytes((length >> 7, (length & 127) | 128))
+    if length < 2097151:
+        return bytes((length >> 14, ((length >> 7) & 127) | 128, (length & 127) | 128))
+    if length < 268435455:
+        return bytes((length >> 21, ((length >> 14) & 127) | 128, ((length >> 7) & 127) | 128, (length & 127) | 128))
+    return bytes((length >> 28, ((length >> 21) & 127) | 128, ((length >> 14) & 127) | 128,
+                  ((length >> 7) & 127) | 128, (length & 127) | 128))
+
+def listpack_int(value):
+    if 0 <= value <= 127:
+        encoded = bytes((value,))
+    elif -4096 <= value <= 4095:
+        value &= 0x1FFF
+        encoded = bytes((0xC0 | (value >> 8), value & 0xFF))
+    elif -(1 << 15) <= value < (1 << 15):
+        encoded = b"\xf1" + value.to_bytes(2, "little", signed=True)
+    elif -(1 << 23) <= value < (1 << 23):
+        encoded = b"\xf2" + value.to_bytes(3, "little", signed=True)
+    elif -(1 << 31) <= value < (1 << 31):
+        encoded = b"\xf3" + value.to_bytes(4, "little", signed=True)
+    else:
+        encoded = b"\xf4" + value.to_bytes(8, "little", signed=True)
+    return encoded + listpack_backlen(len(encoded))
+
+def listpack_string(s):
+    n = len(s)
+    if n < 64:
+        encoded = bytes((0x80 | n,)) + s
+    elif n < 4096:
+        encoded = bytes((0xE0 | (n >> 8), n & 0xFF)) + s
+    else:
+        encoded = b"\xf0" + n.to_bytes(4, "little") + s
+    return encoded + listpack_backlen(len(encoded))
+
+def listpack_entry(s):
+    """A string element, stored as an integer when it is one, as Redis's listpacks do."""
+    value = encode_string(s)
+    return listpack_int(value) if type(value) is int else listpack_string(s)
+
+def build_listpack(elements, count):
+    body = b"".join(elements)
+    total = 6 + len(body) + 1
+    return total.to_bytes(4, "little") + min(count, 65535).to_bytes(2, "little") + body + b"\xff"
+
+def stream_node_listpack(entries):
+    """Encodes up to STREAM_NODE_MAX_ENTRIES (id, fields) entries as one stream listpack, IDs relative to the first."""
+    master_id, master_values = entries[0]
+    master_ms, master_seq = master_id >> 64, master_id & SEQ_MASK
+    master_fields = master_values[0::2]
+    elements = [listpack_int(len(entries)), listpack_int(0), listpack_int(len(master_fields))]
+    elements.extend(listpack_string(field) for field in master_fields)
+    elements.append(listpack_int(0))
+    for entry_id, values in entries:
+        ms_diff = (entry_id >> 64) - master_ms
+        seq_diff = (entry_id & SEQ_MASK) - master_seq
+        fields = values[0::2]
+        if fields == master_fields:
+            elements += [listpack_int(STREAM_ITEM_FLAG_SAMEFIELDS), listpack_int(ms_diff), listpack_int(seq_diff)]
+            elements.extend(listpack_string(value) for value in values[1::2])
+            elements.append(listpack_int(len(fields) + 3))
+        else:
+            elements += [listpack_int(STREAM_ITEM_FLAG_NONE), listpack_int(ms_diff), listpack_int(seq_diff),
+                         listpack_int(len(fields))]
+            elements.extend(listpack_string(item) for item in values)
+            elements.append(listpack_int(2 * len(fields) + 4))
+    return master_id.to_bytes(16, "big"), build_listpack(elements, len(elements))
+
+def write_list_value(buf, the_list):
+    write_length(buf, len(the_list))
+    for element in the_list:
+        write_string(buf, element)
+
+def write_hash_value(buf, h):
+    write_length(buf, len(h))
+    for field, value in h.items():
+        write_string(buf, field)
+        write_string(buf, value)
+
+def write_hash_listpack_value(buf, h):
+    write_string(buf, build_listpack([listpack_entry(s) for s in h], len(h)))
+
+INTSET_ENCODINGS = ((2, 'h'), (4, 'i'), (8, 'q'))
+
+def write_set_value(buf, s):
+    write_length(buf, len(s))
+    for member in s:
+        write_string(buf, member)
+
+def write_intset_value(buf, intset):
+    """An intset blob: element width, count, then the sorted elements, all little-endian, at the narrowest width that fits."""
+    low, high = (intset[0], intset[-1]) if intset else (0, 0)
+    for width, typecode in INTSET_ENCODINGS:
+        if -(1 << (8 * width - 1)) <= low and high < (1 << (8 * width - 1)):
+            break
+    elements = array(typecode, intset)
+    if sys.byteorder == "big":
+        elements.byteswap()
+    write_string(buf, width.to_bytes(4, "little") + len(intset).to_bytes(4, "little") + elements.tobytes())
+
+def write_zset_value(buf, zset):
+    write_length(buf, zset.card())
+    for score, member in zset.entries(0, zset.card()):
+        write_string(buf, member)
+        buf += struct.pack("<d", score)
+
+def write_zset_listpack_value(buf, zset):
+    elements = []
+    for score, member in zset.entries(0, zset.card()):
+        elements += (listpack_entry(member), listpack_entry(format_score(score)))
+    write_string(buf, build_listpack(elements, len(elements)))
+
+def write_stream_value(buf, stream):
+    nodes = []
+    chunk = []
+    for entry in stream.iter_entries():
+        chunk.append(entry)
+        if len(chunk) == STREAM_NODE_MAX_ENTRIES:
+            nodes.append(stream_node_listpack(chunk))
+            chunk = []
+    if chunk:
+        nodes.append(stream_node_listpack(chunk))
+    write_length(buf, len(nodes))
+    for master_key, listpack in nodes:
+        write_string(buf, master_key)
+        write_string(buf, listpack)
+    write_length(buf, len(stream))
+    write_length(buf, stream.last_id >> 64)
+    write_length(buf, stream.last_id & SEQ_MASK)
+    write_length(buf, 0)
+
+VALUE_WRITERS = {
+    bytes: (RDB_TYPE_STRING, write_string),
+    int: (RDB_TYPE_STRING, write_integer),
+    deque: (RDB_TYPE_LIST, write_list_value),
+    Stream: (RDB_TYPE_STREAM_LISTPACKS, write_stream_value),
+    HashListpack: (RDB_TYPE_HASH_LISTPACK, write_hash_listpack_value),
+    dict: (RDB_TYPE_HASH, write_hash_value),
+    ZsetListpack: (RDB_TYPE_ZSET_LISTPACK, write_zset_listpack_value),
+    SortedSet: (RDB_TYPE_ZSET_2, write_zset_value),
+    IntSet: (RDB_TYPE_SET_INTSET, write_intset_value),
+    set: (RDB_TYPE_SET, write_set_value),
+}
+
+def write_snapshot(snapshot, out):
+    """Encodes `snapshot` as an RDB file into the binary file object `out`, RDB_WRITE_CHUNK_SIZE bytes at a time."""
+    buf = bytearray(RDB_MAGIC)
+    aux_fields = [(b"redis-ver", RDB_VERSION_STRING), (b"redis-bits", b"64"),
+                  (b"ctime", b"%d" % int(time.time())), (b"aof-base", b"0")]
+    if snapshot.repl_id:
+        aux_fields += [(b"repl-id", snapshot.repl_id.encode()), (b"repl-offset", b"%d" % snapshot.repl_offset)]
+    for name, value in aux_fields:
+        buf.append(RDB_OPCODE_AUX)
+        write_string(buf, name)
+        write_string(buf, value)
+
+    buf.append(RDB_OPCODE_SELECTDB)
+    write_length(buf, 0)
+    buf.append(RDB_OPCODE_RESIZEDB)
+    write_length(buf, snapshot.num_keys)
+    write_length(buf, snapshot.num_expires)
+
+    now = now_ms()
+    for key, value, expiry_ms in snapshot.items():
+        if expiry_ms is not None:
+            if expiry_ms <= now:
+                continue
+            buf.append(RDB_OPCODE_EXPIRETIME_MS)
+            buf += expiry_ms.to_bytes(8, "little")
+        type_byte, write_value = VALUE_WRITERS[type(value)]
+        buf.append(type_byte)
+        write_string(buf, key)
+        write_value(buf, value)
+        if len(buf) >= RDB_WRITE_CHUNK_SIZE:
+            out.write(buf)
+            buf.clear()
+
+    # A zero checksum tells loaders the file carries none.
+    buf.append(RDB_OPCODE_EOF)
+    buf += bytes(8)
+    out.write(buf)
+
+def encode_snapshot(snapshot):
+    """Encodes into a spooled temp file (memory first, disk once large); returns the file rewound and its size."""
+    spool = tempfile.SpooledTemporaryFile(max_size=RDB_SPOOL_MAX_MEMORY)
+    try:
+        write_snapshot(snapshot, spool)
+    finally:
+        snapshot.release()
+    size = spool.tell()
+    spool.seek(0)
+    return spool, size
+
+def transfer_chunks(spool, size):
+    """Yields the `$<size>\\r\\n` header and then the RDB payload of an encoded snapshot, for a replica full sync."""
+    yield b"$%d\r\n" % size
+    with spool:
+        while True:
+            chunk = spool.read(RDB_WRITE_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+def save_snapshot(snapshot, directory, filename):
+    """Writes the RDB to a temp file in `directory` and renames it over `filename`, so readers never see a partial dump."""
+    path = os.path.join(directory, filename)
+    temp_path = os.path.join(directory, f"temp-{os.getpid()}-{time.monotonic_ns()}.rdb")
+    try:
+        with open(temp_path, "wb") as f:
+            write_snapshot(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        snapshot.release()
+    return path
+
+RDB_TYPE_ZSET = 3
+RDB_TYPE_LIST_ZIPLIST = 10
+RDB_TYPE_ZSET_ZIPLIST = 12
+RDB_TYPE_HASH_ZIPLIST = 13
+RDB_TYPE_LIST_QUICKLIST = 14
+RDB_TYPE_LIST_QUICKLIST_2 = 18
+RDB_TYPE_STREAM_LISTPACKS_2 = 19
+RDB_TYPE_SET_LISTPACK = 20
+RDB_TYPE_STREAM_LISTPACKS_3 = 21
+
+RDB_OPCODE_SLOT_INFO = 0xF4
+RDB_OPCODE_FUNCTION2 = 0xF5
+RDB_OPCODE_IDLE = 0xF8
+RDB_OPCODE_FREQ = 0xF9
+RDB_OPCODE_EXPIRETIME = 0xFD
+
+QUICKLIST_NODE_CONTAINER_PLAIN = 1
+STREAM_ITEM_FLAG_DELETED = 1
+RDB_LOAD_BATCH_SIZE = 1024
+
+class RdbError(Exception):
+    pass
+
+class RdbIncomplete(Exception):
+    """Raised by the readers when the buffer ends inside the current record."""
+
+def read_length(buf, pos):
+    if pos >= len(buf):
+        raise RdbIncomplete()
+    first = buf[pos]
+    kind = first >> 6
+    if kind == 0:
+        return first & 0x3F, pos + 1
+    if kind == 1:
+        if pos + 2 > len(buf):
+            raise RdbIncomplete()
+        return ((first & 0x3F) << 8) | buf[pos + 1], pos + 2
+    if first == 0x80:
+        if pos + 5 > len(buf):
+            raise RdbIncomplete()
+        return int.from_bytes(buf[pos + 1:pos + 5], "big"), pos + 5
+    if first == 0x81:
+        if pos + 9 > len(buf):
+            raise RdbIncomplete()
+        return int.from_bytes(buf[pos + 1:pos + 9], "big"), pos + 9
+    raise RdbError(f"unexpected string encoding 0x{first:02x} where a length was expected")
+
+def read_string(buf, pos):
+    if pos >= len(buf):
+        raise RdbIncomplete()
+    first = buf[pos]
+    if first >> 6 == 3:
+        encoding = first & 0x3F
+        if encoding <= 2:
+            width = 1 << encoding
+            if pos + 1 + width > len(buf):
+                raise RdbIncomplete()
+            return b"%d" % int.from_bytes(buf[pos + 1:pos + 1 + width], "little", signed=True), pos + 1 + width
+        if encoding == 3:
+            compressed_length, pos = read_length(buf, pos + 1)
+            length, pos = read_length(buf, pos)
+            end = pos + compressed_length
+            if end > len(buf):
+                raise RdbIncomplete()
+            return lzf_decompress(buf[pos:end], length), end
+        raise RdbError(f"unknown string encoding {encoding}")
+    length, pos = read_length(buf, pos)
+    end = pos + length
+    if end > len(buf):
+        raise RdbIncomplete()
+    return bytes(buf[pos:end]), end
+
+def lzf_decompress(data, expected_length):
+    out = bytearray()
+    i, n = 0, len(data)
+    while i < n:
+        ctrl = data[i]
+        i += 1
+        if ctrl < 32:
+            out += data[i:i + ctrl + 1]
+            i += ctrl + 1
+            continue
+        length = ctrl >> 5
+        if length == 7:
+            length += data[i]
+            i += 1
+        ref = len(out) - ((ctrl & 0x1F) << 8) - data[i] - 1
+        i += 1
+        length += 2
+        if ref < 0:
+            raise RdbError("corrupt LZF data")
+        if ref + length <= len(out):
+            out += out[ref:ref + length]
+        else:
+            for k in range(length):
+                out.append(out[ref + k])
+    if len(out) != expected_length:
+        raise RdbError("LZF decompressed length mismatch")
+    return bytes(out)
+
+def listpack_backlen_size(size):
+    if size <= 127: return 1
+    if size < 16383: return 2
+    if size < 2097151: return 3
+    if size < 268435455: return 4
+    return 5
+
+def listpack_elements(lp):
+    """Decodes a listpack blob into its elements: bytes for strings, int for integers."""
+    elements = []
+    pos = 6
+    while True:
+        first = lp[pos]
+        if first == 0xFF:
+            return elements
+        if first < 0x80:
+            value, size = first, 1
+        elif first < 0xC0:
+            n = first & 0x3F
+            value, size = lp[pos + 1:pos + 1 + n], 1 + n
+        elif first < 0xE0:
+            value = ((first & 0x1F) << 8) | lp[pos + 1]
+            if value >= 4096:
+                value -= 8192
+            size = 2
+        elif first < 0xF0:
+            n = ((first & 0x0F) << 8) | lp[pos + 1]
+            value, size = lp[pos + 2:pos + 2 + n], 2 + n
+        elif first == 0xF0:
+            n = int.from_bytes(lp[pos + 1:pos + 5], "little")
+            value, size = lp[pos + 5:pos + 5 + n], 5 + n
+        elif 0xF1 <= first <= 0xF4:
+            width = (2, 3, 4, 8)[first - 0xF1]
+            value, size = int.from_bytes(lp[pos + 1:pos + 1 + width], "little", signed=True), 1 + width
+        else:
+            raise RdbError(f"bad listpack encoding 0x{first:02x}")
+        elements.append(value)
+        pos += size + listpack_backlen_size(size)
+
+def ziplist_elements(zl):
+    """Decodes a (pre-7.0) ziplist blob into its elements: bytes for strings, int for integers."""
+    elements = []
+    pos = 10
+    while True:
+        if zl[pos] == 0xFF:
+            return elements
+        pos += 5 if zl[pos] == 0xFE else 1
+        first = zl[pos]
+        kind = first >> 6
+        if kind == 0:
+            n = first & 0x3F
+            elements.append(zl[pos + 1:pos + 1 + n])
+            pos += 1 + n
+        elif kind == 1:
+            n = ((first & 0x3F) << 8) | zl[pos + 1]
+            elements.append(zl[pos + 2:pos + 2 + n])
+            pos += 2 + n
+        elif kind == 2:
+            n = int.from_bytes(zl[pos + 1:pos + 5], "big")
+            elements.append(zl[pos + 5:pos + 5 + n])
+            pos += 5 + n
+        elif 0xF1 <= first <= 0xFD:
+            elements.append((first & 0x0F) - 1)
+            pos += 1
+        else:
+            width = {0xC0: 2, 0xD0: 4, 0xE0: 8, 0xF0: 3, 0xFE: 1}.get(first)
+            if width is None:
+                raise RdbError(f"bad ziplist encoding 0x{first:02x}")
+            elements.append(int.from_bytes(zl[pos + 1:pos + 1 + width], "little", signed=True))
+            pos += 1 + width
+
+def as_bytes(element):
+    return b"%d" % element if isinstance(element, int) else bytes(element)
+
+def read_list(buf, pos, rdb_type, limits):
+    the_list = deque()
+    if rdb_type == RDB_TYPE_LIST_ZIPLIST:
+        blob, pos = read_string(buf, pos)
+        the_list.extend(as_bytes(element) for element in ziplist_elements(blob))
+        return the_list, pos
+    length, pos = read_length(buf, pos)
+    if rdb_type == RDB_TYPE_LIST:
+        for _ in range(length):
+            element, pos = read_string(buf, pos)
+            the_list.append(element)
+        return the_list, pos
+    for _ in range(length):
+        container = None
+        if rdb_type == RDB_TYPE_LIST_QUICKLIST_2:
+            container, pos = read_length(buf, pos)
+        node, pos = read_string(buf, pos)
+        if container == QUICKLIST_NODE_CONTAINER_PLAIN:
+            the_list.append(node)
+        elif rdb_type == RDB_TYPE_LIST_QUICKLIST_2:
+            the_list.extend(as_bytes(element) for element in listpack_elements(node))
+        else:
+            the_list.extend(as_bytes(element) for element in ziplist_elements(node))
+    return the_list, pos
+
+def read_stream(buf, pos, rdb_type, limits):
+    stream = Stream()
+    num_nodes, pos = read_length(buf, pos)
+    for _ in range(num_nodes):
+        master_key, pos = read_string(buf, pos)
+        listpack, pos = read_string(buf, pos)
+        if len(master_key) != 16:
+            raise RdbError("bad stream node key")
+        master_ms = int.from_bytes(master_key[:8], "big")
+        master_seq = int.from_bytes(master_key[8:], "big")
+        elements = listpack_elements(listpack)
+        num_master_fields = elements[2]
+        master_fields = [as_bytes(field) for field in elements[3:3 + num_master_fields]]
+        i = 4 + num_master_fields
+        while i < len(elements):
+            flags = elements[i]
+            entry_id = pack_id(master_ms + elements[i + 1], master_seq + elements[i + 2])
+            i += 3
+            if flags & STREAM_ITEM_FLAG_SAMEFIELDS:
+                fields = [None] * (2 * num_master_fields)
+                fields[0::2] = master_fields
+                fields[1::2] = [as_bytes(value) for value in elements[i:i + num_master_fields]]
+                i += num_master_fields
+            else:
+                num_fields = elements[i]
+                fields = [as_bytes(item) for item in elements[i + 1:i + 1 + 2 * num_fields]]
+                i += 1 + 2 * num_fields
+            i += 1
+            if not flags & STREAM_ITEM_FLAG_DELETED:
+                stream.append(entry_id, tuple(fields))
+
+    _, pos = read_length(buf, pos)
+    last_ms, pos = read_length(buf, pos)
+    last_seq, pos = read_length(buf, pos)
+    stream.last_id = pack_id(last_ms, last_seq)
+    if rdb_type >= RDB_TYPE_STREAM_LISTPACKS_2:
+        _, pos = read_length(buf, pos)
+        _, pos = read_length(buf, pos)
+        deleted_ms, pos = read_length(buf, pos)
+        deleted_seq, pos = read_length(buf, pos)
+        stream.max_deleted_id = pack_id(deleted_ms, deleted_seq)
+        stream.entries_added, pos = read_length(buf, pos)
+
+    # Consumer groups are not supported here; they are parsed only to be skipped.
+    num_groups, pos = read_length(buf, pos)
+    for _ in range(num_groups):
+        _, pos = read_string(buf, pos)
+        _, pos = read_length(buf, pos)
+        _, pos = read_length(buf, pos)
+        if rdb_type >= RDB_TYPE_STREAM_LISTPACKS_2:
+            _, pos = read_length(buf, pos)
+        pel_size, pos = read_length(buf, pos)
+        for _ in range(pel_size):
+            _, pos = read_length(buf, pos + 24)
+        num_consumers, pos = read_length(buf, pos)
+        for _ in range(num_consumers):
+            _, pos = read_string(buf, pos)
+            pos += 16 if rdb_type >= RDB_TYPE_STREAM_LISTPACKS_3 else 8
+            pel_size, pos = read_length(buf, pos)
+            pos += 16 * pel_size
+        if pos > len(buf):
+            raise RdbIncomplete()
+    return stream, pos
+
+def read_string_value(buf, pos, rdb_type, limits):
+    value, pos = read_string(buf, pos)
+    return encode_string(value), pos
+
+def read_hash(buf, pos, rdb_type, limits):
+    if rdb_type == RDB_TYPE_HASH:
+        length, pos = read_length(buf, pos)
+        flat = []
+        for _ in range(2 * length):
+            item, pos = read_string(buf, pos)
+            flat.append(item)
+    else:
+        blob, pos = read_string(buf, pos)
+        elements = listpack_elements(blob) if rdb_type == RDB_TYPE_HASH_LISTPACK else ziplist_elements(blob)
+        flat = [as_bytes(element) for element in elements]
+    return new_hash(flat, limits), pos
+
+def read_set(buf, pos, rdb_type, limits):
+    if rdb_type == RDB_TYPE_SET:
+        length, pos = read_length(buf, pos)
+        members = []
+        for _ in range(length):
+            member, pos = read_string(buf, pos)
+            members.append(encode_string(member))
+        return new_set(members, limits), pos
+    blob, pos = read_string(buf, pos)
+    if rdb_type == RDB_TYPE_SET_LISTPACK:
+        members = [encode_string(element) if type(element) is not int else element for element in listpack_elements(blob)]
+        return new_set(members, limits), pos
+    width = int.from_bytes(blob[:4], "little")
+    count = int.from_bytes(blob[4:8], "little")
+    typecode = dict(INTSET_ENCODINGS).get(width)
+    if typecode is None or len(blob) < 8 + width * count:
+        raise RdbError("bad intset encoding")
+    elements = array(typecode, blob[8:8 + width * count])
+    if sys.byteorder == "big":
+        elements.byteswap()
+    return new_set(elements.tolist(), limits), pos
+
+def read_zset(buf, pos, rdb_type, limits):
+    if rdb_type in (RDB_TYPE_ZSET, RDB_TYPE_ZSET_2):
+        length, pos = read_length(buf, pos)
+        pairs = []
+        for _ in range(length):
+            member, pos = read_string(buf, pos)
+            if rdb_type == RDB_TYPE_ZSET_2:
+                if pos + 8 > len(buf):
+                    raise RdbIncomplete()
+                score = struct.unpack_from("<d", buf, pos)[0]
+                pos += 8
+            else:
+                # Version 1 scores are a length byte and ASCII digits; lengths 253-255 stand for nan, inf and -inf.
+                if pos >= len(buf):
+                    raise RdbIncomplete()
+                n = buf[pos]
+                if n >= 253:
+                    score = (math.nan, math.inf, -math.inf)[n - 253]
+                    pos += 1
+                else:
+                    if pos + 1 + n > len(buf):
+                        raise RdbIncomplete()
+                    score = float(bytes(buf[pos + 1:pos + 1 + n]))
+                    pos += 1 + n
+            pairs.append((member, score))
+    else:
+        blob, pos = read_string(buf, pos)
+        elements = listpack_elements(blob) if rdb_type == RDB_TYPE_ZSET_LISTPACK else ziplist_elements(blob)
+        pairs = [(as_bytes(elements[i]), float(elements[i + 1] if type(elements[i + 1]) is int else bytes(elements[i + 1])))
+                 for i in range(0, len(elements), 2)]
+    return new_zset(pairs, limits), pos
+
+VALUE_READERS = {
+    RDB_TYPE_STRING: read_string_value,
+    RDB_TYPE_LIST: read_list,
+    RDB_TYPE_LIST_ZIPLIST: read_list,
+    RDB_TYPE_LIST_QUICKLIST: read_list,
+    RDB_TYPE_LIST_QUICKLIST_2: read_list,
+    RDB_TYPE_STREAM_LISTPACKS: read_stream,
+    RDB_TYPE_STREAM_LISTPACKS_2: read_stream,
+    RDB_TYPE_STREAM_LISTPACKS_3: read_stream,
+    RDB_TYPE_HASH: read_hash,
+    RDB_TYPE_HASH_ZIPLIST: read_hash,
+    RDB_TYPE_HASH_LISTPACK: read_hash,
+    RDB_TYPE_ZSET: read_zset,
+    RDB_TYPE_ZSET_2: read_zset,
+    RDB_TYPE_ZSET_ZIPLIST: read_zset,
+    RDB_TYPE_ZSET_LISTPACK: read_zset,
+    RDB_TYPE_SET: read_set,
+    RDB_TYPE_SET_INTSET: read_set,
+    RDB_TYPE_SET_LISTPACK: read_set,
+}
+
+class RdbLoader:
+    """
+    Push parser for an RDB payload that fills the datastore directly,
+    RDB_LOAD_BATCH_SIZE keys per lock acquisition, without going through
+    the command handlers. `feed()` accepts the payload in chunks of any
+    size, so a replica loads while the transfer is still arriving; a record
+    cut off at the end of a chunk is parsed again from its start once the
+    pending bytes have doubled, which keeps the work linear even for one
+    huge value. `parse()` runs over a whole buffer, e.g. an mmap of the file.
+    """
+    def __init__(self, datastore):
+        self.datastore = datastore
+        self.version = None
+        self.aux = {}
+        self.db = 0
+        self.expiry_ms = None
+        self.keys_loaded = 0
+        self.done = False
+        self.now = now_ms()
+        self._batch = []
+        self._pending = bytearray()
+        self._retry_at = 0
+
+    def feed(self, data):
+        pending = self._pending
+        pending += data
+        if self.done or len(pending) < self._retry_at:
+            return
+        consumed = self.parse(bytes(pending), 0)
+        del pending[:consumed]
+        self._retry_at = 2 * len(pending)
+
+    def finish(self):
+        """Parses whatever is still pending once the payload has fully arrived; raises RdbError if it ended early."""
+        if not self.done and self._pending:
+            self.parse(bytes(self._pending), 0)
+        self._pending = bytearray()
+        if not self.done:
+            raise RdbError("unexpected end of RDB payload")
+
+    def parse(self, buf, pos):
+        """Parses every complete record of `buf` from `pos`; returns the position of the first unparsed byte."""
+        # Loading creates millions of acyclic objects; left on, the cyclic
+        # collector would rescan the ever-growing heap many times over.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            if self.version is None:
+                if len(buf) < pos + 9:
+                    raise RdbIncomplete()
+                if buf[pos:pos + 5] != b"REDIS":
+                    raise RdbError("wrong signature trying to load DB")
+                self.version = int(bytes(buf[pos + 5:pos + 9]))
+                pos += 9
+            while not self.done:
+                pos = self.parse_record(buf, pos)
+        except RdbIncomplete:
+            pass
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        self.flush()
+        return pos
+
+    def parse_record(self, buf, pos):
+        if pos >= len(buf):
+            raise RdbIncomplete()
+        opcode = buf[pos]
+        if opcode == RDB_OPCODE_EXPIRETIME_MS or opcode == RDB_OPCODE_EXPIRETIME:
+            width = 8 if opcode == RDB_OPCODE_EXPIRETIME_MS else 4
+            if pos + 1 + width > len(buf):
+                raise RdbIncomplete()
+            self.expiry_ms = int.from_bytes(buf[pos + 1:pos + 1 + width], "little")
+            if opcode == RDB_OPCODE_EXPIRETIME:
+                self.expiry_ms *= 1000
+            return pos + 1 + width
+        if opcode == RDB_OPCODE_AUX:
+            name, next_pos = read_string(buf, pos + 1)
+            value, next_pos = read_string(buf, next_pos)
+            self.aux[name] = value
+            return next_pos
+        if opcode == RDB_OPCODE_SELECTDB:
+            self.db, next_pos = read_length(buf, pos + 1)
+            return next_pos
+        if opcode == RDB_OPCODE_RESIZEDB:
+            _, next_pos = read_length(buf, pos + 1)
+            _, next_pos = read_length(buf, next_pos)
+            return next_pos
+        if opcode == RDB_OPCODE_IDLE:
+            _, next_pos = read_length(buf, pos + 1)
+            return next_pos
+        if opcode == RDB_OPCODE_FREQ:
+            if pos + 2 > len(buf):
+                raise RdbIncomplete()
+            return pos + 2
+        if opcode == RDB_OPCODE_SLOT_INFO:
+            _, next_pos = read_length(buf, pos + 1)
+            _, next_pos = read_length(buf, next_pos)
+            _, next_pos = read_length(buf, next_pos)
+            return next_pos
+        if opcode == RDB_OPCODE_FUNCTION2:
+            _, next_pos = read_string(buf, pos + 1)
+            return next_pos
+        if opcode == RDB_OPCODE_EOF:
+            end = pos + 1 + (8 if self.version >= 5 else 0)
+            if end > len(buf):
+                raise RdbIncomplete()
+            self.done = True
+            return end
+
+        read_value = VALUE_READERS.get(opcode)
+        if read_value is None:
+            raise RdbError(f"unknown RDB value type {opcode}")
+        key, next_pos = read_string(buf, pos + 1)
+        value, next_pos = read_value(buf, next_pos, opcode, self.datastore.limits)
+        expiry_ms, self.expiry_ms = self.expiry_ms, None
+        if self.db == 0 and (expiry_ms is None or expiry_ms > self.now):
+            self._batch.append((key, value, expiry_ms))
+            if len(self._batch) >= RDB_LOAD_BATCH_SIZE:
+                self.flush()
+        return next_pos
+
+    def flush(self):
+        if self._batch:
+            self.datastore.load_items(self._batch)
+            self.keys_loaded += len(self._batch)
+            self._batch = []
+
+def load_file(path, datastore):
+    """Loads the RDB file at `path` into `datastore` through a read-only mmap; returns the finished RdbLoader."""
+    loader = RdbLoader(datastore)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise RdbError("empty RDB file")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            loader.parse(view, 0)
+    if not loader.done:
+        raise RdbError("unexpected EOF reading RDB file")
+    return loader
@@ -0,0 +1,340 @@
+import socket
+import threading
+import time
+from . import protocol
+from . import rdb
+from .command_handler import handle_command
+from .resp import RespParser
+
+REPLICA_ACK_INTERVAL_S = 1.0
+REPLICA_RECONNECT_DELAY_S = 1.0
+DEFAULT_REPL_BACKLOG_SIZE = 1024 * 1024
+DEFAULT_REPLICA_OUTPUT_BUFFER_LIMIT = 256 * 1024 * 1024
+REPLICA_READ_BUFFER_SIZE = 64 * 1024
+
+GETACK_COMMAND = protocol.format_array([
+    protocol.format_bulk_string(b"REPLCONF"),
+    protocol.format_bulk_string(b"GETACK"),
+    protocol.format_bulk_string(b"*")
+])
+
+def format_command(*args):
+    return protocol.format_array([protocol.format_bulk_string(arg) for arg in args])
+
+def handshake_commands(replica_port, master_replid=None, offset=0):
+    if master_replid is None:
+        psync = format_command(b"PSYNC", b"?", b"-1")
+    else:
+        psync = format_command(b"PSYNC", master_replid.encode(), str(offset + 1).encode())
+    return [
+        format_command(b"PING"),
+        format_command(b"REPLCONF", b"listening-port", str(replica_port).encode()),
+        format_command(b"REPLCONF", b"capa", b"psync2"),
+        psync,
+    ]
+
+class ReplicationBacklog:
+    """
+    Fixed-size ring buffer holding the tail of the replication stream, so a
+    replica that reconnects with an offset still inside it is sent only the
+    bytes it missed. Offsets are master_repl_offset values.
+    """
+    __slots__ = ("buffer", "end_offset", "histlen")
+
+    def __init__(self, size, start_offset=0):
+        self.buffer = bytearray(size)
+        self.end_offset = start_offset
+        self.histlen = 0
+
+    def start_offset(self):
+        return self.end_offset - self.histlen
+
+    def covers(self, offset):
+        return self.start_offset() <= offset <= self.end_offset
+
+    def append(self, data):
+        buffer, size = self.buffer, len(self.buffer)
+        n = len(data)
+        view = memoryview(data)[max(0, n - size):]
+        pos = (self.end_offset + n - len(view)) % size
+        first = min(len(view), size - pos)
+        buffer[pos:pos + first] = view[:first]
+        buffer[:len(view) - first] = view[first:]
+        self.end_offset += n
+        self.histlen = min(size, self.histlen + n)
+
+    def read_from(self, offset):
+        if not self.covers(offset):
+            return None
+        buffer, size = self.buffer, len(self.buffer)
+        length = self.end_offset - offset
+        pos = offset % size
+        if pos + length <= size:
+            return bytes(buffer[pos:pos + length])
+        return bytes(buffer[pos:]) + bytes(buffer[:pos + length - size])
+
+class ReplicaOutput:
+    """
+    Outbound side of one replica link on the threaded server. `sendall()`
+    only appends to a buffer, so writers holding ack_condition never wait on
+    the network; a writer thread per replica, started by `start()` once the
+    PSYNC reply (and RDB) is out, sends everything that piled up in one call.
+    A replica more than `limit` bytes behind is disconnected: it reconnects
+    and resyncs rather than letting the buffer grow unbounded.
+    """
+    def __init__(self, sock, limit=DEFAULT_REPLICA_OUTPUT_BUFFER_LIMIT):
+        self.sock = sock
+        self.limit = limit
+        self.condition = threading.Condition(threading.Lock())
+        self.buffer = bytearray()
+        self.closed = False
+
+    def start(self):
+        threading.Thread(target=self.run_writer, daemon=True).start()
+
+    def sendall(self, data):
+        with self.condition:
+            if self.closed:
+                return
+            if len(self.buffer) + len(data) > self.limit:
+                print(f"Replica output buffer over {self.limit} bytes, disconnecting the replica")
+                self.close_locked()
+                return
+            self.buffer += data
+            self.condition.notify()
+
+    def run_writer(self):
+        while True:
+            with self.condition:
+                while not self.buffer and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                data, self.buffer = self.buffer, bytearray()
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.close()
+                return
+
+    def close(self):
+        with self.condition:
+            self.close_locked()
+
+    def close_locked(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.buffer = bytearray()
+        self.condition.notify()
+        # Wakes the connection's reader too, which then unregisters the replica.
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def feed_replication_stream(server_state, data):
+    """Appends `data` to the replication stream: offset, backlog and every replica. Caller holds ack_condition."""
+    server_state["master_repl_offset"] += len(data)
+    server_state["repl_backlog"].append(data)
+    for replica in server_state["replicas"]:
+        try:
+            replica.sendall(data)
+        except OSError: pass
+
+def propagate_write(server_state, command_bytes):
+    """Sends a write to the replicas and the AOF, in the same order for both."""
+    if not command_bytes:
+        return
+    started = time.perf_counter_ns()
+    with server_state["ack_condition"]:
+        feed_replication_stream(server_state, command_bytes)
+        server_state["write_offset"] = server_state["master_repl_offset"]
+        if server_state["aof"] is not None:
+            server_state["aof"].append(command_bytes)
+    server_state["stats"].latency_monitor.measure("replica-fanout", started)
+
+def propagate_expired(server_state, keys):
+    """
+    Sends a DEL for keys the master expired. Replicas never expire keys on
+    their own clock, so this keeps them (and the AOF) in step.
+    """
+    if server_state["role"] == "master":
+        propagate_write(server_state, format_command(b"DEL", *keys))
+
+def sync_replica(cmd, datastore, server_state, replica):
+    """
+    Answers PSYNC and returns (reply, snapshot). CONTINUE if the backlog
+    still holds the replica's next byte, else FULLRESYNC with a snapshot the
+    caller sends as the RDB. `replica` (None on a replica server) is
+    registered in the same step that fixes its offset, so whatever is written
+    during the transfer queues in its output (bounded by its own limit)
+    rather than having to still be in the backlog afterwards. The caller
+    sends the reply and RDB before letting that output reach the socket.
+    """
+    replid = server_state["master_replid"]
+    try:
+        resume_offset = int(cmd.argv[2]) - 1
+    except ValueError:
+        resume_offset = -1
+    with server_state["ack_condition"]:
+        if cmd.argv[1].decode() == replid:
+            missing = server_state["repl_backlog"].read_from(resume_offset)
+            if missing is not None:
+                if replica is not None:
+                    if missing:
+                        replica.sendall(missing)
+                    register_replica(server_state, replica, resume_offset)
+                return protocol.format_simple_string(f"CONTINUE {replid}"), None
+    # Exclusive gate first, as writers take it before ack_condition.
+    with datastore.write_gate.exclusive(), server_state["ack_condition"]:
+        snapshot = rdb.begin_snapshot(datastore, server_state)
+        if replica is not None:
+            register_replica(server_state, replica, snapshot.repl_offset)
+    return protocol.format_simple_string(f"FULLRESYNC {replid} {snapshot.repl_offset}"), snapshot
+
+def register_replica(server_state, replica, sync_offset):
+    """Adds `replica` as holding the stream up to `sync_offset`; caller holds ack_condition."""
+    server_state["replicas"].append(replica)
+    server_state["replica_acks"][replica] = sync_offset
+    server_state["replica_ack_times"][replica] = time.monotonic()
+
+def remove_replica(server_state, replica):
+    with server_state["ack_condition"]:
+        if replica in server_state["replicas"]:
+            server_state["replicas"].remove(replica)
+        server_state["replica_acks"].pop(replica, None)
+        server_state["replica_ack_times"].pop(replica, None)
+
+def count_acked_replicas(server_state, wait_offset):
+    with server_state["ack_condition"]:
+        return sum(1 for offset in server_state["replica_acks"].values() if offset >= wait_offset)
+
+def request_acks(server_state, wait_offset):
+    """Sends GETACK to every replica, unless one sent at or after `wait_offset` already covers it."""
+    with server_state["ack_condition"]:
+        if server_state["acks_requested_offset"] >= wait_offset:
+            return
+        server_state["acks_requested_offset"] = server_state["master_repl_offset"]
+        # GETACK is part of the stream (replicas count it), so it goes through the backlog too.
+        feed_replication_stream(server_state, GETACK_COMMAND)
+
+def wait_for_acks(server_state, wait_offset, num_replicas, timeout_ms):
+    """Blocks until `num_replicas` replicas have acknowledged `wait_offset` or `timeout_ms` (0 = forever) passes."""
+    deadline = None if timeout_ms <= 0 else time.monotonic() + timeout_ms / 1000.0
+    condition = server_state["ack_condition"]
+    request_acks(server_state, wait_offset)
+    with condition:
+        while True:
+            acked = count_acked_replicas(server_state, wait_offset)
+            if acked >= num_replicas:
+                return acked
+            timeout_s = None if deadline is None else deadline - time.monotonic()
+            if timeout_s is not None and timeout_s <= 0:
+                return acked
+            condition.wait(timeout_s)
+
+def record_replica_ack(server_state, replica, ack_offset):
+    with server_state["ack_condition"]:
+        server_state["replica_acks"][replica] = ack_offset
+        server_state["replica_ack_times"][replica] = time.monotonic()
+        server_state["ack_condition"].notify_all()
+        ack_waiters = server_state.get("ack_waiters")
+        if ack_waiters:
+            for waiter in list(ack_waiters):
+                wait_offset, num_replicas, future = waiter
+                if future.done():
+                    ack_waiters.remove(waiter)
+                    continue
+                acked = sum(1 for offset in server_state["replica_acks"].values() if offset >= wait_offset)
+                if acked >= num_replicas:
+                    ack_waiters.remove(waiter)
+                    future.set_result(acked)
+
+class ReplicationStream:
+    """
+    Replica side of the replication link once the handshake is done: consumes
+    the FULLRESYNC line and RDB payload (or a CONTINUE line) and then the
+    command stream, applying every command to the datastore. A full sync
+    empties the datastore and loads the RDB chunk by chunk as it arrives.
+    The replication ID and offset are kept in server_state so a reconnect
+    can ask for a partial resync. `feed()` returns the bytes to send back to
+    the master (REPLCONF ACK replies).
+    """
+    def __init__(self, datastore, server_state):
+        self.datastore = datastore
+        self.server_state = server_state
+        self.parser = RespParser()
+        self.sync_line = None
+        self.rdb_received = False
+        self.rdb_loader = None
+        self.rdb_remaining = 0
+        self.sync_replid = server_state["master_replid"]
+        self.offset = server_state["master_repl_offset"]
+
+    def ack_command(self):
+        return format_command(b"REPLCONF", b"ACK", str(self.offset).encode())
+
+    def load_rdb(self):
+        """Streams the buffered part of the full-sync RDB into the loader; True once the whole payload is loaded."""
+        parser = self.parser
+        if self.rdb_loader is None:
+            length = parser.read_bulk_header()
+            if length is None: return False
+            self.rdb_loader = rdb.RdbLoader(self.datastore)
+            self.rdb_remaining = length
+        while self.rdb_remaining:
+            chunk = parser.take(self.rdb_remaining)
+            if not chunk: return False
+            self.rdb_remaining -= len(chunk)
+            self.rdb_loader.feed(chunk)
+        self.rdb_loader.finish()
+        self.rdb_loader = None
+        self.rdb_received = True
+        return True
+
+    def feed(self, data):
+        parser = self.parser
+        parser.feed(data)
+        self.server_state["master_last_io_time"] = time.monotonic()
+
+        if not self.rdb_received:
+            if self.sync_line is None:
+                self.sync_line = parser.read_line()
+                if self.sync_line is None: return b""
+                reply = self.sync_line.split()
+                if reply[0] == b"+FULLRESYNC":
+                    # No replid until the RDB is fully loaded, so a snapshot of a half-loaded
+                    # keyspace is never saved as one a restart could PSYNC from.
+                    self.server_state["master_replid"] = None
+                    self.sync_replid = reply[1].decode()
+                    self.offset = int(reply[2])
+                    self.datastore.clear()
+                elif reply[0] == b"+CONTINUE":
+                    if len(reply) > 1:
+                        self.sync_replid = reply[1].decode()
+                    self.rdb_received = True
+                else:
+                    raise ConnectionError(f"unexpected PSYNC reply {self.sync_line!r}")
+            if not self.rdb_received and not self.load_rdb(): return b""
+            with self.datastore.write_gate:
+                self.server_state["master_repl_offset"] = self.offset
+                self.server_state["master_replid"] = self.sync_replid
+            self.server_state["master_link_status"] = "up"
+
+        commands = parser.parse_commands()
+        if not commands:
+            return b""
+        replies = []
+        datastore = self.datastore
+        # One lock acquisition per received batch instead of one per command (the shard locks are reentrant).
+        with datastore.write_gate, datastore.all_locks():
+            for cmd in commands:
+                if cmd.name == "REPLCONF" and len(cmd.argv) > 1 and cmd.argv[1].upper() == b"GETACK":
+                    replies.append(self.ack_command())
+                else:
+                    handle_command(cmd, datastore, self.server_state)
+                self.offset += cmd.size
+            # Inside the gate, so a snapshot's repl-offset always matches the data it holds.
+            self.server_state["master_repl_offset"] = self.offset
+        return b"".join(replies)
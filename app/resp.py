@@ -0,0 +1,186 @@
+from . import protocol
+
+MAX_BULK_LENGTH = 512 * 1024 * 1024
+MAX_INLINE_LENGTH = 64 * 1024
+
+_COMMAND_NAMES = {}
+
+class ProtocolError(Exception):
+    pass
+
+def normalize_command_name(raw_name):
+    name = _COMMAND_NAMES.get(raw_name)
+    if name is None:
+        name = raw_name.decode(errors="replace").upper()
+        if len(_COMMAND_NAMES) < 1024:
+            _COMMAND_NAMES[raw_name] = name
+    return name
+
+class Command:
+    """
+    A parsed request: `argv` holds the raw arguments (argv[0] is the command
+    name as sent), `name` the normalized upper-case name, `size` the number
+    of bytes the request occupied on the wire and `client` the sender's
+    "ip:port" (None for commands replayed from the AOF or a master).
+    """
+    __slots__ = ("name", "argv", "size", "client", "_raw")
+
+    def __init__(self, argv, size=None, client=None):
+        self.argv = argv
+        self.name = normalize_command_name(argv[0])
+        self.size = size
+        self.client = client
+        self._raw = None
+
+    @property
+    def raw(self):
+        if self._raw is None:
+            self._raw = protocol.format_array([protocol.format_bulk_string(arg) for arg in self.argv])
+            if self.size is None:
+                self.size = len(self._raw)
+        return self._raw
+
+    def rewrite(self, argv):
+        """Replaces what gets propagated for this command; `None` propagates nothing."""
+        self._raw = b"" if argv is None else protocol.format_array([protocol.format_bulk_string(arg) for arg in argv])
+
+    def __len__(self):
+        return len(self.argv)
+
+    def __repr__(self):
+        return f"Command({self.argv!r})"
+
+class RespParser:
+    """
+    Incremental request parser. Data is appended to one bytearray and
+    arguments are sliced out of it through a memoryview, so each argument is
+    copied exactly once; consumed bytes are dropped lazily on the next feed.
+    """
+    def __init__(self, client=None):
+        self._buf = bytearray()
+        self._pos = 0
+        self.client = client
+
+    def feed(self, data):
+        if self._pos:
+            del self._buf[:self._pos]
+            self._pos = 0
+        self._buf += data
+
+    def pending(self):
+        return len(self._buf) - self._pos
+
+    def parse_commands(self):
+        commands = []
+        while True:
+            command = self._parse_one()
+            if command is None:
+                return commands
+            commands.append(command)
+
+    def read_line(self):
+        buf = self._buf
+        crlf = buf.find(b'\r\n', self._pos)
+        if crlf == -1:
+            return None
+        line = bytes(buf[self._pos:crlf])
+        self._pos = crlf + 2
+        return line
+
+    def read_bulk_header(self):
+        """Reads the `$<len>\\r\\n` that starts an RDB transfer (whose payload has no trailing CRLF); returns the length."""
+        buf = self._buf
+        start = self._pos
+        if len(buf) <= start:
+            return None
+        if buf[start] != 36:
+            raise ProtocolError(f"expected '$', got '{chr(buf[start])}'")
+        crlf = buf.find(b'\r\n', start)
+        if crlf == -1:
+            return None
+        length = self._parse_length(buf, start + 1, crlf)
+        self._pos = crlf + 2
+        return length
+
+    def take(self, n):
+        """Consumes and returns up to `n` raw buffered bytes."""
+        start = self._pos
+        end = min(len(self._buf), start + n)
+        with memoryview(self._buf) as view:
+            data = bytes(view[start:end])
+        self._pos = end
+        return data
+
+    def _parse_one(self):
+        buf = self._buf
+        buf_len = len(buf)
+        while True:
+            start = self._pos
+            if start >= buf_len:
+                return None
+            if buf[start] != 42:
+                command = self._parse_inline()
+                if command is False:
+                    continue
+                return command
+
+            crlf = buf.find(b'\r\n', start)
+            if crlf == -1:
+                if buf_len - start > MAX_INLINE_LENGTH:
+                    raise ProtocolError("too big mbulk count string")
+                return None
+            num_elements = self._parse_length(buf, start + 1, crlf)
+            if num_elements <= 0:
+                self._pos = crlf + 2
+                continue
+            break
+
+        argv = []
+        current_pos = crlf + 2
+        with memoryview(buf) as view:
+            for _ in range(num_elements):
+                if current_pos >= buf_len:
+                    return None
+                if buf[current_pos] != 36:
+                    raise ProtocolError(f"expected '$', got '{chr(buf[current_pos])}'")
+                crlf = buf.find(b'\r\n', current_pos)
+                if crlf == -1:
+                    return None
+                length = self._parse_length(buf, current_pos + 1, crlf)
+                if length < 0:
+                    raise ProtocolError("invalid bulk length")
+                data_start = crlf + 2
+                data_end = data_start + length
+                if buf_len < data_end + 2:
+                    return None
+                if buf[data_end] != 13 or buf[data_end + 1] != 10:
+                    raise ProtocolError("expected CRLF after bulk string")
+                argv.append(bytes(view[data_start:data_end]))
+                current_pos = data_end + 2
+
+        self._pos = current_pos
+        return Command(argv, current_pos - start, self.client)
+
+    def _parse_inline(self):
+        buf = self._buf
+        start = self._pos
+        newline = buf.find(b'\n', start)
+        if newline == -1:
+            if len(buf) - start > MAX_INLINE_LENGTH:
+                raise ProtocolError("too big inline request")
+            return None
+        argv = bytes(buf[start:newline]).split()
+        self._pos = newline + 1
+        if not argv:
+            return False
+        return Command(argv, newline + 1 - start, self.client)
+
+    @staticmethod
+    def _parse_length(buf, start, end):
+        try:
+            length = int(buf[start:end])
+        except ValueError:
+            raise ProtocolError("invalid length") from None
+        if length > MAX_BULK_LENGTH:
+            raise ProtocolError("invalid bulk length")
+        return length
@@ -0,0 +1,321 @@
+import threading
+import time
+from collections import deque
+
+# Latency histograms are HDR-style: each power of two is split into
+# 2**LATENCY_SUB_BUCKET_BITS linear sub-buckets, so a bucket is never wider
+# than 1/8 of its value (percentiles are within 12.5%) while a histogram
+# covering 1 usec to LATENCY_MAX_USEC is a flat list of a few hundred counters.
+LATENCY_SUB_BUCKET_BITS = 3
+LATENCY_SUB_BUCKETS = 1 << LATENCY_SUB_BUCKET_BITS
+LATENCY_MAX_USEC = 1 << 36
+LATENCY_BUCKETS = (LATENCY_MAX_USEC.bit_length() - LATENCY_SUB_BUCKET_BITS + 1) * LATENCY_SUB_BUCKETS
+LATENCY_PERCENTILES = (50.0, 99.0, 99.9)
+
+OPS_SAMPLE_INTERVAL_S = 0.1
+OPS_SAMPLES = 16
+
+DEFAULT_SLOWLOG_LOG_SLOWER_THAN_US = 10000
+DEFAULT_SLOWLOG_MAX_LEN = 128
+SLOWLOG_ENTRY_MAX_ARGC = 32
+SLOWLOG_ENTRY_MAX_STRING = 128
+
+DEFAULT_LATENCY_MONITOR_THRESHOLD_MS = 0
+LATENCY_HISTORY_LEN = 160
+
+def latency_bucket(usec):
+    if usec < LATENCY_SUB_BUCKETS:
+        return usec
+    if usec >= LATENCY_MAX_USEC:
+        return LATENCY_BUCKETS - 1
+    shift = usec.bit_length() - LATENCY_SUB_BUCKET_BITS - 1
+    return ((shift + 1) << LATENCY_SUB_BUCKET_BITS) + (usec >> shift) - LATENCY_SUB_BUCKETS
+
+def bucket_upper_bound(index):
+    """Largest latency, in usec, that lands in bucket `index`."""
+    if index < LATENCY_SUB_BUCKETS:
+        return index
+    shift = (index >> LATENCY_SUB_BUCKET_BITS) - 1
+    mantissa = (index & (LATENCY_SUB_BUCKETS - 1)) + LATENCY_SUB_BUCKETS
+    return ((mantissa + 1) << shift) - 1
+
+class CommandStats:
+    __slots__ = ("calls", "nanoseconds", "histogram")
+
+    def __init__(self):
+        self.calls = 0
+        self.nanoseconds = 0
+        self.histogram = [0] * LATENCY_BUCKETS
+
+    def copy(self):
+        stats = CommandStats()
+        stats.calls, stats.nanoseconds, stats.histogram = self.calls, self.nanoseconds, list(self.histogram)
+        return stats
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.nanoseconds += other.nanoseconds
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    def percentile(self, p):
+        threshold = self.calls * p / 100.0
+        seen = 0
+        for index, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= threshold:
+                return bucket_upper_bound(index)
+        return 0
+
+class ThreadCounters:
+    """One thread's share of the command counters. Only that thread writes it, so it needs no lock."""
+    __slots__ = ("commands", "total_commands", "net_input_bytes")
+
+    def __init__(self):
+        self.commands = {}
+        self.total_commands = 0
+        self.net_input_bytes = 0
+
+    def merge(self, other):
+        """Adds `other` (possibly being written meanwhile) into self, which nothing else writes."""
+        for name, stats in list(other.commands.items()):
+            mine = self.commands.get(name)
+            if mine is None:
+                self.commands[name] = stats.copy()
+            else:
+                mine.merge(stats)
+        self.total_commands += other.total_commands
+        self.net_input_bytes += other.net_input_bytes
+
+class SlowLogEntry:
+    __slots__ = ("id", "timestamp", "duration_us", "argv", "client")
+
+    def __init__(self, entry_id, duration_us, cmd):
+        self.id = entry_id
+        self.timestamp = int(time.time())
+        self.duration_us = duration_us
+        self.argv = slowlog_argv(cmd.argv)
+        self.client = cmd.client or ""
+
+def slowlog_argv(argv):
+    """Copies argv the way SLOWLOG shows it: at most SLOWLOG_ENTRY_MAX_ARGC arguments of SLOWLOG_ENTRY_MAX_STRING bytes each."""
+    shown = []
+    for i, arg in enumerate(argv):
+        if i == SLOWLOG_ENTRY_MAX_ARGC - 1 and len(argv) > SLOWLOG_ENTRY_MAX_ARGC:
+            shown.append(b"... (%d more arguments)" % (len(argv) - i))
+            break
+        if len(arg) > SLOWLOG_ENTRY_MAX_STRING:
+            arg = arg[:SLOWLOG_ENTRY_MAX_STRING] + b"... (%d more bytes)" % (len(arg) - SLOWLOG_ENTRY_MAX_STRING)
+        shown.append(bytes(arg))
+    return shown
+
+class LatencyEvent:
+    """Per-second maxima of one event type's latency spikes, newest last, plus the all-time max."""
+    __slots__ = ("history", "max_ms")
+
+    def __init__(self):
+        self.history = deque(maxlen=LATENCY_HISTORY_LEN)
+        self.max_ms = 0
+
+class LatencyMonitor:
+    """
+    Records internal operations (commands, expiry cycles, blocked-client
+    wake-ups, replica fan-out, EXEC) that took at least `threshold_ms`.
+    A threshold of 0 disables it, and `observe()` then costs one comparison.
+    """
+    def __init__(self, threshold_ms=DEFAULT_LATENCY_MONITOR_THRESHOLD_MS):
+        self.lock = threading.Lock()
+        self.threshold_ns = threshold_ms * 1000000 if threshold_ms > 0 else None
+        self.events = {}
+
+    def observe(self, event, elapsed_ns):
+        if self.threshold_ns is None or elapsed_ns < self.threshold_ns:
+            return
+        latency_ms = elapsed_ns // 1000000
+        now = int(time.time())
+        with self.lock:
+            stats = self.events.get(event)
+            if stats is None:
+                stats = self.events[event] = LatencyEvent()
+            history = stats.history
+            if history and history[-1][0] == now:
+                history[-1] = (now, max(history[-1][1], latency_ms))
+            else:
+                history.append((now, latency_ms))
+            stats.max_ms = max(stats.max_ms, latency_ms)
+
+    def measure(self, event, started_ns):
+        self.observe(event, time.perf_counter_ns() - started_ns)
+
+    def latest(self):
+        """(event, timestamp, latest ms, max ms) for every event with samples."""
+        with self.lock:
+            return [(event, stats.history[-1][0], stats.history[-1][1], stats.max_ms)
+                    for event, stats in sorted(self.events.items())]
+
+    def history(self, event):
+        with self.lock:
+            stats = self.events.get(event)
+            return list(stats.history) if stats is not None else []
+
+    def reset(self, events=None):
+        with self.lock:
+            if events is None:
+                events = list(self.events)
+            return sum(self.events.pop(event, None) is not None for event in events)
+
+class ServerStats:
+    """
+    Server-wide counters behind INFO, SLOWLOG and LATENCY. `record()` is the
+    only call on the command path: a few integer updates to the calling
+    thread's own ThreadCounters, taking the lock only to add a slow log
+    entry, so connections never serialize on it. Readers merge every
+    thread's counters under the lock; a thread that is done hands its
+    counters over with `retire_thread()`. A negative
+    `slowlog_log_slower_than_us` disables the slow log.
+    """
+    def __init__(self, slowlog_log_slower_than_us=DEFAULT_SLOWLOG_LOG_SLOWER_THAN_US,
+                 slowlog_max_len=DEFAULT_SLOWLOG_MAX_LEN,
+                 latency_monitor_threshold_ms=DEFAULT_LATENCY_MONITOR_THRESHOLD_MS):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.thread_counters = []
+        self.retired_counters = ThreadCounters()
+        self.start_time = time.time()
+        self.total_connections = 0
+        self.connected_clients = 0
+        self.ops_samples = [0] * OPS_SAMPLES
+        self.ops_sample_index = 0
+        self.last_sample_time = time.monotonic()
+        self.last_sample_commands = 0
+        self.slowlog_threshold_ns = slowlog_log_slower_than_us * 1000 if slowlog_log_slower_than_us >= 0 else None
+        self.slowlog = deque(maxlen=slowlog_max_len)
+        self.slowlog_next_id = 0
+        self.latency_monitor = LatencyMonitor(latency_monitor_threshold_ms)
+
+    def counters(self):
+        """The calling thread's ThreadCounters, registered on first use."""
+        try:
+            return self.local.counters
+        except AttributeError:
+            counters = self.local.counters = ThreadCounters()
+            with self.lock:
+                self.thread_counters.append(counters)
+            return counters
+
+    def retire_thread(self):
+        """Folds the calling thread's counters into the totals; call it when a thread that recorded stats exits."""
+        counters = getattr(self.local, "counters", None)
+        if counters is None:
+            return
+        del self.local.counters
+        with self.lock:
+            self.thread_counters.remove(counters)
+            self.retired_counters.merge(counters)
+
+    def merged_commands(self):
+        """Every thread's per-command stats added up; caller holds `lock`."""
+        merged = ThreadCounters()
+        merged.merge(self.retired_counters)
+        for counters in self.thread_counters:
+            merged.merge(counters)
+        return merged.commands
+
+    def totals(self):
+        """(commands processed, input bytes) over every thread; caller holds `lock`."""
+        all_counters = [self.retired_counters] + self.thread_counters
+        return (sum(counters.total_commands for counters in all_counters),
+                sum(counters.net_input_bytes for counters in all_counters))
+
+    def record(self, cmd, started_ns):
+        """Charges the time since `started_ns` (a perf_counter_ns() reading) to `cmd`."""
+        elapsed_ns = time.perf_counter_ns() - started_ns
+        counters = self.counters()
+        stats = counters.commands.get(cmd.name)
+        if stats is None:
+            stats = counters.commands[cmd.name] = CommandStats()
+        stats.calls += 1
+        stats.nanoseconds += elapsed_ns
+        stats.histogram[latency_bucket(elapsed_ns // 1000)] += 1
+        counters.total_commands += 1
+        if self.slowlog_threshold_ns is not None and elapsed_ns >= self.slowlog_threshold_ns:
+            with self.lock:
+                self.slowlog.append(SlowLogEntry(self.slowlog_next_id, elapsed_ns // 1000, cmd))
+                self.slowlog_next_id += 1
+        self.latency_monitor.observe("command", elapsed_ns)
+
+    def slowlog_entries(self, count=None):
+        """Newest first."""
+        with self.lock:
+            entries = list(reversed(self.slowlog))
+        return entries if count is None else entries[:count]
+
+    def slowlog_len(self):
+        return len(self.slowlog)
+
+    def slowlog_reset(self):
+        with self.lock:
+            self.slowlog.clear()
+
+    def client_connected(self):
+        with self.lock:
+            self.connected_clients += 1
+            self.total_connections += 1
+
+    def client_disconnected(self):
+        with self.lock:
+            self.connected_clients -= 1
+
+    def add_input_bytes(self, n):
+        self.counters().net_input_bytes += n
+
+    def sample_ops(self):
+        """Records the command rate since the previous call; the last OPS_SAMPLES of them average into instantaneous_ops_per_sec."""
+        now = time.monotonic()
+        with self.lock:
+            elapsed = now - self.last_sample_time
+            if elapsed <= 0:
+                return
+            total_commands, _ = self.totals()
+            self.ops_samples[self.ops_sample_index] = int((total_commands - self.last_sample_commands) / elapsed)
+            self.ops_sample_index = (self.ops_sample_index + 1) % OPS_SAMPLES
+            self.last_sample_time = now
+            self.last_sample_commands = total_commands
+
+    def snapshot_commands(self):
+        with self.lock:
+            return sorted(self.merged_commands().items())
+
+    def stats_info(self):
+        with self.lock:
+            total_commands, net_input_bytes = self.totals()
+            return [
+                f"total_connections_received:{self.total_connections}",
+                f"total_commands_processed:{total_commands}",
+                f"instantaneous_ops_per_sec:{sum(self.ops_samples) // OPS_SAMPLES}",
+                f"total_net_input_bytes:{net_input_bytes}",
+                f"uptime_in_seconds:{int(time.time() - self.start_time)}",
+            ]
+
+    def clients_info(self, blocked_clients):
+        with self.lock:
+            connected = self.connected_clients
+        return [f"connected_clients:{connected}", f"blocked_clients:{blocked_clients}"]
+
+    def commandstats_info(self):
+        info_lines = []
+        for name, stats in self.snapshot_commands():
+            usec = stats.nanoseconds // 1000
+            info_lines.append(f"cmdstat_{name.lower()}:calls={stats.calls},usec={usec},usec_per_call={usec / stats.calls:.2f}")
+        return info_lines
+
+    def latencystats_info(self):
+        info_lines = []
+        for name, stats in self.snapshot_commands():
+            percentiles = ",".join(f"p{p:g}={stats.percentile(p):.3f}" for p in LATENCY_PERCENTILES)
+            info_lines.append(f"latency_percentiles_usec_{name.lower()}:{percentiles}")
+        return info_lines
+
+def run_ops_sampler(stats, interval_s=OPS_SAMPLE_INTERVAL_S):
+    while True:
+        time.sleep(interval_s)
+        stats.sample_ops()
@@ -0,0 +1,213 @@
+from array import array
+
+SEGMENT_MAX_ENTRIES = 512
+SEQ_MASK = (1 << 64) - 1
+MAX_ID = (1 << 128) - 1
+
+def pack_id(ms, seq):
+    return (ms << 64) | seq
+
+def unpack_id(stream_id):
+    return stream_id >> 64, stream_id & SEQ_MASK
+
+def format_id(stream_id):
+    return b"%d-%d" % (stream_id >> 64, stream_id & SEQ_MASK)
+
+def parse_id(id_bytes, missing_seq=0):
+    """Parses `ms-seq` or a bare `ms` (taking `missing_seq` as the sequence) into a packed ID."""
+    ms_part, sep, seq_part = id_bytes.partition(b'-')
+    try:
+        ms = int(ms_part)
+        seq = int(seq_part) if sep else missing_seq
+    except ValueError:
+        ms = seq = -1
+    if not 0 <= ms <= SEQ_MASK or not 0 <= seq <= SEQ_MASK:
+        raise ValueError("Invalid stream ID specified as stream command argument")
+    return pack_id(ms, seq)
+
+class StreamSegment:
+    """A run of up to SEGMENT_MAX_ENTRIES consecutive entries, IDs held in two unsigned 64-bit arrays."""
+    __slots__ = ("ms", "seq", "fields")
+
+    def __init__(self):
+        self.ms = array('Q')
+        self.seq = array('Q')
+        self.fields = []
+
+    def __len__(self):
+        return len(self.fields)
+
+    def id_at(self, index):
+        return (self.ms[index] << 64) | self.seq[index]
+
+    def bisect(self, stream_id, right=False):
+        """Index of the first entry >= `stream_id` (> when `right`)."""
+        ms, seq = self.ms, self.seq
+        lo, hi = 0, len(self.fields)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_id = (ms[mid] << 64) | seq[mid]
+            if mid_id < stream_id or (right and mid_id == stream_id):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def entries(self, start, stop):
+        ms, seq = self.ms, self.seq
+        return [(b"%d-%d" % (ms[i], seq[i]), self.fields[i]) for i in range(start, stop)]
+
+    def copy(self):
+        segment = StreamSegment()
+        segment.ms = array('Q', self.ms)
+        segment.seq = array('Q', self.seq)
+        segment.fields = list(self.fields)
+        return segment
+
+class Stream:
+    """
+    Append-only log of (ID, flat field/value tuple) entries split into
+    fixed-size segments. Lookups binary-search the segments by their last
+    ID and then the IDs inside one segment, so range starts cost O(log n)
+    however long the stream is; trimming from the head drops whole segments.
+    """
+    __slots__ = ("segments", "length", "last_id", "entries_added", "max_deleted_id")
+
+    def __init__(self):
+        self.segments = []
+        self.length = 0
+        self.last_id = 0
+        self.entries_added = 0
+        self.max_deleted_id = 0
+
+    def __len__(self):
+        return self.length
+
+    def first_id(self):
+        return self.segments[0].id_at(0) if self.length else 0
+
+    def append(self, stream_id, fields):
+        segments = self.segments
+        if not segments or len(segments[-1]) >= SEGMENT_MAX_ENTRIES:
+            segments.append(StreamSegment())
+        segment = segments[-1]
+        segment.ms.append(stream_id >> 64)
+        segment.seq.append(stream_id & SEQ_MASK)
+        segment.fields.append(fields)
+        self.length += 1
+        self.last_id = stream_id
+        self.entries_added += 1
+
+    def _locate(self, stream_id, right=False):
+        segments = self.segments
+        lo, hi = 0, len(segments)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            segment = segments[mid]
+            last_id = segment.id_at(len(segment) - 1)
+            if last_id < stream_id or (right and last_id == stream_id):
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(segments):
+            return lo, 0
+        return lo, segments[lo].bisect(stream_id, right)
+
+    def range(self, start, end, count=None):
+        results = []
+        if start > end or count == 0:
+            return results
+        segments = self.segments
+        segment_index, index = self._locate(start)
+        while segment_index < len(segments):
+            segment = segments[segment_index]
+            stop = len(segment)
+            reached_end = segment.id_at(stop - 1) > end
+            if reached_end:
+                stop = segment.bisect(end, right=True)
+            if count is not None:
+                stop = min(stop, index + count - len(results))
+            results.extend(segment.entries(index, stop))
+            if reached_end or (count is not None and len(results) >= count):
+                break
+            segment_index += 1
+            index = 0
+        return results
+
+    def revrange(self, end, start, count=None):
+        results = []
+        if start > end or count == 0:
+            return results
+        segments = self.segments
+        segment_index, index = self._locate(end, right=True)
+        if index == 0:
+            segment_index -= 1
+            index = len(segments[segment_index]) if segment_index >= 0 else 0
+        while segment_index >= 0:
+            segment = segments[segment_index]
+            first = 0
+            reached_start = segment.id_at(0) < start
+            if reached_start:
+                first = segment.bisect(start)
+            if count is not None:
+                first = max(first, index - (count - len(results)))
+            chunk = segment.entries(first, index)
+            chunk.reverse()
+            results.extend(chunk)
+            if reached_start or (count is not None and len(results) >= count):
+                break
+            segment_index -= 1
+            index = len(segments[segment_index]) if segment_index >= 0 else 0
+        return results
+
+    def after(self, stream_id, count=None):
+        if stream_id >= MAX_ID:
+            return []
+        return self.range(stream_id + 1, MAX_ID, count)
+
+    def count_before(self, stream_id):
+        segment_index, index = self._locate(stream_id)
+        return sum(len(segment) for segment in self.segments[:segment_index]) + index
+
+    def trim_maxlen(self, maxlen, approximate=False, limit=None):
+        return self._remove_head(self.length - maxlen, approximate, limit)
+
+    def trim_minid(self, minid, approximate=False, limit=None):
+        return self._remove_head(self.count_before(minid), approximate, limit)
+
+    def _remove_head(self, count, approximate, limit):
+        if count <= 0:
+            return 0
+        if approximate and limit:
+            count = min(count, limit)
+        segments = self.segments
+        removed = 0
+        while segments and count - removed >= len(segments[0]):
+            segment = segments.pop(0)
+            removed += len(segment)
+            self.max_deleted_id = segment.id_at(len(segment) - 1)
+        if not approximate and count > removed and segments:
+            head = segments[0]
+            cut = count - removed
+            self.max_deleted_id = head.id_at(cut - 1)
+            del head.ms[:cut]
+            del head.seq[:cut]
+            del head.fields[:cut]
+            removed += cut
+        self.length -= removed
+        return removed
+
+    def iter_entries(self):
+        for segment in self.segments:
+            ms, seq, fields = segment.ms, segment.seq, segment.fields
+            for i in range(len(fields)):
+                yield (ms[i] << 64) | seq[i], fields[i]
+
+    def copy(self):
+        stream = Stream()
+        stream.segments = [segment.copy() for segment in self.segments]
+        stream.length = self.length
+        stream.last_id = self.last_id
+        stream.entries_added = self.entries_added
+        stream.max_deleted_id = self.max_deleted_id
+        return stream
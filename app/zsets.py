@@ -0,0 +1,257 @@
+import math
+from bisect import bisect_left, insort
+
+DEFAULT_ZSET_MAX_LISTPACK_ENTRIES = 128
+DEFAULT_ZSET_MAX_LISTPACK_VALUE = 64
+SORTED_SET_SEGMENT_LOAD = 256
+
+# Both encodings keep their elements ordered by (score, member) and share
+# one small interface: card(), get_score(), rank(), bisect(), entries(),
+# insert() and delete(). Ranges of every kind (by rank, score or lex) are
+# turned into rank ranges with bisect() and read with entries(), which
+# returns (score, member) tuples.
+
+class ZsetListpack(list):
+    """
+    A small sorted set packed as one flat [member, score, member, score, ...]
+    list in (score, member) order, like Redis's listpack encoding. Every
+    operation is a scan or a binary search over the list, cheap while the
+    set stays within the encoding limits; past them it becomes a SortedSet.
+    """
+    __slots__ = ()
+
+    def card(self):
+        return len(self) >> 1
+
+    def get_score(self, member):
+        # Scores are floats, so list.index() can only ever match a member.
+        try:
+            return self[self.index(member) + 1]
+        except ValueError:
+            return None
+
+    def rank(self, member):
+        try:
+            return self.index(member) >> 1
+        except ValueError:
+            return None
+
+    def bisect(self, key):
+        """Number of elements whose (score, member) sorts before the tuple `key`."""
+        lo, hi = 0, len(self) >> 1
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if (self[2 * mid + 1], self[2 * mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def entries(self, start, stop):
+        return [(self[2 * i + 1], self[2 * i]) for i in range(start, stop)]
+
+    def insert(self, member, score):
+        i = 2 * self.bisect((score, member))
+        self[i:i] = (member, score)
+
+    def delete(self, member):
+        try:
+            i = self.index(member)
+        except ValueError:
+            return False
+        del self[i:i + 2]
+        return True
+
+class SortedSet:
+    """
+    A sorted set of any size: a dict from member to score, plus an ordered
+    index of (score, member) tuples split into segments of up to
+    2 * SORTED_SET_SEGMENT_LOAD entries. `maxes` holds each segment's last
+    entry to bisect on, and `tree` is a Fenwick tree over the segment
+    lengths, so finding an element, its rank, or the element at a rank all
+    take O(log n) steps plus a memmove of at most one segment.
+    """
+    __slots__ = ("scores", "segments", "maxes", "tree")
+
+    def __init__(self):
+        self.scores = {}
+        self.segments = []
+        self.maxes = []
+        self.tree = [0]
+
+    def card(self):
+        return len(self.scores)
+
+    def get_score(self, member):
+        return self.scores.get(member)
+
+    def rebuild_tree(self):
+        tree = [0]
+        tree.extend(len(segment) for segment in self.segments)
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def add_to_tree(self, index, delta):
+        tree = self.tree
+        i = index + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def count_before(self, index):
+        """Number of elements in the segments before segment `index`."""
+        tree = self.tree
+        total = 0
+        while index > 0:
+            total += tree[index]
+            index -= index & -index
+        return total
+
+    def find_position(self, rank):
+        """(segment index, offset in it) of the element at `rank`, which must exist."""
+        tree = self.tree
+        index = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            next_index = index + step
+            if next_index < len(tree) and tree[next_index] <= rank:
+                index = next_index
+                rank -= tree[next_index]
+            step >>= 1
+        return index, rank
+
+    def rank(self, member):
+        score = self.scores.get(member)
+        if score is None:
+            return None
+        return self.bisect((score, member))
+
+    def bisect(self, key):
+        i = bisect_left(self.maxes, key)
+        if i == len(self.segments):
+            return len(self.scores)
+        return self.count_before(i) + bisect_left(self.segments[i], key)
+
+    def entries(self, start, stop):
+        if start >= stop:
+            return []
+        index, offset = self.find_position(start)
+        result = []
+        remaining = stop - start
+        segments = self.segments
+        while remaining > 0:
+            chunk = segments[index][offset:offset + remaining]
+            result += chunk
+            remaining -= len(chunk)
+            index += 1
+            offset = 0
+        return result
+
+    def insert(self, member, score):
+        self.scores[member] = score
+        key = (score, member)
+        segments, maxes = self.segments, self.maxes
+        if not segments:
+            segments.append([key])
+            maxes.append(key)
+            self.rebuild_tree()
+            return
+        i = bisect_left(maxes, key)
+        if i == len(segments):
+            i -= 1
+        segment = segments[i]
+        insort(segment, key)
+        maxes[i] = segment[-1]
+        if len(segment) > 2 * SORTED_SET_SEGMENT_LOAD:
+            self.split_segment(i)
+            self.rebuild_tree()
+        else:
+            self.add_to_tree(i, 1)
+
+    def split_segment(self, i):
+        segment = self.segments[i]
+        self.segments[i:i + 1] = [segment[:SORTED_SET_SEGMENT_LOAD], segment[SORTED_SET_SEGMENT_LOAD:]]
+        self.maxes[i:i + 1] = [segment[SORTED_SET_SEGMENT_LOAD - 1], segment[-1]]
+
+    def delete(self, member):
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        key = (score, member)
+        i = bisect_left(self.maxes, key)
+        segment = self.segments[i]
+        del segment[bisect_left(segment, key)]
+        segments, maxes = self.segments, self.maxes
+        if not segment:
+            del segments[i]
+            del maxes[i]
+            self.rebuild_tree()
+        elif len(segment) < SORTED_SET_SEGMENT_LOAD // 2 and len(segments) > 1:
+            # Merge a segment running low into a neighbour, so deletes can't leave many tiny ones behind.
+            j = i if i + 1 < len(segments) else i - 1
+            merged = segments[j] + segments[j + 1]
+            segments[j:j + 2] = [merged]
+            maxes[j:j + 2] = [merged[-1]]
+            if len(merged) > 2 * SORTED_SET_SEGMENT_LOAD:
+                self.split_segment(j)
+            self.rebuild_tree()
+        else:
+            maxes[i] = segment[-1]
+            self.add_to_tree(i, -1)
+        return True
+
+    def copy(self):
+        copied = SortedSet()
+        copied.scores = self.scores.copy()
+        copied.segments = [list(segment) for segment in self.segments]
+        copied.maxes = list(self.maxes)
+        copied.tree = list(self.tree)
+        return copied
+
+def zset_convert_if_needed(zset, limits, members=()):
+    """
+    Returns `zset`, or a SortedSet with its elements if it is a listpack that
+    has more than zset_max_listpack_entries elements or is about to take one
+    of `members` longer than zset_max_listpack_value bytes.
+    """
+    if type(zset) is ZsetListpack:
+        max_value = limits.zset_max_listpack_value
+        if zset.card() > limits.zset_max_listpack_entries or any(len(m) > max_value for m in members):
+            converted = SortedSet()
+            for score, member in zset.entries(0, zset.card()):
+                converted.insert(member, score)
+            return converted
+    return zset
+
+def new_zset(pairs, limits):
+    """Builds a sorted set from (member, score) pairs, in whichever encoding its size calls for."""
+    zset = ZsetListpack() if len(pairs) <= limits.zset_max_listpack_entries else SortedSet()
+    zset = zset_convert_if_needed(zset, limits, [member for member, _ in pairs])
+    for member, score in pairs:
+        if zset.get_score(member) is not None:
+            zset.delete(member)
+        zset.insert(member, score)
+    return zset
+
+def score_rank(zset, score, after):
+    """Number of elements with a score below `score`, or at most `score` when `after`."""
+    if after:
+        if score == math.inf:
+            return zset.card()
+        score = math.nextafter(score, math.inf)
+    return zset.bisect((score,))
+
+def lex_rank(zset, member, after):
+    """Like score_rank() for members, assuming (as Redis does for BYLEX) that all scores are equal."""
+    if not zset.card():
+        return 0
+    first_score = zset.entries(0, 1)[0][0]
+    return zset.bisect((first_score, member + b"\x00" if after else member))
+
+def format_score(score):
+    if score.is_integer() and abs(score) < 1e16:
+        return b"%d" % score
+    return repr(score).encode()
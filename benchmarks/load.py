@@ -0,0 +1,335 @@
+"""
+Load generator in the spirit of redis-benchmark. Starts `app.main` on a free
+loopback port (or targets --host/--port), runs each test with --clients
+connections spread over --processes worker processes, and prints one JSON
+document with throughput and latency percentiles per test, so runs can be
+diffed across changes.
+
+    python -m benchmarks.load --tests set,get --clients 50 --pipeline 16 --requests 200000
+    python -m benchmarks.load --populate 1000000 --tests get --output before.json
+
+Latency is measured per request, from the write of its pipeline batch to
+the arrival of its last reply, and bucketed like INFO latencystats (within
+12.5%). xread_block ignores --pipeline: each request is an XADD sent on a
+second connection to wake a pending XREAD BLOCK, timed from the XADD.
+Each mget request reads MGET_KEYS random keys.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import time
+from app import stats
+
+MGET_KEYS = 10
+
+def encode(*args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        parts += (b"$%d\r\n" % len(arg), arg, b"\r\n")
+    return b"".join(parts)
+
+def reply_end(buf, pos):
+    """End offset of the complete RESP reply starting at `pos`, or -1 if more data is needed."""
+    crlf = buf.find(b"\r\n", pos)
+    if crlf == -1:
+        return -1
+    kind = buf[pos]
+    if kind == 36:
+        length = int(buf[pos + 1:crlf])
+        if length < 0:
+            return crlf + 2
+        end = crlf + 4 + length
+        return end if end <= len(buf) else -1
+    if kind == 42:
+        count = int(buf[pos + 1:crlf])
+        pos = crlf + 2
+        for _ in range(count):
+            pos = reply_end(buf, pos)
+            if pos == -1:
+                return -1
+        return pos
+    return crlf + 2
+
+class Workload:
+    """What one client sends: `request()` returns (bytes, number of replies) for one benchmarked operation."""
+    def __init__(self, test, args, seed):
+        self.test = test
+        self.keyspace = args.keyspace
+        self.value = b"x" * args.value_size
+        self.rng = random.Random(seed)
+
+    def key(self, prefix):
+        return b"%s:%d" % (prefix, self.rng.randrange(self.keyspace))
+
+    def request(self):
+        test = self.test
+        if test == "ping":
+            return encode(b"PING"), 1
+        if test == "set":
+            return encode(b"SET", self.key(b"key"), self.value), 1
+        if test == "get":
+            return encode(b"GET", self.key(b"key")), 1
+        if test == "mget":
+            return encode(b"MGET", *[self.key(b"key") for _ in range(MGET_KEYS)]), 1
+        if test == "incr":
+            return encode(b"INCR", self.key(b"counter")), 1
+        if test == "hset":
+            return encode(b"HSET", self.key(b"hash"), b"field:%d" % self.rng.randrange(10), self.value), 1
+        if test == "zadd":
+            return encode(b"ZADD", b"myzset", b"%d" % self.rng.randrange(1000000), self.key(b"member")), 1
+        if test == "lpush":
+            return encode(b"LPUSH", b"mylist", self.value), 1
+        if test == "lpop":
+            return encode(b"LPOP", b"mylist"), 1
+        if test == "xadd":
+            return encode(b"XADD", b"mystream", b"*", b"field", self.value), 1
+        if test == "xrange":
+            return encode(b"XRANGE", b"mystream", b"-", b"+", b"COUNT", b"10"), 1
+        if test == "multi_exec":
+            return b"".join((encode(b"MULTI"), encode(b"SET", self.key(b"key"), self.value),
+                             encode(b"INCR", self.key(b"counter")), encode(b"EXEC"))), 4
+        raise ValueError(f"unknown test {test}")
+
+TESTS = ("ping", "set", "get", "mget", "incr", "hset", "zadd", "lpush", "lpop", "xadd", "xrange", "xread_block", "multi_exec")
+
+class Results:
+    __slots__ = ("latency", "max_ns", "errors")
+
+    def __init__(self):
+        self.latency = stats.CommandStats()
+        self.max_ns = 0
+        self.errors = 0
+
+    def add(self, elapsed_ns):
+        latency = self.latency
+        latency.calls += 1
+        latency.nanoseconds += elapsed_ns
+        latency.histogram[stats.latency_bucket(elapsed_ns // 1000)] += 1
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+
+    def merge(self, other):
+        self.latency.calls += other.latency.calls
+        self.latency.nanoseconds += other.latency.nanoseconds
+        self.latency.histogram = [a + b for a, b in zip(self.latency.histogram, other.latency.histogram)]
+        self.max_ns = max(self.max_ns, other.max_ns)
+        self.errors += other.errors
+
+class ReplyReader:
+    def __init__(self, reader, results):
+        self.reader = reader
+        self.results = results
+        self.buf = bytearray()
+        self.pos = 0
+
+    async def read_replies(self, count):
+        """Waits for `count` more replies and returns the last one."""
+        buf = self.buf
+        while True:
+            end = reply_end(buf, self.pos) if self.pos < len(buf) else -1
+            if end == -1:
+                if self.pos:
+                    del buf[:self.pos]
+                    self.pos = 0
+                data = await self.reader.read(65536)
+                if not data:
+                    raise ConnectionError("server closed the connection")
+                buf += data
+                continue
+            if buf[self.pos] == 45:
+                self.results.errors += 1
+            reply = bytes(buf[self.pos:end])
+            self.pos = end
+            count -= 1
+            if not count:
+                return reply
+
+async def run_client(args, test, client_id, quota, results):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    replies = ReplyReader(reader, results)
+    workload = Workload(test, args, client_id)
+    try:
+        done = 0
+        while done < quota:
+            batch = [workload.request() for _ in range(min(args.pipeline, quota - done))]
+            writer.write(b"".join(request for request, _ in batch))
+            started = time.perf_counter_ns()
+            for _, reply_count in batch:
+                await replies.read_replies(reply_count)
+                results.add(time.perf_counter_ns() - started)
+            done += len(batch)
+    finally:
+        writer.close()
+
+async def run_xread_client(args, client_id, quota, results):
+    key = b"bench:xread:%d" % client_id
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    producer_reader, producer = await asyncio.open_connection(args.host, args.port)
+    replies, producer_replies = ReplyReader(reader, results), ReplyReader(producer_reader, results)
+    value = b"x" * args.value_size
+    last_id = b"0-0"
+    try:
+        for _ in range(quota):
+            writer.write(encode(b"XREAD", b"BLOCK", b"0", b"STREAMS", key, last_id))
+            await writer.drain()
+            producer.write(encode(b"XADD", key, b"*", b"field", value))
+            started = time.perf_counter_ns()
+            reply = await producer_replies.read_replies(1)
+            last_id = reply.split(b"\r\n")[1]
+            await replies.read_replies(1)
+            results.add(time.perf_counter_ns() - started)
+    finally:
+        writer.close()
+        producer.close()
+
+async def run_clients(args, test, client_ids, quotas):
+    results = Results()
+    if test == "xread_block":
+        clients = [run_xread_client(args, client_id, quota, results) for client_id, quota in zip(client_ids, quotas)]
+    else:
+        clients = [run_client(args, test, client_id, quota, results) for client_id, quota in zip(client_ids, quotas)]
+    await asyncio.gather(*clients)
+    return results
+
+def run_worker(args, test, client_ids, quotas, start_at):
+    """Entry point of one worker process; returns (results, first send, last reply) with monotonic times."""
+    time.sleep(max(0.0, start_at - time.monotonic()))
+    started = time.monotonic()
+    results = asyncio.run(run_clients(args, test, client_ids, quotas))
+    return results, started, time.monotonic()
+
+def split(total, parts):
+    return [total // parts + (i < total % parts) for i in range(parts)]
+
+def run_test(pool, args, test):
+    quotas = split(args.requests, args.clients)
+    processes = min(args.processes, args.clients)
+    per_process = split(args.clients, processes)
+    jobs = []
+    first = 0
+    # A common start time lets every process finish forking before any load starts.
+    start_at = time.monotonic() + 0.2
+    for count in per_process:
+        client_ids = list(range(first, first + count))
+        jobs.append((args, test, client_ids, quotas[first:first + count], start_at))
+        first += count
+    outcomes = pool.starmap(run_worker, jobs)
+
+    results = Results()
+    for worker_results, _, _ in outcomes:
+        results.merge(worker_results)
+    elapsed = max(end for _, _, end in outcomes) - min(start for _, start, _ in outcomes)
+    latency = results.latency
+    return {
+        "test": test,
+        "requests": latency.calls,
+        "errors": results.errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_sec": round(latency.calls / elapsed, 1),
+        "latency_usec": {
+            "avg": round(latency.nanoseconds / 1000 / max(1, latency.calls), 1),
+            "p50": latency.percentile(50.0),
+            "p99": latency.percentile(99.0),
+            "p999": latency.percentile(99.9),
+            "max": results.max_ns // 1000,
+        },
+    }
+
+def send_command(args, *argv):
+    with socket.create_connection((args.host, args.port)) as sock:
+        sock.sendall(encode(*argv))
+        buf = bytearray()
+        while not buf or reply_end(buf, 0) == -1:
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            buf += data
+        return bytes(buf)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+def start_server(args):
+    command = [sys.executable, "-m", "app.main", "--port", str(args.port), "--io-model", args.io_model]
+    command += shlex.split(args.server_args)
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection((args.host, args.port)).close()
+            return server
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError(f"server failed to start: {' '.join(command)}")
+            time.sleep(0.05)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, help="Benchmark a running server instead of starting one.")
+    parser.add_argument("--io-model", choices=["threads", "asyncio"], default="threads",
+                        help="I/O model of the server started for the run.")
+    parser.add_argument("--server-args", default="", help="Extra arguments for the started server, e.g. '--shards 4'.")
+    parser.add_argument("--tests", default=",".join(TESTS), help=f"Comma-separated subset of {','.join(TESTS)}.")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--processes", type=int, default=4, help="Worker processes the clients are spread over.")
+    parser.add_argument("--requests", type=int, default=100000, help="Requests per test, over all clients.")
+    parser.add_argument("--pipeline", type=int, default=1)
+    parser.add_argument("--keyspace", type=int, default=10000, help="Random keys are drawn from key:0..keyspace-1.")
+    parser.add_argument("--value-size", type=int, default=3)
+    parser.add_argument("--populate", type=int, default=0,
+                        help="DEBUG POPULATE this many keys (key:N, --value-size bytes) before the tests.")
+    parser.add_argument("--output", help="Also write the JSON report to this file.")
+    args = parser.parse_args()
+
+    tests = [test.strip().lower() for test in args.tests.split(",") if test.strip()]
+    unknown = [test for test in tests if test not in TESTS]
+    if unknown:
+        parser.error(f"unknown tests: {', '.join(unknown)}")
+
+    server = None
+    if args.port is None:
+        args.port = free_port()
+        server = start_server(args)
+    try:
+        if args.populate:
+            started = time.perf_counter()
+            send_command(args, b"DEBUG", b"POPULATE", b"%d" % args.populate, b"key", b"%d" % args.value_size)
+            print(f"populated {args.populate} keys in {time.perf_counter() - started:.2f} s", file=sys.stderr)
+        results = []
+        with multiprocessing.Pool(min(args.processes, args.clients)) as pool:
+            for test in tests:
+                result = run_test(pool, args, test)
+                latency = result["latency_usec"]
+                print(f"{test:<12} {result['requests_per_sec']:>12,.0f} req/s  p50 {latency['p50']} us  "
+                      f"p99 {latency['p99']} us  p999 {latency['p999']} us", file=sys.stderr)
+                results.append(result)
+    finally:
+        if server is not None:
+            server.kill()
+            server.wait()
+
+    report = {
+        "config": {"io_model": args.io_model if server is not None else None, "server_args": args.server_args,
+                   "clients": args.clients, "processes": args.processes, "requests": args.requests,
+                   "pipeline": args.pipeline, "keyspace": args.keyspace, "value_size": args.value_size,
+                   "populate": args.populate},
+        "results": results,
+    }
+    document = json.dumps(report, indent=2)
+    print(document)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(document + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+RDB load throughput: builds a keyspace of strings, lists and streams, saves
+it once, then times loading it back from the file (mmap) and from a chunked
+in-memory feed, the way a replica receives a full sync.
+
+    python -m benchmarks.rdb_load --keys 200000 --value-size 64
+"""
+import argparse
+import os
+import tempfile
+import time
+from collections import deque
+from app import rdb
+from app.datastore import RedisDataStore
+from app.streams import Stream, pack_id
+
+def build_datastore(num_keys, value_size, shards):
+    datastore = RedisDataStore(num_shards=shards)
+    value = b"x" * value_size
+    for i in range(num_keys):
+        key = b"key:%d" % i
+        kind = i % 10
+        if kind == 8:
+            datastore.set_item(key, deque(value[:8] + b"%d" % j for j in range(16)))
+        elif kind == 9:
+            stream = Stream()
+            for j in range(16):
+                stream.append(pack_id(1700000000000 + j, 0), (b"field", value[:8], b"n", b"%d" % j))
+            datastore.set_item(key, stream)
+        elif kind % 2:
+            datastore.set_item(key, i)
+        else:
+            datastore.set_item(key, value)
+    return datastore
+
+def report(label, size, num_keys, elapsed):
+    print(f"{label:<16} {elapsed:8.3f} s  {num_keys / elapsed:12,.0f} keys/s  {size / elapsed / 1e6:8.1f} MB/s")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keys", type=int, default=100000)
+    parser.add_argument("--value-size", type=int, default=64)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=64 * 1024, help="Feed size for the streaming load.")
+    args = parser.parse_args()
+
+    source = build_datastore(args.keys, args.value_size, args.shards)
+    snapshot = rdb.capture_snapshot(source, {})
+    with tempfile.TemporaryDirectory() as directory:
+        path = rdb.save_snapshot(snapshot, directory, "bench.rdb")
+        size = os.path.getsize(path)
+        print(f"{args.keys} keys, {size / 1e6:.1f} MB RDB")
+
+        started = time.perf_counter()
+        loader = rdb.load_file(path, RedisDataStore(num_shards=args.shards))
+        report("file (mmap)", size, loader.keys_loaded, time.perf_counter() - started)
+
+        with open(path, "rb") as f:
+            data = f.read()
+        started = time.perf_counter()
+        loader = rdb.RdbLoader(RedisDataStore(num_shards=args.shards))
+        for i in range(0, len(data), args.chunk_size):
+            loader.feed(data[i:i + args.chunk_size])
+        loader.finish()
+        report(f"stream ({args.chunk_size // 1024} KiB)", size, loader.keys_loaded, time.perf_counter() - started)
+
+if __name__ == "__main__":
+    main()
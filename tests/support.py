@@ -0,0 +1,85 @@
+"""
+Helpers shared by the persistence tests: a datastore holding every value
+encoding, filled through the command handlers the way clients would, and a
+plain-data description of a keyspace to compare two of them by.
+"""
+from collections import deque
+from app import stats
+from app.command_handler import handle_command
+from app.datastore import RedisDataStore
+from app.hashes import HashListpack
+from app.intsets import IntSet
+from app.resp import Command
+from app.streams import Stream
+from app.zsets import ZsetListpack, SortedSet
+
+def make_server_state():
+    return {"role": "master", "master_replid": "8371b4fb1155b71f4a04d3e1bc3e18c4a990aeeb",
+            "master_repl_offset": 0, "aof": None, "stats": stats.ServerStats()}
+
+def run(datastore, server_state, *argv):
+    return handle_command(Command([arg if isinstance(arg, bytes) else str(arg).encode() for arg in argv]),
+                          datastore, server_state)
+
+def populate(datastore, server_state):
+    """Writes at least one key in each encoding the RDB and AOF writers handle."""
+    run(datastore, server_state, "SET", "str", "hello")
+    run(datastore, server_state, "SET", "str:long", "x" * 300)
+    run(datastore, server_state, "SET", "str:binary", b"\x00\r\n\xff")
+    run(datastore, server_state, "SET", "int", "12345")
+    run(datastore, server_state, "SET", "int:negative", "-9223372036854775808")
+    run(datastore, server_state, "SET", "int:too-big", "92233720368547758070")
+    run(datastore, server_state, "SET", "int:leading-zero", "007")
+    run(datastore, server_state, "SET", "expiring", "v", "PX", "100000000")
+
+    run(datastore, server_state, "RPUSH", "list", "a", "b", "1", "-2", "x" * 100)
+
+    run(datastore, server_state, "HSET", "hash:listpack", "f1", "v1", "f2", "2", "f3", "")
+    run(datastore, server_state, "HSET", "hash:dict", *[x for i in range(200) for x in (f"f{i}", f"v{i}")])
+    run(datastore, server_state, "HSET", "hash:long-value", "f", "v" * 100)
+
+    run(datastore, server_state, "ZADD", "zset:listpack", "1", "a", "2.5", "b", "-inf", "c", "1", "aa")
+    run(datastore, server_state, "ZADD", "zset:sorted", *[x for i in range(300) for x in (str(i % 17), f"m{i}")])
+
+    run(datastore, server_state, "SADD", "set:int16", "1", "2", "-3")
+    run(datastore, server_state, "SADD", "set:int32", "1", "100000")
+    run(datastore, server_state, "SADD", "set:int64", "1", "70000000000", "-70000000000")
+    run(datastore, server_state, "SADD", "set:strings", "a", "b", "1")
+    run(datastore, server_state, "SADD", "set:many-ints", *range(1000))
+
+    for i in range(1, 251):
+        run(datastore, server_state, "XADD", "stream", f"{i}-{i % 3}", "f", i, *(("g", "same") if i % 2 else ()))
+    run(datastore, server_state, "XTRIM", "stream", "MAXLEN", "200")
+    run(datastore, server_state, "XADD", "stream:empty", "5-5", "f", "v")
+    run(datastore, server_state, "XTRIM", "stream:empty", "MAXLEN", "0")
+
+def describe_value(value):
+    """A comparable (encoding, contents) pair for a stored value."""
+    value_type = type(value)
+    if value_type is deque:
+        contents = list(value)
+    elif value_type in (HashListpack, ZsetListpack, IntSet):
+        contents = list(value)
+    elif value_type is SortedSet:
+        contents = value.entries(0, value.card())
+    elif value_type is set:
+        contents = sorted(value)
+    elif value_type is Stream:
+        contents = (list(value.iter_entries()), len(value), value.last_id)
+    else:
+        contents = value
+    return value_type.__name__, contents
+
+def describe(datastore):
+    """{key: ((encoding, contents), expiry_ms)} for every key in `datastore`."""
+    keyspace = {}
+    for shard in datastore.shards:
+        for key, value in shard.data.items():
+            keyspace[key] = (describe_value(value), shard.expires.get(key))
+    return keyspace
+
+def populated_datastore(num_shards=1):
+    datastore = RedisDataStore(num_shards=num_shards)
+    server_state = make_server_state()
+    populate(datastore, server_state)
+    return datastore, server_state
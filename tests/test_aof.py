@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+from app import aof, rdb
+from app.datastore import RedisDataStore
+from tests.support import describe, make_server_state, populated_datastore
+
+COMMANDS = [
+    aof.format_command(b"SET", b"a", b"1"),
+    aof.format_command(b"RPUSH", b"list", b"x", b"y\r\nz"),
+    aof.format_command(b"INCR", b"a"),
+    aof.format_command(b"HSET", b"h", b"f", b"v"),
+]
+
+class LoadAofTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "appendonly.aof")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def load(self, data):
+        with open(self.path, "wb") as f:
+            f.write(data)
+        datastore = RedisDataStore()
+        applied = aof.load_aof(self.path, datastore, make_server_state())
+        return applied, datastore
+
+    def test_complete_file(self):
+        applied, datastore = self.load(b"".join(COMMANDS))
+        self.assertEqual(applied, len(COMMANDS))
+        self.assertEqual(os.path.getsize(self.path), len(b"".join(COMMANDS)))
+        self.assertEqual(datastore.get_item(b"a"), 2)
+        self.assertEqual(list(datastore.get_item(b"list")), [b"x", b"y\r\nz"])
+
+    def test_truncated_tail_is_dropped_at_every_cut(self):
+        complete = b"".join(COMMANDS[:-1])
+        last = COMMANDS[-1]
+        for cut in range(1, len(last)):
+            applied, datastore = self.load(complete + last[:cut])
+            self.assertEqual(applied, len(COMMANDS) - 1, cut)
+            self.assertEqual(os.path.getsize(self.path), len(complete), cut)
+            self.assertIsNone(datastore.get_item(b"h"), cut)
+            self.assertEqual(datastore.get_item(b"a"), 2, cut)
+
+    def test_truncated_file_accepts_new_writes(self):
+        complete = b"".join(COMMANDS[:2])
+        self.load(complete + COMMANDS[2][:5])
+        with open(self.path, "rb") as f:
+            recovered = f.read()
+        applied, datastore = self.load(recovered + COMMANDS[3])
+        self.assertEqual(applied, 3)
+        self.assertEqual(datastore.get_item(b"a"), 1)
+        self.assertIsNotNone(datastore.get_item(b"h"))
+
+class RewriteRoundTripTest(unittest.TestCase):
+    def test_rewritten_log_rebuilds_the_keyspace(self):
+        datastore, server_state = populated_datastore()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "appendonly.aof")
+            aof.save_dataset(rdb.capture_snapshot(datastore, server_state), path)
+            loaded = RedisDataStore()
+            aof.load_aof(path, loaded, make_server_state())
+            self.assertEqual(os.listdir(directory), ["appendonly.aof"])
+        self.assertEqual(describe(loaded), describe(datastore))
+
+if __name__ == "__main__":
+    unittest.main()
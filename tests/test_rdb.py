@@ -0,0 +1,77 @@
+import io
+import os
+import tempfile
+import unittest
+from app import rdb
+from app.datastore import RedisDataStore
+from tests.support import describe, populated_datastore
+
+def encode(datastore, server_state):
+    out = io.BytesIO()
+    rdb.write_snapshot(rdb.capture_snapshot(datastore, server_state), out)
+    return out.getvalue()
+
+class RdbRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.datastore, self.server_state = populated_datastore()
+        self.payload = encode(self.datastore, self.server_state)
+
+    def test_parse_restores_every_encoding(self):
+        loaded = RedisDataStore()
+        loader = rdb.RdbLoader(loaded)
+        self.assertEqual(loader.parse(self.payload, 0), len(self.payload))
+        self.assertTrue(loader.done)
+        self.assertEqual(describe(loaded), describe(self.datastore))
+        self.assertEqual(loader.keys_loaded, len(describe(self.datastore)))
+
+    def test_feed_in_small_chunks(self):
+        for chunk_size in (1, 7, 4096):
+            loaded = RedisDataStore()
+            loader = rdb.RdbLoader(loaded)
+            for i in range(0, len(self.payload), chunk_size):
+                loader.feed(self.payload[i:i + chunk_size])
+            loader.finish()
+            self.assertEqual(describe(loaded), describe(self.datastore), chunk_size)
+
+    def test_load_file_into_sharded_datastore(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = rdb.save_snapshot(rdb.capture_snapshot(self.datastore, self.server_state), directory, "dump.rdb")
+            loaded = RedisDataStore(num_shards=4)
+            rdb.load_file(path, loaded)
+            self.assertEqual(os.listdir(directory), ["dump.rdb"])
+        self.assertEqual(describe(loaded), describe(self.datastore))
+
+    def test_sharded_datastore_encodes_the_same_keyspace(self):
+        datastore, server_state = populated_datastore(num_shards=3)
+        loaded = RedisDataStore()
+        rdb.RdbLoader(loaded).parse(encode(datastore, server_state), 0)
+        self.assertEqual(describe(loaded), describe(datastore))
+
+    def test_replication_aux_fields(self):
+        self.server_state["master_repl_offset"] = 12345
+        loader = rdb.RdbLoader(RedisDataStore())
+        loader.parse(encode(self.datastore, self.server_state), 0)
+        self.assertEqual(loader.aux[b"repl-id"], self.server_state["master_replid"].encode())
+        self.assertEqual(loader.aux[b"repl-offset"], b"12345")
+
+    def test_truncated_payload(self):
+        loader = rdb.RdbLoader(RedisDataStore())
+        loader.feed(self.payload[:len(self.payload) // 2])
+        with self.assertRaises(rdb.RdbError):
+            loader.finish()
+
+    def test_writes_after_the_snapshot_starts_are_not_in_it(self):
+        expected = describe(self.datastore)
+        snapshot = rdb.capture_snapshot(self.datastore, self.server_state)
+        with self.datastore.all_locks():
+            self.datastore.get_item(b"list").append(b"late")
+            self.datastore.set_item(b"str", b"changed")
+            self.datastore.delete_item(b"hash:listpack")
+        out = io.BytesIO()
+        rdb.write_snapshot(snapshot, out)
+        loaded = RedisDataStore()
+        rdb.RdbLoader(loaded).parse(out.getvalue(), 0)
+        self.assertEqual(describe(loaded), expected)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import random
+import unittest
+from app.replication import ReplicationBacklog
+
+class ReplicationBacklogTest(unittest.TestCase):
+    def check_tail(self, backlog, stream, start_offset=0):
+        """Every offset the backlog still covers reads back exactly what was appended from there on."""
+        end_offset = start_offset + len(stream)
+        self.assertEqual(backlog.end_offset, end_offset)
+        kept = min(len(backlog.buffer), len(stream))
+        self.assertEqual(backlog.start_offset(), end_offset - kept)
+        for offset in range(end_offset - kept, end_offset + 1):
+            self.assertEqual(backlog.read_from(offset), stream[offset - start_offset:], offset)
+        self.assertIsNone(backlog.read_from(end_offset - kept - 1))
+        self.assertIsNone(backlog.read_from(end_offset + 1))
+
+    def test_empty(self):
+        backlog = ReplicationBacklog(16)
+        self.assertEqual(backlog.read_from(0), b"")
+        self.assertIsNone(backlog.read_from(1))
+
+    def test_within_capacity(self):
+        backlog = ReplicationBacklog(16)
+        backlog.append(b"hello ")
+        backlog.append(b"world")
+        self.check_tail(backlog, b"hello world")
+
+    def test_wraps_around(self):
+        backlog = ReplicationBacklog(16)
+        stream = b""
+        for i in range(40):
+            data = b"%d," % i
+            backlog.append(data)
+            stream += data
+            self.check_tail(backlog, stream)
+
+    def test_append_larger_than_buffer(self):
+        backlog = ReplicationBacklog(16)
+        backlog.append(b"abc")
+        stream = b"abc" + bytes(range(100))
+        backlog.append(bytes(range(100)))
+        self.check_tail(backlog, stream)
+
+    def test_append_exactly_buffer_size_at_an_offset(self):
+        backlog = ReplicationBacklog(16)
+        backlog.append(b"12345")
+        backlog.append(b"x" * 16)
+        self.check_tail(backlog, b"12345" + b"x" * 16)
+
+    def test_nonzero_start_offset(self):
+        backlog = ReplicationBacklog(16, start_offset=1000)
+        self.assertIsNone(backlog.read_from(999))
+        backlog.append(b"0123456789abcdefXYZ")
+        self.check_tail(backlog, b"0123456789abcdefXYZ", start_offset=1000)
+
+    def test_accepts_memoryview(self):
+        backlog = ReplicationBacklog(8)
+        backlog.append(memoryview(b"abcdefghij")[2:])
+        self.check_tail(backlog, b"cdefghij")
+
+    def test_random_appends_against_a_reference(self):
+        rng = random.Random(1234)
+        for size in (1, 7, 64):
+            backlog = ReplicationBacklog(size)
+            stream = b""
+            for _ in range(200):
+                data = rng.randbytes(rng.randint(0, 2 * size))
+                backlog.append(data)
+                stream += data
+            self.check_tail(backlog, stream)
+
+if __name__ == "__main__":
+    unittest.main()